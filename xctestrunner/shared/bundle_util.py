@@ -14,16 +14,35 @@
 
 """Utility methods for managing Apple bundles."""
 
+import concurrent.futures
 import glob
+import hashlib
+import json
+import logging
 import os
+import plistlib
+import re
+import stat
 import subprocess
 import tempfile
+import threading
 
+from xctestrunner.shared import cache_util
 from xctestrunner.shared import ios_errors
+from xctestrunner.shared import macho
 from xctestrunner.shared import plist_util
+from xctestrunner.shared import zip_util
 
+_FINGERPRINT_MAX_WORKERS = min(8, os.cpu_count() or 1)
+_FILE_DIGESTS_CACHE_NAME = 'file_digests'
+_FILE_DIGESTS_MAX_SHARDS = 256
+_HASH_CHUNK_SIZE = 1024 * 1024
+_CERTIFICATE_SHA1_PATTERN = re.compile(r'^[0-9A-Fa-f]{40}$')
+_FIND_IDENTITY_LINE_PATTERN = re.compile(
+    r'^\s*\d+\)\s+([0-9A-Fa-f]{40})\s+"(.*)"')
 
-def ExtractApp(compressed_app_path, working_dir):
+
+def ExtractApp(compressed_app_path, working_dir, extraction_cache=None):
   """Creates a temp directory and extracts compressed file of the app there.
 
   Args:
@@ -31,6 +50,8 @@ def ExtractApp(compressed_app_path, working_dir):
       extension name must end with .ipa.
     working_dir: string, the working directory where the extracted bundle
       places.
+    extraction_cache: extraction_cache.ExtractionCache, the cache of the
+      extracted archives. None means always extracting the file.
 
   Returns:
     string, the path of extracted bundle, which is
@@ -44,11 +65,15 @@ def ExtractApp(compressed_app_path, working_dir):
     ios_errors.BundleError(
         'The extension of the compressed file should be .ipa.')
   unzip_target_dir = tempfile.mkdtemp(dir=working_dir)
-  _UnzipWithShell(compressed_app_path, unzip_target_dir)
+  # Only extracts the app, skipping the other payload like SwiftSupport and
+  # Symbols.
+  _ExtractZip(compressed_app_path, unzip_target_dir, _IsAppMember,
+              extraction_cache)
   return _ExtractBundleFile('%s/Payload' % unzip_target_dir, 'app')
 
 
-def ExtractTestBundle(compressed_test_path, working_dir):
+def ExtractTestBundle(compressed_test_path, working_dir,
+                      extraction_cache=None):
   """Creates a temp directory and extracts compressed file of the test bundle.
 
   Args:
@@ -56,6 +81,8 @@ def ExtractTestBundle(compressed_test_path, working_dir):
       extension name must end with .ipa/.zip.
     working_dir: string, the working directory where the extracted bundle
       places.
+    extraction_cache: extraction_cache.ExtractionCache, the cache of the
+      extracted archives. None means always extracting the file.
 
   Returns:
     string, the path of extracted bundle, which is
@@ -70,7 +97,8 @@ def ExtractTestBundle(compressed_test_path, working_dir):
     ios_errors.BundleError(
         'The extension of the compressed file should be .ipa/zip.')
   unzip_target_dir = tempfile.mkdtemp(dir=working_dir)
-  _UnzipWithShell(compressed_test_path, unzip_target_dir)
+  _ExtractZip(compressed_test_path, unzip_target_dir, _IsTestBundleMember,
+              extraction_cache)
   try:
     return _ExtractBundleFile(unzip_target_dir, 'xctest')
   except ios_errors.BundleError:
@@ -111,6 +139,79 @@ def GetBundleId(bundle_path):
   return plist_util.Plist(info_plist).GetPlistField('CFBundleIdentifier')
 
 
+class SigningInfo(object):
+  """The code signing information of a bundle, parsed from codesign."""
+
+  def __init__(self, identifier=None, authorities=None, team_identifier=None,
+               entitlements=None, output=''):
+    self._identifier = identifier
+    self._authorities = authorities or []
+    self._team_identifier = team_identifier
+    self._entitlements = entitlements
+    self._output = output
+
+  @property
+  def identifier(self):
+    """Gets the code signing identifier of the bundle."""
+    return self._identifier
+
+  @property
+  def authorities(self):
+    """Gets the authority chain of the signature, from the leaf certificate."""
+    return list(self._authorities)
+
+  @property
+  def identity(self):
+    """Gets the codesign identity which signs the bundle with."""
+    return self._authorities[0] if self._authorities else None
+
+  @property
+  def team_identifier(self):
+    """Gets the development team of the bundle."""
+    return self._team_identifier
+
+  @property
+  def entitlements(self):
+    """Gets the dict of the signed entitlements, or None if there are none."""
+    return self._entitlements
+
+  @property
+  def output(self):
+    """Gets the raw output of codesign."""
+    return self._output
+
+
+_signing_info_cache = {}
+_signing_info_cache_lock = threading.Lock()
+_certificate_sha1_cache = {}
+_certificate_sha1_cache_lock = threading.Lock()
+
+
+def GetSigningInfo(bundle_path):
+  """Gets the code signing information of the bundle.
+
+  The codesign is run once per bundle. The result is memoized by the bundle
+  path and the mtimes of the bundle and its signature, and dropped when the
+  bundle is resigned by CodesignBundle.
+
+  Args:
+    bundle_path: string, full path of bundle folder or the signed file.
+
+  Returns:
+    a SigningInfo object.
+  """
+  bundle_path = os.path.realpath(bundle_path)
+  stamp = _GetSigningStamp(bundle_path)
+  with _signing_info_cache_lock:
+    cached = _signing_info_cache.get(bundle_path)
+  if cached and cached[0] == stamp:
+    return cached[1]
+  signing_info = _ProbeSigningInfo(bundle_path)
+  with _signing_info_cache_lock:
+    _signing_info_cache[bundle_path] = (stamp, signing_info)
+  return signing_info
+
+
 def GetCodesignIdentity(bundle_path):
   """Gets the codesign identity which signs the bundle with.
 
@@ -124,16 +225,51 @@ def GetCodesignIdentity(bundle_path):
     ios_errors.BundleError: when failed to get the signing identity from the
       bundle.
   """
-  command = ('codesign', '-dvv', bundle_path)
-  process = subprocess.Popen(command, stdout=subprocess.PIPE,
-                             stderr=subprocess.STDOUT)
-  output = process.communicate()[0].decode('utf-8')
-  for line in output.split('\n'):
-    if line.startswith('Authority='):
-      return line[len('Authority='):]
+  signing_info = GetSigningInfo(bundle_path)
+  if signing_info.identity is None:
+    raise ios_errors.BundleError('Failed to extract signing identity from %s' %
+                                 signing_info.output)
+  return signing_info.identity
+
+
+def GetSigningCertificateSha1(identity):
+  """Gets the SHA-1 of the certificate which codesign uses for the identity.
+
+  Like codesign, a 40 hex digits identity is the SHA-1 itself, and any other
+  identity is matched as a substring of the names of the valid codesigning
+  identities in the keychains.
 
-  raise ios_errors.BundleError('Failed to extract signing identity from %s' %
-                               output)
+  Args:
+    identity: string, the identity to sign bundle.
+
+  Returns:
+    string, the upper case SHA-1 of the certificate. '-' for the ad-hoc
+      identity. None if the identity does not match exactly one certificate.
+  """
+  if identity == '-':
+    return identity
+  if _CERTIFICATE_SHA1_PATTERN.match(identity):
+    return identity.upper()
+  with _certificate_sha1_cache_lock:
+    if identity in _certificate_sha1_cache:
+      return _certificate_sha1_cache[identity]
+  try:
+    output = subprocess.check_output(
+        ['security', 'find-identity', '-v', '-p', 'codesigning'],
+        stderr=subprocess.STDOUT).decode('utf-8', 'replace')
+  except (subprocess.CalledProcessError, OSError) as e:
+    logging.warning('Failed to find the codesigning identities: %s', e)
+    return None
+  certificate_sha1s = set()
+  for line in output.splitlines():
+    match = _FIND_IDENTITY_LINE_PATTERN.match(line)
+    if match and identity in match.group(2):
+      certificate_sha1s.add(match.group(1).upper())
+  certificate_sha1 = (
+      certificate_sha1s.pop() if len(certificate_sha1s) == 1 else None)
+  with _certificate_sha1_cache_lock:
+    _certificate_sha1_cache[identity] = certificate_sha1
+  return certificate_sha1
 
 
 def GetDevelopmentTeam(bundle_path):
@@ -149,16 +285,11 @@ def GetDevelopmentTeam(bundle_path):
     ios_errors.BundleError: when failed to get the development team from the
       bundle.
   """
-  command = ('codesign', '-dvv', bundle_path)
-  process = subprocess.Popen(command, stdout=subprocess.PIPE,
-                             stderr=subprocess.STDOUT)
-  output = process.communicate()[0].decode('utf-8')
-  for line in output.split('\n'):
-    if line.startswith('TeamIdentifier='):
-      return line[len('TeamIdentifier='):]
-
-  raise ios_errors.BundleError('Failed to extract development team from %s' %
-                               output)
+  signing_info = GetSigningInfo(bundle_path)
+  if signing_info.team_identifier is None:
+    raise ios_errors.BundleError('Failed to extract development team from %s' %
+                                 signing_info.output)
+  return signing_info.team_identifier
 
 
 def CodesignBundle(bundle_path,
@@ -176,6 +307,8 @@ def CodesignBundle(bundle_path,
   """
   if identity is None:
     identity = GetCodesignIdentity(bundle_path)
+  with _signing_info_cache_lock:
+    _signing_info_cache.pop(os.path.realpath(bundle_path), None)
   try:
     if entitlements_plist_path is None:
       subprocess.check_call(
@@ -218,15 +351,219 @@ def EnableUIFileSharing(bundle_path, resigning=True):
 
 def GetFileArchTypes(file_path):
   """Gets the architecture types of the file."""
-  output = subprocess.check_output(['/usr/bin/lipo', file_path,
-                                    '-archs']).decode('utf-8').strip()
-  return output.split(' ')
+  return macho.GetArchTypes(file_path)
 
 
 def RemoveArchType(file_path, arch_type):
   """Remove the given architecture types for the file."""
-  subprocess.check_call(
-      ['/usr/bin/lipo', file_path, '-remove', arch_type, '-output', file_path])
+  macho.RemoveArchType(file_path, arch_type)
+
+
+def Fingerprint(bundle_path, max_workers=_FINGERPRINT_MAX_WORKERS):
+  """Gets the content fingerprint of the bundle.
+
+  The files are hashed in parallel. The digest of a directory is the hash of
+  the names, types, permission bits and digests of its entries, so the
+  fingerprint is the Merkle root of the bundle. The symlinks are hashed by
+  their targets and are not followed.
+
+  The file digests are memoized on disk per bundle, by the inode, size and
+  mtime of the file, so fingerprinting an unchanged bundle only walks the file
+  stats.
+
+  Args:
+    bundle_path: string, the path of the bundle directory or a file.
+    max_workers: int, the max number of the files hashed at once.
+
+  Returns:
+    string, the hex digest of the fingerprint.
+  """
+  bundle_path = os.path.realpath(bundle_path)
+  if not os.path.isdir(bundle_path):
+    return _GetFileDigests(bundle_path,
+                           [(bundle_path, os.stat(bundle_path))],
+                           max_workers)[bundle_path]
+  dir_entries = {}
+  files = []
+  for dir_path, dir_names, file_names in os.walk(bundle_path):
+    entries = []
+    for name in dir_names + file_names:
+      path = os.path.join(dir_path, name)
+      file_stat = os.lstat(path)
+      if stat.S_ISLNK(file_stat.st_mode):
+        entries.append((name, 'L', file_stat))
+      elif stat.S_ISDIR(file_stat.st_mode):
+        entries.append((name, 'D', file_stat))
+      else:
+        entries.append((name, 'F', file_stat))
+        files.append((path, file_stat))
+    dir_entries[dir_path] = sorted(entries)
+  digests = _GetFileDigests(bundle_path, files, max_workers)
+  # The subdirectories are hashed before their parents.
+  for dir_path in sorted(dir_entries, key=len, reverse=True):
+    hasher = hashlib.sha256()
+    for name, kind, file_stat in dir_entries[dir_path]:
+      path = os.path.join(dir_path, name)
+      if kind == 'L':
+        digest = hashlib.sha256(os.fsencode(os.readlink(path))).hexdigest()
+      else:
+        digest = digests[path]
+      hasher.update(b'%s\0%s%o\0%s\n' % (
+          os.fsencode(name), kind.encode('utf-8'),
+          stat.S_IMODE(file_stat.st_mode), digest.encode('utf-8')))
+    digests[dir_path] = hasher.hexdigest()
+  return digests[bundle_path]
+
+
+def _GetFileDigests(bundle_path, files, max_workers):
+  """Gets the sha256 digests of the files, from the on-disk memo if possible.
+
+  Args:
+    bundle_path: string, the real path of the bundle which has the files.
+    files: a list of (path, os.stat_result) of the files.
+    max_workers: int, the max number of the files hashed at once.
+
+  Returns:
+    a dict of the file path to the hex digest.
+  """
+  shard_path = _GetFileDigestsShardPath(bundle_path)
+  memo = _LoadFileDigests(shard_path)
+  digests = {}
+  missing_files = []
+  for path, file_stat in files:
+    entry = memo.get(_GetFileDigestKey(file_stat))
+    if entry and entry[:2] == [file_stat.st_size, file_stat.st_mtime_ns]:
+      digests[path] = entry[2]
+    else:
+      missing_files.append((path, file_stat))
+  if not missing_files:
+    _TouchFileDigests(shard_path)
+    return digests
+  with concurrent.futures.ThreadPoolExecutor(max_workers) as executor:
+    # The largest files go first to balance the workers.
+    missing_files.sort(key=lambda f: f[1].st_size, reverse=True)
+    for (path, _), digest in zip(
+        missing_files,
+        executor.map(_HashFile, [path for path, _ in missing_files])):
+      digests[path] = digest
+  # The shard only keeps the current files of the bundle.
+  _SaveFileDigests(shard_path, {
+      _GetFileDigestKey(file_stat):
+      [file_stat.st_size, file_stat.st_mtime_ns, digests[path]]
+      for path, file_stat in files
+  })
+  return digests
+
+
+def _GetFileDigestKey(file_stat):
+  return '%d:%d' % (file_stat.st_dev, file_stat.st_ino)
+
+
+def _HashFile(file_path):
+  """Gets the sha256 hex digest of the content of the file."""
+  hasher = hashlib.sha256()
+  with open(file_path, 'rb') as f:
+    for chunk in iter(lambda: f.read(_HASH_CHUNK_SIZE), b''):
+      hasher.update(chunk)
+  return hasher.hexdigest()
+
+
+def _GetFileDigestsShardPath(bundle_path):
+  """Gets the path of the memo shard of the file digests of the bundle."""
+  return os.path.join(
+      cache_util.GetCacheDir(_FILE_DIGESTS_CACHE_NAME),
+      '%s.json' % hashlib.sha256(os.fsencode(bundle_path)).hexdigest()[:32])
+
+
+def _LoadFileDigests(shard_path):
+  """Loads the memo shard of the file digests. Returns {} if unavailable."""
+  try:
+    with open(shard_path) as digests_file:
+      return json.load(digests_file)
+  except (OSError, ValueError):
+    return {}
+
+
+def _TouchFileDigests(shard_path):
+  """Marks the memo shard as used. Its mtime is the last used time."""
+  try:
+    os.utime(shard_path)
+  except OSError:
+    pass
+
+
+def _SaveFileDigests(shard_path, memo):
+  """Saves the memo shard of the file digests.
+
+  The least recently used shards are dropped when there are too many of them.
+  """
+  temp_file_path = '%s.%d.%d.tmp' % (shard_path, os.getpid(),
+                                     threading.get_ident())
+  try:
+    with open(temp_file_path, 'w') as digests_file:
+      json.dump(memo, digests_file)
+    os.rename(temp_file_path, shard_path)
+  except OSError as e:
+    logging.warning('Failed to save the memo of the file digests: %s', e)
+    return
+  shard_dir = os.path.dirname(shard_path)
+  shards = []
+  for file_name in os.listdir(shard_dir):
+    if file_name.endswith('.json'):
+      try:
+        shards.append((os.path.getmtime(os.path.join(shard_dir, file_name)),
+                       file_name))
+      except OSError:
+        pass
+  for _, file_name in sorted(shards)[:-_FILE_DIGESTS_MAX_SHARDS]:
+    try:
+      os.remove(os.path.join(shard_dir, file_name))
+    except OSError:
+      pass
+
+
+def _ProbeSigningInfo(bundle_path):
+  """Runs codesign once to get all the signing information of the bundle."""
+  # The details are printed to stderr and the entitlements plist to stdout.
+  command = ('codesign', '-dvv', '--entitlements', ':-', bundle_path)
+  process = subprocess.Popen(command, stdout=subprocess.PIPE,
+                             stderr=subprocess.PIPE)
+  stdout, stderr = process.communicate()
+  output = stderr.decode('utf-8')
+  fields = {}
+  authorities = []
+  for line in output.split('\n'):
+    key, sep, value = line.partition('=')
+    if not sep:
+      continue
+    if key == 'Authority':
+      authorities.append(value)
+    else:
+      fields.setdefault(key, value)
+  entitlements = None
+  if stdout.strip():
+    try:
+      entitlements = plistlib.loads(stdout)
+    except (ValueError, plistlib.InvalidFileException):
+      pass
+  return SigningInfo(
+      identifier=fields.get('Identifier'),
+      authorities=authorities,
+      team_identifier=fields.get('TeamIdentifier'),
+      entitlements=entitlements,
+      output=output)
+
+
+def _GetSigningStamp(bundle_path):
+  """Gets the mtimes which change when the bundle is resigned."""
+  stamp = []
+  for path in (bundle_path,
+               os.path.join(bundle_path, '_CodeSignature/CodeResources')):
+    try:
+      stamp.append(os.stat(path).st_mtime_ns)
+    except OSError:
+      stamp.append(None)
+  return tuple(stamp)
 
 
 def _ExtractBundleFile(target_dir, bundle_extension):
@@ -256,15 +593,24 @@ def _ExtractBundleFile(target_dir, bundle_extension):
   return extracted_bundles[0]
 
 
-def _UnzipWithShell(src_file_path, des_file_path):
-  """Unzips the file in shell.
+def _ExtractZip(zip_file_path, target_dir, member_filter, extraction_cache):
+  """Extracts the members of the zip file, through the cache if given."""
+  if extraction_cache:
+    extraction_cache.ExtractZip(zip_file_path, target_dir, member_filter,
+                                variant=member_filter.__name__)
+  else:
+    zip_util.ExtractZip(zip_file_path, target_dir, member_filter)
 
-  Args:
-    src_file_path: string, full path of the file to be unzipped.
-    des_file_path: string, full path of the extracted file.
-  """
-  # Python zipfile extractall method silently removes file permission bits.
-  # See https://bugs.python.org/issue15795. As workaround for now, use shell
-  # command unzip.
-  subprocess.check_call(['unzip', '-q', '-o',
-                         src_file_path, '-d', des_file_path])
+
+def _IsAppMember(member_name):
+  """Whether the zip member is in the app bundle of the ipa."""
+  parts = member_name.split('/')
+  return len(parts) > 1 and parts[0] == 'Payload' and parts[1].endswith('.app')
+
+
+def _IsTestBundleMember(member_name):
+  """Whether the zip member is in the top level or the Payload test bundle."""
+  parts = member_name.split('/')
+  if parts[0] == 'Payload':
+    parts = parts[1:]
+  return len(parts) > 1 and parts[0].endswith('.xctest')
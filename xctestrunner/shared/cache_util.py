@@ -0,0 +1,240 @@
+# Copyright 2017 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Utility methods for the persistent caches of test runner."""
+
+import contextlib
+import fcntl
+import json
+import os
+import pwd
+import shutil
+import threading
+import time
+
+_CACHE_ROOT_ENV_VAR = 'XCTESTRUNNER_CACHE_DIR'
+_INDEX_FILE_NAME = 'index.json'
+_INDEX_LOCK_FILE_NAME = 'index.lock'
+_ENTRIES_DIR_NAME = 'entries'
+
+
+def GetCacheDir(name):
+  """Gets the directory of the named cache and creates it if it is missing.
+
+  By default, the caches are placed under ~/Library/Caches/xctestrunner. The
+  root directory can be overridden by the environment variable
+  XCTESTRUNNER_CACHE_DIR.
+
+  Args:
+    name: string, the name of the cache, e.g. simulator_pool.
+
+  Returns:
+    string, the absolute path of the cache directory.
+  """
+  cache_root_dir = os.environ.get(_CACHE_ROOT_ENV_VAR)
+  if not cache_root_dir:
+    home_dir = pwd.getpwuid(os.geteuid()).pw_dir
+    cache_root_dir = os.path.join(home_dir, 'Library/Caches/xctestrunner')
+  path = os.path.join(cache_root_dir, name)
+  if not os.path.exists(path):
+    os.makedirs(path, exist_ok=True)
+  return path
+
+
+@contextlib.contextmanager
+def FileLock(lock_file_path, shared=False):
+  """Holds an inter-process lock on the given file.
+
+  Args:
+    lock_file_path: string, the path of the lock file. It will be created if it
+      does not exist.
+    shared: bool, whether to hold a shared lock, which is only exclusive with
+      the exclusive locks of the file. By default, the lock is exclusive.
+
+  Yields:
+    None. The lock is released when leaving the context.
+  """
+  with open(lock_file_path, 'a') as lock_file:
+    fcntl.flock(lock_file.fileno(), fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+    try:
+      yield
+    finally:
+      fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+
+
+def GetDirSize(path):
+  """Gets the total size of the regular files under the directory.
+
+  Args:
+    path: string, the path of the directory.
+
+  Returns:
+    int, the total size in bytes. The symlinks are not followed.
+  """
+  total_size = 0
+  for dir_path, _, file_names in os.walk(path):
+    for file_name in file_names:
+      file_path = os.path.join(dir_path, file_name)
+      if not os.path.islink(file_path):
+        total_size += os.lstat(file_path).st_size
+  return total_size
+
+
+def SelectLruEvictions(entries, max_size_bytes):
+  """Selects the least recently used entries to keep the total size in cap.
+
+  Args:
+    entries: dict, the key of the cache entry to a dict with keys size and
+      last_used_time.
+    max_size_bytes: int, the max total size of the kept entries.
+
+  Returns:
+    a list of the keys of the entries to evict, the least recently used first.
+  """
+  total_size = sum(entry['size'] for entry in entries.values())
+  evicted_keys = []
+  for key in sorted(entries, key=lambda k: entries[k]['last_used_time']):
+    if total_size <= max_size_bytes:
+      break
+    total_size -= entries[key]['size']
+    evicted_keys.append(key)
+  return evicted_keys
+
+
+class EntryCache(object):
+  """The entry directories of a cache keyed by string, with an LRU index.
+
+  The index file records the size and the last used time of every entry, and
+  is guarded by a file lock, so the runner processes on the host share the
+  cache. An entry is built in a staging directory and renamed into place under
+  the lock, so it is never seen half written. The least recently used entries
+  are evicted when the total size exceeds the cap.
+
+  The layout under the cache directory is:
+    entries/<key>/  the entry directories.
+    index.json      the index of the entries.
+    index.lock      the lock of the index.
+  """
+
+  def __init__(self, cache_dir, max_size_bytes):
+    """Initializes the EntryCache object.
+
+    Args:
+      cache_dir: string, the directory of the cache.
+      max_size_bytes: int, the max total size of the entries.
+    """
+    self._max_size_bytes = max_size_bytes
+    self._entries_dir = os.path.join(cache_dir, _ENTRIES_DIR_NAME)
+    if not os.path.exists(self._entries_dir):
+      os.makedirs(self._entries_dir, exist_ok=True)
+    self._index_file_path = os.path.join(cache_dir, _INDEX_FILE_NAME)
+    self._lock_file_path = os.path.join(cache_dir, _INDEX_LOCK_FILE_NAME)
+
+  def GetEntryDir(self, key):
+    """Gets the directory of the entry of the key."""
+    return os.path.join(self._entries_dir, key)
+
+  def Use(self, key):
+    """Marks the entry of the key as used now.
+
+    Args:
+      key: string, the key of the entry.
+
+    Returns:
+      the dict of the index record of the entry, or None on cache miss.
+    """
+    with FileLock(self._lock_file_path):
+      index = self._LoadIndex()
+      record = index.get(key)
+      if record is None:
+        return None
+      record['last_used_time'] = time.time()
+      self._SaveIndex(index)
+    return record
+
+  def GetStagingDir(self, key):
+    """Gets the path of the staging directory to build the entry of the key.
+
+    The path is private to the calling thread and does not exist. The staging
+    directory should be passed to Commit, or removed by the caller on failure.
+    """
+    staging_dir = '%s.%d.%d.tmp' % (self.GetEntryDir(key), os.getpid(),
+                                    threading.get_ident())
+    shutil.rmtree(staging_dir, ignore_errors=True)
+    return staging_dir
+
+  def Commit(self, key, staging_dir, record=None, is_stale=None):
+    """Renames the staging directory into place as the entry of the key.
+
+    If the key is already in the cache, the staging directory is removed
+    instead. The new entry is never evicted by its own commit.
+
+    Args:
+      key: string, the key of the entry.
+      staging_dir: string, the staging directory from GetStagingDir.
+      record: dict, the json serializable data stored in the index record of
+        the entry. The size and the last_used_time are added.
+      is_stale: the callable which accepts an index record and returns whether
+        to evict the entry regardless of the size.
+
+    Returns:
+      a list of (key, record) of the evicted entries.
+
+    Raises:
+      OSError: when failed to measure or rename the staging directory.
+    """
+    try:
+      size = GetDirSize(staging_dir)
+    except OSError:
+      shutil.rmtree(staging_dir, ignore_errors=True)
+      raise
+    entry_dir = self.GetEntryDir(key)
+    with FileLock(self._lock_file_path):
+      index = self._LoadIndex()
+      if key in index and os.path.exists(entry_dir):
+        shutil.rmtree(staging_dir, ignore_errors=True)
+        return []
+      shutil.rmtree(entry_dir, ignore_errors=True)
+      os.rename(staging_dir, entry_dir)
+      new_record = dict(record or {})
+      new_record['size'] = size
+      new_record['last_used_time'] = time.time()
+      index[key] = new_record
+      others = {k: r for k, r in index.items() if k != key}
+      evicted_keys = [k for k, r in others.items() if is_stale and is_stale(r)]
+      evicted_keys.extend(SelectLruEvictions(
+          {k: r for k, r in others.items() if k not in evicted_keys},
+          self._max_size_bytes - size))
+      evicted = [(k, index.pop(k)) for k in evicted_keys]
+      for evicted_key, _ in evicted:
+        shutil.rmtree(self.GetEntryDir(evicted_key), ignore_errors=True)
+      self._SaveIndex(index)
+    return evicted
+
+  def _LoadIndex(self):
+    """Loads the index of the entries. The caller should hold the lock."""
+    if not os.path.exists(self._index_file_path):
+      return {}
+    with open(self._index_file_path) as index_file:
+      try:
+        return json.load(index_file)
+      except ValueError:
+        return {}
+
+  def _SaveIndex(self, index):
+    """Saves the index of the entries. The caller should hold the lock."""
+    temp_file_path = self._index_file_path + '.tmp'
+    with open(temp_file_path, 'w') as index_file:
+      json.dump(index, index_file, indent=2, sort_keys=True)
+    os.rename(temp_file_path, self._index_file_path)
@@ -0,0 +1,123 @@
+# Copyright 2017 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""The cache of the extracted ipa and zip archives shared across sessions.
+
+The sharded tests run many sessions with the same build artifact on a host.
+The cache extracts an archive once and materializes the extracted files into
+the work directory of each session, by copy-on-write clone where the file
+system supports it.
+
+The entries are keyed by the identity of the archive file, i.e., its device,
+inode, size and modified time, which is much cheaper than hashing the content
+of a big ipa. When the total size of the entries exceeds the cap, the least
+recently used entries are evicted.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import shutil
+
+from xctestrunner.shared import cache_util
+from xctestrunner.shared import ios_errors
+from xctestrunner.shared import materialize_util
+from xctestrunner.shared import zip_util
+
+DEFAULT_MAX_SIZE_BYTES = 20 * 1024 * 1024 * 1024
+_EXTRACTION_CACHE_NAME = 'extracted_archives'
+
+
+class ExtractionCache(object):
+  """The persistent cache of the extracted archives."""
+
+  def __init__(self, max_size_bytes=DEFAULT_MAX_SIZE_BYTES, cache_dir=None):
+    """Initializes the ExtractionCache object.
+
+    Args:
+      max_size_bytes: int, the max total size of the extracted archives.
+      cache_dir: string, the directory of the cache. By default, it is under
+        the user cache directory.
+    """
+    self._entries = cache_util.EntryCache(
+        cache_dir or cache_util.GetCacheDir(_EXTRACTION_CACHE_NAME),
+        max_size_bytes)
+
+  def ExtractZip(self, zip_file_path, target_dir, member_filter=None,
+                 variant=''):
+    """Extracts the zip file to the directory through the cache.
+
+    Args:
+      zip_file_path: string, the path of the zip file.
+      target_dir: string, the empty or non-existent directory to extract the
+        files to.
+      member_filter: the callable which accepts the name of the member and
+        returns whether to extract it. See zip_util.ExtractZip.
+      variant: string, the name of the member filter. The extractions of the
+        same archive with different filters are cached separately.
+
+    Raises:
+      ios_errors.BundleError: when the zip file is invalid.
+    """
+    key = _ComputeKey(zip_file_path, variant)
+    if self._Materialize(key, target_dir):
+      return
+    staging_dir = self._entries.GetStagingDir(key)
+    try:
+      zip_util.ExtractZip(zip_file_path, staging_dir, member_filter)
+      evicted = self._entries.Commit(
+          key, staging_dir, {'archive_path': os.path.abspath(zip_file_path)})
+    except (ios_errors.BundleError, OSError):
+      shutil.rmtree(staging_dir, ignore_errors=True)
+      raise
+    for _, record in evicted:
+      logging.info('Evicted extracted %s from cache.', record['archive_path'])
+    logging.info('Stored extracted %s in cache.', zip_file_path)
+    if not self._Materialize(key, target_dir):
+      zip_util.ExtractZip(zip_file_path, target_dir, member_filter)
+
+  def _Materialize(self, key, target_dir):
+    """Materializes the cached extraction. Returns False on cache miss."""
+    record = self._entries.Use(key)
+    if record is None:
+      return False
+    if os.path.exists(target_dir):
+      shutil.rmtree(target_dir)
+    try:
+      # The extracted bundles are modified later, e.g., resigned, so they are
+      # never hardlinked to the entry.
+      materialize_util.MaterializeTree(
+          self._entries.GetEntryDir(key), target_dir, symlinks=True)
+    except OSError as e:
+      # The entry may be evicted by another process during copying.
+      logging.warning('Failed to materialize extracted %s: %s',
+                      record['archive_path'], e)
+      shutil.rmtree(target_dir, ignore_errors=True)
+      return False
+    logging.info('Materialized extracted %s from cache.',
+                 record['archive_path'])
+    return True
+
+
+def _ComputeKey(zip_file_path, variant):
+  """Computes the cache key from the identity of the archive file."""
+  file_stat = os.stat(zip_file_path)
+  return hashlib.sha256(json.dumps({
+      'device': file_stat.st_dev,
+      'inode': file_stat.st_ino,
+      'size': file_stat.st_size,
+      'mtime_ns': file_stat.st_mtime_ns,
+      'variant': variant,
+  }, sort_keys=True).encode('utf-8')).hexdigest()
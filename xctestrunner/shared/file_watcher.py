@@ -0,0 +1,286 @@
+# Copyright 2017 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Helper class for waiting on the change of a file.
+
+The watcher uses inotify on Linux, kqueue on MacOS and polling with adaptive
+backoff on other platforms or when the kernel facility is not available. Both
+in-place writes and atomic replacement (write to temp file, then rename) of the
+watched file are detected.
+"""
+
+import ctypes
+import ctypes.util
+import errno
+import logging
+import os
+import select
+import struct
+import sys
+import time
+
+_POLL_MIN_INTERVAL_SEC = 0.02
+_POLL_MAX_INTERVAL_SEC = 0.5
+
+# inotify constants from <sys/inotify.h>.
+_IN_MODIFY = 0x00000002
+_IN_ATTRIB = 0x00000004
+_IN_CLOSE_WRITE = 0x00000008
+_IN_MOVED_TO = 0x00000080
+_IN_CREATE = 0x00000100
+_IN_DELETE = 0x00000200
+_IN_NONBLOCK = 0o4000
+_IN_CLOEXEC = 0o2000000
+_INOTIFY_EVENT_HEADER = struct.Struct('iIII')
+_INOTIFY_READ_SIZE = 64 * 1024
+
+_libc = None
+
+
+class FileWatcher(object):
+  """Waits for the change of a file.
+
+  Usage:
+    with FileWatcher(path) as watcher:
+      while not IsReady():
+        if not watcher.Wait(remaining_sec):
+          break
+
+  The watcher is armed when entering the context, so any change happening
+  between checking the file and calling Wait is not lost.
+  """
+
+  def __init__(self, file_path):
+    """Initializes the FileWatcher object.
+
+    Args:
+      file_path: string, the path of the file to watch. Its parent directory
+        should exist. The file itself may not exist yet.
+    """
+    self._file_path = os.path.abspath(file_path)
+    self._backend = None
+
+  def __enter__(self):
+    self._backend = _CreateBackend(self._file_path)
+    return self
+
+  def __exit__(self, unused_type, unused_value, unused_traceback):
+    self.Close()
+
+  @property
+  def backend_name(self):
+    """Gets the name of the backend which is in use."""
+    return self._backend.name if self._backend else None
+
+  def Wait(self, timeout_sec):
+    """Waits until the file is changed or the timeout is reached.
+
+    The wakeup may be spurious, e.g., the file is rewritten with the same
+    content. The caller should check the file content after waking up.
+
+    Args:
+      timeout_sec: float, the max seconds to wait.
+
+    Returns:
+      True if the file may have changed, False if the timeout is reached.
+    """
+    if self._backend is None:
+      self._backend = _CreateBackend(self._file_path)
+    return self._backend.Wait(max(timeout_sec, 0))
+
+  def Close(self):
+    """Releases the kernel resources of the watcher."""
+    if self._backend:
+      self._backend.Close()
+      self._backend = None
+
+
+def _CreateBackend(file_path):
+  """Creates the best available watcher backend for the file."""
+  parent_dir = os.path.dirname(file_path)
+  if os.path.isdir(parent_dir):
+    try:
+      if sys.platform.startswith('linux') and _GetLibc() is not None:
+        return _InotifyBackend(file_path)
+      if hasattr(select, 'kqueue'):
+        return _KqueueBackend(file_path)
+    except OSError as e:
+      logging.debug('Failed to watch %s by kernel notification: %s. Will '
+                    'poll it instead.', file_path, e)
+  return _PollingBackend(file_path)
+
+
+def _GetLibc():
+  """Gets the libc with inotify functions or None if it is not available."""
+  global _libc
+  if _libc is None:
+    try:
+      libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+      libc.inotify_init1  # pylint: disable=pointless-statement
+      libc.inotify_add_watch  # pylint: disable=pointless-statement
+    except (OSError, AttributeError):
+      _libc = False
+    else:
+      _libc = libc
+  return _libc or None
+
+
+class _InotifyBackend(object):
+  """Watches the file by inotify on its parent directory."""
+
+  name = 'inotify'
+
+  def __init__(self, file_path):
+    libc = _GetLibc()
+    self._file_name = os.path.basename(file_path).encode('utf-8')
+    self._fd = libc.inotify_init1(_IN_NONBLOCK | _IN_CLOEXEC)
+    if self._fd < 0:
+      err = ctypes.get_errno()
+      raise OSError(err, os.strerror(err))
+    mask = (_IN_MODIFY | _IN_ATTRIB | _IN_CLOSE_WRITE | _IN_MOVED_TO |
+            _IN_CREATE | _IN_DELETE)
+    watch = libc.inotify_add_watch(
+        self._fd, os.path.dirname(file_path).encode('utf-8'), mask)
+    if watch < 0:
+      err = ctypes.get_errno()
+      os.close(self._fd)
+      raise OSError(err, os.strerror(err))
+
+  def Wait(self, timeout_sec):
+    deadline = time.time() + timeout_sec
+    while True:
+      readable, _, _ = select.select([self._fd], [], [],
+                                     max(deadline - time.time(), 0))
+      if not readable:
+        return False
+      if self._HasEventOfFile():
+        return True
+
+  def _HasEventOfFile(self):
+    """Reads the pending events and checks if any is about the file."""
+    try:
+      data = os.read(self._fd, _INOTIFY_READ_SIZE)
+    except OSError as e:
+      if e.errno == errno.EAGAIN:
+        return False
+      raise
+    offset = 0
+    while offset + _INOTIFY_EVENT_HEADER.size <= len(data):
+      _, _, _, name_len = _INOTIFY_EVENT_HEADER.unpack_from(data, offset)
+      name_start = offset + _INOTIFY_EVENT_HEADER.size
+      name = data[name_start:name_start + name_len].rstrip(b'\0')
+      if name == self._file_name:
+        return True
+      offset = name_start + name_len
+    return False
+
+  def Close(self):
+    os.close(self._fd)
+
+
+class _KqueueBackend(object):
+  """Watches the file and its parent directory by kqueue."""
+
+  name = 'kqueue'
+
+  def __init__(self, file_path):
+    self._file_path = file_path
+    self._kqueue = select.kqueue()
+    # Renaming a temp file onto the watched file only changes the directory.
+    self._dir_fd = os.open(os.path.dirname(file_path), _GetEventOnlyFlag())
+    self._file_fd = None
+    self._kqueue.control([_MakeVnodeKevent(self._dir_fd)], 0, 0)
+    self._ArmFileWatch()
+
+  def _ArmFileWatch(self):
+    """Watches the current inode of the file for in-place writes."""
+    if self._file_fd is not None:
+      os.close(self._file_fd)
+      self._file_fd = None
+    try:
+      self._file_fd = os.open(self._file_path, _GetEventOnlyFlag())
+    except OSError:
+      return
+    self._kqueue.control([_MakeVnodeKevent(self._file_fd)], 0, 0)
+
+  def Wait(self, timeout_sec):
+    events = self._kqueue.control(None, 8, timeout_sec)
+    if not events:
+      return False
+    # The file may have been replaced by a new inode.
+    self._ArmFileWatch()
+    return True
+
+  def Close(self):
+    if self._file_fd is not None:
+      os.close(self._file_fd)
+    os.close(self._dir_fd)
+    self._kqueue.close()
+
+
+def _GetEventOnlyFlag():
+  """Gets the open flag for a descriptor only used to watch events."""
+  # O_EVTONLY in <sys/fcntl.h> of MacOS. It does not block the unmount.
+  return getattr(os, 'O_EVTONLY', 0x8000 if sys.platform == 'darwin' else
+                 os.O_RDONLY)
+
+
+def _MakeVnodeKevent(fd):
+  """Makes the kevent to watch the changes of the vnode."""
+  return select.kevent(
+      fd,
+      filter=select.KQ_FILTER_VNODE,
+      flags=select.KQ_EV_ADD | select.KQ_EV_CLEAR,
+      fflags=(select.KQ_NOTE_WRITE | select.KQ_NOTE_EXTEND |
+              select.KQ_NOTE_ATTRIB | select.KQ_NOTE_DELETE |
+              select.KQ_NOTE_RENAME))
+
+
+class _PollingBackend(object):
+  """Watches the file by polling its stat with adaptive backoff.
+
+  The polling interval starts short and doubles on every unchanged check up to
+  the max interval. So the waiter is woken soon after a fast change while many
+  concurrent waiters on slow changes don't spin.
+  """
+
+  name = 'polling'
+
+  def __init__(self, file_path):
+    self._file_path = file_path
+    self._signature = self._GetSignature()
+
+  def _GetSignature(self):
+    try:
+      stat = os.stat(self._file_path)
+    except OSError:
+      return None
+    return stat.st_ino, stat.st_size, stat.st_mtime_ns
+
+  def Wait(self, timeout_sec):
+    deadline = time.time() + timeout_sec
+    interval = _POLL_MIN_INTERVAL_SEC
+    while True:
+      signature = self._GetSignature()
+      if signature != self._signature:
+        self._signature = signature
+        return True
+      remaining = deadline - time.time()
+      if remaining <= 0:
+        return False
+      time.sleep(min(interval, remaining))
+      interval = min(interval * 2, _POLL_MAX_INTERVAL_SEC)
+
+  def Close(self):
+    pass
@@ -84,6 +84,18 @@ Available keys for the json:
     Seconds until the xcodebuild command is deemed stuck.
   destination_timeout_sec: int
     Wait for the given seconds while searching for the destination device.
+  stream_simulator_log: bool
+    Whether streams the simulator log by `log stream` during the test. The log
+    is compressed on the fly into the SimulatorLog directory of output_dir. It
+    only works when running on sdk iphonesimulator. By default, it is false.
+  simulator_log_predicate: string
+    The predicate of `log stream` to filter the streamed simulator log.
+  simulator_log_max_size_mb: int
+    The max total size of the compressed simulator log. When it is exceeded,
+    the oldest log is dropped. By default, it is 64.
+  simulator_log_compression: string
+    The compression format of the streamed simulator log, gzip or zstd. zstd
+    requires the zstandard module. By default, it is gzip.
   """)
 
 SIGNING_OPTIONS_JSON_HELP = (
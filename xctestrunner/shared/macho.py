@@ -0,0 +1,333 @@
+# Copyright 2017 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""The reader of the Mach-O and the fat (universal) binaries.
+
+It parses the headers, the arch slices and the symbol tables of the memory
+mapped binary directly, instead of running lipo and nm. The layouts come from
+<mach-o/fat.h>, <mach-o/loader.h> and <mach-o/nlist.h>.
+"""
+
+import collections
+import mmap
+import os
+import struct
+
+from xctestrunner.shared import ios_errors
+
+_FAT_MAGIC = 0xcafebabe
+_FAT_MAGIC_64 = 0xcafebabf
+_MH_MAGIC = 0xfeedface
+_MH_MAGIC_64 = 0xfeedfacf
+_MH_CIGAM = 0xcefaedfe
+_MH_CIGAM_64 = 0xcffaedfe
+# Java class files share the magic of the fat binary, but they are told apart
+# by the arch count, which is the class file version there.
+_MAX_FAT_ARCH_COUNT = 30
+
+_LC_SYMTAB = 0x2
+_N_STAB = 0xe0
+
+_CPU_ARCH_ABI64 = 0x01000000
+_CPU_ARCH_ABI64_32 = 0x02000000
+_CPU_TYPE_X86 = 7
+_CPU_TYPE_ARM = 12
+_CPU_SUBTYPE_MASK = 0xff000000
+_FAT_ARCH_FORMAT = '>IIIII'
+_FAT_ARCH_64_FORMAT = '>IIQQII'
+_ARCH_NAMES = {
+    (_CPU_TYPE_X86, 3): 'i386',
+    (_CPU_TYPE_X86 | _CPU_ARCH_ABI64, 3): 'x86_64',
+    (_CPU_TYPE_X86 | _CPU_ARCH_ABI64, 8): 'x86_64h',
+    (_CPU_TYPE_ARM, 9): 'armv7',
+    (_CPU_TYPE_ARM, 11): 'armv7s',
+    (_CPU_TYPE_ARM, 12): 'armv7k',
+    (_CPU_TYPE_ARM | _CPU_ARCH_ABI64, 0): 'arm64',
+    (_CPU_TYPE_ARM | _CPU_ARCH_ABI64, 1): 'arm64v8',
+    (_CPU_TYPE_ARM | _CPU_ARCH_ABI64, 2): 'arm64e',
+    (_CPU_TYPE_ARM | _CPU_ARCH_ABI64_32, 1): 'arm64_32',
+}
+
+Slice = collections.namedtuple(
+    'Slice', ['arch', 'cputype', 'cpusubtype', 'offset', 'size', 'align'])
+
+
+class MachOFile(object):
+  """The memory mapped Mach-O or fat binary.
+
+  Usage:
+    with macho.MachOFile(path) as macho_file:
+      archs = macho_file.archs
+  """
+
+  def __init__(self, file_path):
+    """Opens and maps the binary.
+
+    Args:
+      file_path: string, the path of the binary.
+
+    Raises:
+      ios_errors.BundleError: when the file is not a Mach-O or fat binary.
+    """
+    self._file_path = file_path
+    with open(file_path, 'rb') as f:
+      try:
+        self._data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+      except ValueError:
+        raise ios_errors.BundleError('The file %s is empty.' % file_path)
+    try:
+      self._is_fat, self._is_fat_64, self._slices = self._ParseSlices()
+    except struct.error:
+      self.Close()
+      raise ios_errors.BundleError('The binary %s is truncated.' % file_path)
+    except ios_errors.BundleError:
+      self.Close()
+      raise
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, unused_type, unused_value, unused_traceback):
+    self.Close()
+
+  @property
+  def is_fat(self):
+    """Whether the binary is a fat binary."""
+    return self._is_fat
+
+  @property
+  def slices(self):
+    """Gets the list of the arch Slices, in the order of the file."""
+    return list(self._slices)
+
+  @property
+  def archs(self):
+    """Gets the list of the arch names of the slices, like lipo -archs."""
+    return [s.arch for s in self._slices]
+
+  def HasSymbolContaining(self, substring):
+    """Checks if any slice has a symbol whose name contains the substring.
+
+    The debugging (stab) symbols are skipped, like nm without -a. It returns
+    on the first match.
+
+    Args:
+      substring: string, the substring of the symbol name.
+
+    Returns:
+      True if any symbol name contains the substring.
+    """
+    pattern = substring.encode('utf-8')
+    for arch_slice in self._slices:
+      try:
+        if self._SliceHasSymbolContaining(arch_slice, pattern):
+          return True
+      except struct.error:
+        raise ios_errors.BundleError(
+            'The symbol table of %s in %s is truncated.' %
+            (arch_slice.arch, self._file_path))
+    return False
+
+  def WriteWithoutArch(self, output_path, arch_type):
+    """Writes the fat binary without the arch slice to the output path.
+
+    The fat header is rewritten without the slice and the other slices are
+    packed at their alignments.
+
+    Args:
+      output_path: string, the path of the new binary.
+      arch_type: string, the arch name of the slice to remove.
+
+    Raises:
+      ios_errors.BundleError: when the binary is not a fat binary or it does
+        not contain the arch.
+    """
+    if not self._is_fat:
+      raise ios_errors.BundleError(
+          'The binary %s is not a fat binary.' % self._file_path)
+    kept_slices = [s for s in self._slices if s.arch != arch_type]
+    if len(kept_slices) == len(self._slices):
+      raise ios_errors.BundleError(
+          'The binary %s does not contain the arch %s.' %
+          (self._file_path, arch_type))
+    if self._is_fat_64:
+      magic, arch_format = _FAT_MAGIC_64, _FAT_ARCH_64_FORMAT
+    else:
+      magic, arch_format = _FAT_MAGIC, _FAT_ARCH_FORMAT
+    offset = 8 + len(kept_slices) * struct.calcsize(arch_format)
+    layout = []
+    for arch_slice in kept_slices:
+      alignment = 1 << arch_slice.align
+      offset = (offset + alignment - 1) // alignment * alignment
+      layout.append((arch_slice, offset))
+      offset += arch_slice.size
+    with open(output_path, 'wb') as f:
+      f.write(struct.pack('>II', magic, len(kept_slices)))
+      for arch_slice, new_offset in layout:
+        fields = [arch_slice.cputype, arch_slice.cpusubtype, new_offset,
+                  arch_slice.size, arch_slice.align]
+        if self._is_fat_64:
+          fields.append(0)
+        f.write(struct.pack(arch_format, *fields))
+      for arch_slice, new_offset in layout:
+        f.write(b'\0' * (new_offset - f.tell()))
+        f.write(self._data[arch_slice.offset:arch_slice.offset +
+                           arch_slice.size])
+
+  def Close(self):
+    if self._data is not None:
+      self._data.close()
+      self._data = None
+
+  def _ParseSlices(self):
+    """Parses the fat header or the thin Mach-O header."""
+    magic, = struct.unpack_from('>I', self._data, 0)
+    if magic in (_FAT_MAGIC, _FAT_MAGIC_64):
+      nfat_arch, = struct.unpack_from('>I', self._data, 4)
+      if nfat_arch <= _MAX_FAT_ARCH_COUNT:
+        is_fat_64 = magic == _FAT_MAGIC_64
+        arch_format = _FAT_ARCH_64_FORMAT if is_fat_64 else _FAT_ARCH_FORMAT
+        arch_size = struct.calcsize(arch_format)
+        slices = []
+        for i in range(nfat_arch):
+          fields = struct.unpack_from(arch_format, self._data,
+                                      8 + i * arch_size)
+          cputype, cpusubtype, offset, size, align = fields[:5]
+          if offset + size > len(self._data):
+            raise ios_errors.BundleError(
+                'The slice %d of %s is out of the file.' %
+                (i, self._file_path))
+          slices.append(
+              Slice(_GetArchName(cputype, cpusubtype), cputype, cpusubtype,
+                    offset, size, align))
+        return True, is_fat_64, slices
+    endian = _GetMachOEndian(self._data, 0)
+    if endian is None:
+      raise ios_errors.BundleError(
+          'The file %s is not a Mach-O binary.' % self._file_path)
+    cputype, cpusubtype = struct.unpack_from(endian + 'II', self._data, 4)
+    return False, False, [
+        Slice(_GetArchName(cputype, cpusubtype), cputype, cpusubtype, 0,
+              len(self._data), 0)
+    ]
+
+  def _SliceHasSymbolContaining(self, arch_slice, pattern):
+    """Checks the symbol table of the Mach-O slice."""
+    base = arch_slice.offset
+    endian = _GetMachOEndian(self._data, base)
+    if endian is None:
+      return False
+    magic, = struct.unpack_from(endian + 'I', self._data, base)
+    is_64 = magic == _MH_MAGIC_64
+    ncmds, = struct.unpack_from(endian + 'I', self._data, base + 16)
+    cmd_offset = base + (32 if is_64 else 28)
+    for _ in range(ncmds):
+      cmd, cmdsize = struct.unpack_from(endian + 'II', self._data, cmd_offset)
+      if cmd == _LC_SYMTAB:
+        symoff, nsyms, stroff, strsize = struct.unpack_from(
+            endian + 'IIII', self._data, cmd_offset + 8)
+        return self._SymtabHasSymbolContaining(
+            endian, is_64, base + symoff, nsyms, base + stroff, strsize,
+            pattern)
+      if cmdsize <= 0:
+        break
+      cmd_offset += cmdsize
+    return False
+
+  def _SymtabHasSymbolContaining(self, endian, is_64, symoff, nsyms, stroff,
+                                 strsize, pattern):
+    """Checks the names of the non-stab symbols in the symbol table."""
+    strtab_end = stroff + strsize
+    # Most binaries are ruled out by one scan of the string table.
+    if self._data.find(pattern, stroff, strtab_end) < 0:
+      return False
+    nlist_format = endian + ('IBBHQ' if is_64 else 'IBBHI')
+    nlist_size = struct.calcsize(nlist_format)
+    symtab = memoryview(self._data)[symoff:symoff + nsyms * nlist_size]
+    try:
+      for n_strx, n_type, _, _, _ in struct.iter_unpack(nlist_format, symtab):
+        if n_type & _N_STAB or not n_strx:
+          continue
+        name_start = stroff + n_strx
+        name_end = self._data.find(b'\0', name_start, strtab_end)
+        if name_end < 0:
+          name_end = strtab_end
+        if self._data.find(pattern, name_start, name_end) >= 0:
+          return True
+    finally:
+      symtab.release()
+    return False
+
+
+def GetArchTypes(file_path):
+  """Gets the arch names of the binary, like lipo -archs.
+
+  Raises:
+    ios_errors.BundleError: when the file is not a Mach-O or fat binary.
+  """
+  with MachOFile(file_path) as macho_file:
+    return macho_file.archs
+
+
+def HasSymbolContaining(file_path, substring):
+  """Checks if the binary has a symbol whose name contains the substring.
+
+  Raises:
+    ios_errors.BundleError: when the file is not a Mach-O or fat binary.
+  """
+  with MachOFile(file_path) as macho_file:
+    return macho_file.HasSymbolContaining(substring)
+
+
+def RemoveArchType(file_path, arch_type):
+  """Removes the arch slice from the fat binary, like lipo -remove.
+
+  The file is replaced atomically.
+
+  Args:
+    file_path: string, the path of the fat binary.
+    arch_type: string, the arch name of the slice to remove.
+
+  Raises:
+    ios_errors.BundleError: when the file is not a fat binary or it does not
+      contain the arch.
+  """
+  temp_file_path = '%s.%d.tmp' % (file_path, os.getpid())
+  try:
+    with MachOFile(file_path) as macho_file:
+      macho_file.WriteWithoutArch(temp_file_path, arch_type)
+    os.chmod(temp_file_path, os.stat(file_path).st_mode & 0o7777)
+    os.replace(temp_file_path, file_path)
+  finally:
+    if os.path.exists(temp_file_path):
+      os.remove(temp_file_path)
+
+
+def _GetMachOEndian(data, offset):
+  """Gets the struct byte order of the Mach-O header or None if it is not."""
+  magic, = struct.unpack_from('<I', data, offset)
+  if magic in (_MH_MAGIC, _MH_MAGIC_64):
+    return '<'
+  if magic in (_MH_CIGAM, _MH_CIGAM_64):
+    return '>'
+  return None
+
+
+def _GetArchName(cputype, cpusubtype):
+  """Gets the arch name of the cpu type like lipo."""
+  cpusubtype &= ~_CPU_SUBTYPE_MASK
+  arch_name = _ARCH_NAMES.get((cputype, cpusubtype))
+  if arch_name:
+    return arch_name
+  return 'cputype (%d) cpusubtype (%d)' % (cputype, cpusubtype)
@@ -0,0 +1,226 @@
+# Copyright 2017 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for xctestrunner.shared.macho.
+
+The fixture binaries are laid out by the helpers below from <mach-o/fat.h>,
+<mach-o/loader.h> and <mach-o/nlist.h>, so the tests run on any platform.
+"""
+
+import os
+import shutil
+import struct
+import tempfile
+import unittest
+
+from xctestrunner.shared import ios_errors
+from xctestrunner.shared import macho
+
+_CPU_TYPE_X86_64 = 0x01000007
+_CPU_TYPE_ARM64 = 0x0100000c
+_CPU_SUBTYPE_X86_64_ALL = 3
+_CPU_SUBTYPE_ARM64_ALL = 0
+_CPU_SUBTYPE_ARM64_V8 = 1
+_CPU_SUBTYPE_ARM64E = 2
+_CPU_SUBTYPE_LIB64 = 0x80000000
+_MH_EXECUTE = 2
+_LC_UUID = 0x1b
+_N_SECT_EXT = 0x0f
+_N_FUN = 0x24
+
+
+def _BuildThinBinary(cputype, cpusubtype, symbols=None):
+  """Builds a 64-bit little endian Mach-O binary.
+
+  Args:
+    cputype: int, the cpu type of the header.
+    cpusubtype: int, the cpu subtype of the header.
+    symbols: a list of (name, n_type) of the symbol table. None means the
+      binary has no LC_SYMTAB.
+
+  Returns:
+    bytes, the content of the binary.
+  """
+  uuid_command = struct.pack('<II16s', _LC_UUID, 24, b'\x01' * 16)
+  commands = [uuid_command]
+  header_size = 32
+  symtab_command_size = 24
+  if symbols is not None:
+    commands_size = len(uuid_command) + symtab_command_size
+    symoff = header_size + commands_size
+    strtab = b'\0'
+    nlists = b''
+    for name, n_type in symbols:
+      nlists += struct.pack('<IBBHQ', len(strtab), n_type, 1, 0, 0x1000)
+      strtab += name.encode('utf-8') + b'\0'
+    stroff = symoff + len(nlists)
+    commands.append(struct.pack('<IIIIII', 0x2, symtab_command_size, symoff,
+                                len(symbols), stroff, len(strtab)))
+    payload = nlists + strtab
+  else:
+    payload = b'\0' * 16
+  header = struct.pack('<IIIIIIII', 0xfeedfacf, cputype, cpusubtype,
+                       _MH_EXECUTE, len(commands),
+                       sum(len(c) for c in commands), 0, 0)
+  return header + b''.join(commands) + payload
+
+
+def _BuildFatBinary(slices, is_fat_64=False, align=12):
+  """Builds a fat binary of the thin binaries.
+
+  Args:
+    slices: a list of (cputype, cpusubtype, thin binary content).
+    is_fat_64: bool, whether to use the fat_arch_64 layout.
+    align: int, the power of 2 alignment of the slices.
+
+  Returns:
+    bytes, the content of the binary.
+  """
+  if is_fat_64:
+    magic, arch_format = 0xcafebabf, '>IIQQII'
+  else:
+    magic, arch_format = 0xcafebabe, '>IIIII'
+  header = struct.pack('>II', magic, len(slices))
+  offset = len(header) + len(slices) * struct.calcsize(arch_format)
+  arch_headers = b''
+  body = b''
+  for cputype, cpusubtype, content in slices:
+    alignment = 1 << align
+    slice_offset = (offset + alignment - 1) // alignment * alignment
+    body += b'\0' * (slice_offset - offset) + content
+    fields = [cputype, cpusubtype, slice_offset, len(content), align]
+    if is_fat_64:
+      fields.append(0)
+    arch_headers += struct.pack(arch_format, *fields)
+    offset = slice_offset + len(content)
+  return header + arch_headers + body
+
+
+class MachOTest(unittest.TestCase):
+
+  def setUp(self):
+    super(MachOTest, self).setUp()
+    self._temp_dir = tempfile.mkdtemp()
+    self.addCleanup(shutil.rmtree, self._temp_dir)
+
+  def _WriteBinary(self, name, content):
+    path = os.path.join(self._temp_dir, name)
+    with open(path, 'wb') as f:
+      f.write(content)
+    return path
+
+  def testThinBinary(self):
+    path = self._WriteBinary('thin', _BuildThinBinary(
+        _CPU_TYPE_X86_64, _CPU_SUBTYPE_X86_64_ALL,
+        [('_main', _N_SECT_EXT),
+         ('_OBJC_CLASS_$_XCUIApplication', _N_SECT_EXT)]))
+    with macho.MachOFile(path) as macho_file:
+      self.assertFalse(macho_file.is_fat)
+      self.assertEqual(['x86_64'], macho_file.archs)
+      self.assertTrue(macho_file.HasSymbolContaining('XCUIApplication'))
+      self.assertFalse(macho_file.HasSymbolContaining('XCTestCase'))
+
+  def testThinBinarySkipsStabSymbols(self):
+    path = self._WriteBinary('stab', _BuildThinBinary(
+        _CPU_TYPE_ARM64, _CPU_SUBTYPE_ARM64_ALL,
+        [('_main', _N_SECT_EXT), ('XCUIApplication.swift', _N_FUN)]))
+    self.assertFalse(macho.HasSymbolContaining(path, 'XCUIApplication'))
+
+  def testBinaryWithoutSymtab(self):
+    path = self._WriteBinary('nosymtab', _BuildThinBinary(
+        _CPU_TYPE_ARM64, _CPU_SUBTYPE_ARM64_ALL))
+    self.assertEqual(['arm64'], macho.GetArchTypes(path))
+    self.assertFalse(macho.HasSymbolContaining(path, 'XCUIApplication'))
+
+  def testFatBinary(self):
+    x86_64 = _BuildThinBinary(_CPU_TYPE_X86_64, _CPU_SUBTYPE_X86_64_ALL,
+                              [('_main', _N_SECT_EXT)])
+    arm64 = _BuildThinBinary(
+        _CPU_TYPE_ARM64, _CPU_SUBTYPE_ARM64_ALL,
+        [('_main', _N_SECT_EXT),
+         ('_OBJC_CLASS_$_XCUIApplication', _N_SECT_EXT)])
+    path = self._WriteBinary('fat', _BuildFatBinary([
+        (_CPU_TYPE_X86_64, _CPU_SUBTYPE_X86_64_ALL, x86_64),
+        (_CPU_TYPE_ARM64, _CPU_SUBTYPE_ARM64_ALL, arm64)]))
+    with macho.MachOFile(path) as macho_file:
+      self.assertTrue(macho_file.is_fat)
+      self.assertEqual(['x86_64', 'arm64'], macho_file.archs)
+      self.assertEqual([4096, 8192],
+                       [s.offset for s in macho_file.slices])
+      # The symbol is only in the second slice.
+      self.assertTrue(macho_file.HasSymbolContaining('XCUIApplication'))
+
+    macho.RemoveArchType(path, 'x86_64')
+    with macho.MachOFile(path) as macho_file:
+      self.assertTrue(macho_file.is_fat)
+      self.assertEqual(['arm64'], macho_file.archs)
+      self.assertEqual(4096, macho_file.slices[0].offset)
+      self.assertTrue(macho_file.HasSymbolContaining('XCUIApplication'))
+
+  def testFat64Binary(self):
+    x86_64 = _BuildThinBinary(_CPU_TYPE_X86_64, _CPU_SUBTYPE_X86_64_ALL,
+                              [('_OBJC_CLASS_$_XCTestCase', _N_SECT_EXT)])
+    arm64e = _BuildThinBinary(_CPU_TYPE_ARM64, _CPU_SUBTYPE_ARM64E,
+                              [('_main', _N_SECT_EXT)])
+    path = self._WriteBinary('fat64', _BuildFatBinary(
+        [(_CPU_TYPE_X86_64, _CPU_SUBTYPE_X86_64_ALL, x86_64),
+         (_CPU_TYPE_ARM64, _CPU_SUBTYPE_ARM64E | _CPU_SUBTYPE_LIB64, arm64e)],
+        is_fat_64=True))
+    self.assertEqual(['x86_64', 'arm64e'], macho.GetArchTypes(path))
+    self.assertTrue(macho.HasSymbolContaining(path, 'XCTestCase'))
+    self.assertFalse(macho.HasSymbolContaining(path, 'XCUIApplication'))
+
+    macho.RemoveArchType(path, 'arm64e')
+    with open(path, 'rb') as f:
+      self.assertEqual(0xcafebabf, struct.unpack('>I', f.read(4))[0])
+    self.assertEqual(['x86_64'], macho.GetArchTypes(path))
+    self.assertTrue(macho.HasSymbolContaining(path, 'XCTestCase'))
+
+  def testArchNames(self):
+    for cpusubtype, arch in ((_CPU_SUBTYPE_ARM64_ALL, 'arm64'),
+                             (_CPU_SUBTYPE_ARM64_V8, 'arm64v8'),
+                             (_CPU_SUBTYPE_ARM64E, 'arm64e')):
+      path = self._WriteBinary(
+          arch, _BuildThinBinary(_CPU_TYPE_ARM64, cpusubtype))
+      self.assertEqual([arch], macho.GetArchTypes(path))
+
+  def testRemoveArchTypeFromThinBinary(self):
+    path = self._WriteBinary('thin', _BuildThinBinary(
+        _CPU_TYPE_ARM64, _CPU_SUBTYPE_ARM64_ALL))
+    with self.assertRaises(ios_errors.BundleError):
+      macho.RemoveArchType(path, 'arm64')
+
+  def testRemoveMissingArchType(self):
+    arm64 = _BuildThinBinary(_CPU_TYPE_ARM64, _CPU_SUBTYPE_ARM64_ALL)
+    path = self._WriteBinary('fat', _BuildFatBinary([
+        (_CPU_TYPE_ARM64, _CPU_SUBTYPE_ARM64_ALL, arm64)]))
+    with self.assertRaises(ios_errors.BundleError):
+      macho.RemoveArchType(path, 'x86_64')
+
+  def testNotMachOBinary(self):
+    path = self._WriteBinary('text', b'#!/bin/sh\necho hello\n')
+    with self.assertRaises(ios_errors.BundleError):
+      macho.GetArchTypes(path)
+
+  def testTruncatedFatBinary(self):
+    arm64 = _BuildThinBinary(_CPU_TYPE_ARM64, _CPU_SUBTYPE_ARM64_ALL)
+    content = _BuildFatBinary([
+        (_CPU_TYPE_ARM64, _CPU_SUBTYPE_ARM64_ALL, arm64)])
+    path = self._WriteBinary('truncated', content[:-8])
+    with self.assertRaises(ios_errors.BundleError):
+      macho.GetArchTypes(path)
+
+
+if __name__ == '__main__':
+  unittest.main()
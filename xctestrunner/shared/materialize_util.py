@@ -0,0 +1,260 @@
+# Copyright 2017 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Utility methods for materializing files and directories cheaply.
+
+The bundles and frameworks are copied a lot when preparing the test. Instead of
+copying bytes, the methods try the fastest available way first, per file:
+  1) clonefile on MacOS or FICLONE on Linux, which shares the data blocks
+     copy-on-write;
+  2) hardlink, only if the caller promises not to modify the files;
+  3) copy_file_range on Linux, which copies in kernel and may share blocks;
+  4) plain copy.
+"""
+
+import ctypes
+import ctypes.util
+import errno
+import fcntl
+import logging
+import os
+import shutil
+import sys
+
+# From <linux/fs.h>.
+_FICLONE = 0x40049409
+# From <sys/clonefile.h> of MacOS.
+_CLONE_NOFOLLOW = 0x0001
+_COPY_CHUNK_SIZE = 64 * 1024 * 1024
+_UNSUPPORTED_ERRNOS = (errno.EXDEV, errno.EOPNOTSUPP, errno.ENOTSUP,
+                       errno.EINVAL, errno.ENOSYS, errno.ENOTTY, errno.EPERM)
+
+_libc = None
+# The (source device, target device, method) which is known to be unsupported.
+_unsupported_methods = set()
+
+
+class Method(object):
+  """The methods to materialize a file."""
+  CLONE = 'clone'
+  COPY_FILE_RANGE = 'copy_file_range'
+  HARDLINK = 'hardlink'
+  COPY = 'copy'
+
+
+class MaterializeStats(object):
+  """The number of files and bytes materialized by each method."""
+
+  def __init__(self):
+    self.file_counts = dict.fromkeys(
+        (Method.CLONE, Method.COPY_FILE_RANGE, Method.HARDLINK, Method.COPY), 0)
+    self.byte_counts = dict.fromkeys(self.file_counts, 0)
+
+  @property
+  def bytes_cloned(self):
+    """Gets the bytes shared with the source instead of being copied."""
+    return (self.byte_counts[Method.CLONE] +
+            self.byte_counts[Method.HARDLINK])
+
+  @property
+  def bytes_copied(self):
+    """Gets the bytes copied to new data blocks, possibly in kernel."""
+    return (self.byte_counts[Method.COPY_FILE_RANGE] +
+            self.byte_counts[Method.COPY])
+
+  def Add(self, method, size, file_count=1):
+    self.file_counts[method] += file_count
+    self.byte_counts[method] += size
+
+  def __str__(self):
+    return '%d bytes cloned, %d bytes copied (%s)' % (
+        self.bytes_cloned, self.bytes_copied, ', '.join(
+            '%s: %d files' % (method, count)
+            for method, count in sorted(self.file_counts.items()) if count))
+
+
+def MaterializeTree(src_dir, dst_dir, symlinks=False, allow_hardlink=False,
+                    stats=None):
+  """Materializes the directory like shutil.copytree.
+
+  Args:
+    src_dir: string, the path of the source directory.
+    dst_dir: string, the path of the target directory. It should not exist.
+    symlinks: bool, whether the symlinks in the source directory are copied as
+      symlinks. Otherwise the content of the linked files are materialized.
+    allow_hardlink: bool, whether the files can be hardlinked. Only set it if
+      neither the source files nor the target files will be modified in place.
+    stats: MaterializeStats, the stats to add to. By default, a new one is
+      created.
+
+  Returns:
+    the MaterializeStats object.
+  """
+  if stats is None:
+    stats = MaterializeStats()
+  src_dir = os.path.realpath(src_dir)
+  # APFS clones the whole hierarchy in one call, but it keeps the symlinks.
+  if symlinks and sys.platform == 'darwin' and _Clonefile(src_dir, dst_dir):
+    file_count, size = _CountFiles(dst_dir)
+    stats.Add(Method.CLONE, size, file_count)
+  else:
+    _MaterializeTree(src_dir, dst_dir, symlinks, allow_hardlink, stats)
+  logging.info('Materialized %s to %s: %s', src_dir, dst_dir, stats)
+  return stats
+
+
+def _MaterializeTree(src_dir, dst_dir, symlinks, allow_hardlink, stats):
+  """Materializes the directory file by file."""
+  os.makedirs(dst_dir)
+  for name in os.listdir(src_dir):
+    src_path = os.path.join(src_dir, name)
+    dst_path = os.path.join(dst_dir, name)
+    if symlinks and os.path.islink(src_path):
+      os.symlink(os.readlink(src_path), dst_path)
+    elif os.path.isdir(src_path):
+      _MaterializeTree(os.path.realpath(src_path), dst_path, symlinks,
+                       allow_hardlink, stats)
+    else:
+      MaterializeFile(src_path, dst_path, allow_hardlink, stats)
+  shutil.copystat(src_dir, dst_dir)
+
+
+def MaterializeFile(src_file, dst_file, allow_hardlink=False, stats=None):
+  """Materializes the content of the file like shutil.copy2.
+
+  Args:
+    src_file: string, the path of the source file.
+    dst_file: string, the path of the target file. It should not exist.
+    allow_hardlink: bool, whether the file can be hardlinked. Only set it if
+      neither the source file nor the target file will be modified in place.
+    stats: MaterializeStats, the stats to add to.
+
+  Returns:
+    the Method which materialized the file.
+  """
+  src_file = os.path.realpath(src_file)
+  size = os.path.getsize(src_file)
+  method = _MaterializeFile(src_file, dst_file, allow_hardlink)
+  if stats is not None:
+    stats.Add(method, size)
+  return method
+
+
+def _MaterializeFile(src_file, dst_file, allow_hardlink):
+  """Materializes the file by the fastest method and returns the method."""
+  is_linux = sys.platform.startswith('linux')
+  if is_linux:
+    devices = (os.stat(src_file).st_dev,
+               os.stat(os.path.dirname(os.path.abspath(dst_file))).st_dev)
+    if _TryByFd(src_file, dst_file, devices, Method.CLONE, _Ficlone):
+      return Method.CLONE
+  elif sys.platform == 'darwin' and _Clonefile(src_file, dst_file):
+    return Method.CLONE
+  # Unless the file system reflinks the file, copy_file_range still copies the
+  # data blocks, so the hardlink is preferred when it is allowed.
+  if allow_hardlink:
+    try:
+      os.link(src_file, dst_file)
+      return Method.HARDLINK
+    except OSError:
+      pass
+  if (is_linux and hasattr(os, 'copy_file_range') and
+      _TryByFd(src_file, dst_file, devices, Method.COPY_FILE_RANGE,
+               _CopyFileRange)):
+    return Method.COPY_FILE_RANGE
+  shutil.copy2(src_file, dst_file)
+  return Method.COPY
+
+
+def _TryByFd(src_file, dst_file, devices, method, copy_fn):
+  """Materializes the file with the function of the file descriptors.
+
+  Returns:
+    True if the file is materialized. False if the method is not supported,
+    then the target file does not exist.
+  """
+  if devices + (method,) in _unsupported_methods:
+    return False
+  try:
+    with open(src_file, 'rb') as src, open(dst_file, 'wb') as dst:
+      copy_fn(src.fileno(), dst.fileno(), os.fstat(src.fileno()).st_size)
+  except OSError as e:
+    if os.path.exists(dst_file):
+      os.remove(dst_file)
+    if e.errno in _UNSUPPORTED_ERRNOS:
+      _unsupported_methods.add(devices + (method,))
+      return False
+    raise
+  shutil.copystat(src_file, dst_file)
+  return True
+
+
+def _Ficlone(src_fd, dst_fd, unused_size):
+  fcntl.ioctl(dst_fd, _FICLONE, src_fd)
+
+
+def _CopyFileRange(src_fd, dst_fd, size):
+  remaining = size
+  while remaining > 0:
+    copied = os.copy_file_range(src_fd, dst_fd, min(remaining,
+                                                    _COPY_CHUNK_SIZE))
+    if copied == 0:
+      break
+    remaining -= copied
+
+
+def _Clonefile(src_path, dst_path):
+  """Clones the file or directory by clonefile of MacOS.
+
+  Returns:
+    True if it is cloned.
+  """
+  libc = _GetLibc()
+  if libc is None:
+    return False
+  result = libc.clonefile(
+      os.fsencode(src_path), os.fsencode(dst_path), _CLONE_NOFOLLOW)
+  if result != 0:
+    logging.debug('Failed to clone %s: %s', src_path,
+                  os.strerror(ctypes.get_errno()))
+    return False
+  return True
+
+
+def _GetLibc():
+  """Gets the libc with clonefile function or None if it is not available."""
+  global _libc
+  if _libc is None:
+    try:
+      libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+      libc.clonefile.argtypes = [ctypes.c_char_p, ctypes.c_char_p,
+                                 ctypes.c_uint32]
+    except (OSError, AttributeError):
+      _libc = False
+    else:
+      _libc = libc
+  return _libc or None
+
+
+def _CountFiles(path):
+  """Gets the number and the total size of the regular files in directory."""
+  file_count = 0
+  size = 0
+  for dir_path, _, file_names in os.walk(path):
+    for file_name in file_names:
+      file_path = os.path.join(dir_path, file_name)
+      if not os.path.islink(file_path):
+        file_count += 1
+        size += os.path.getsize(file_path)
+  return file_count, size
@@ -14,11 +14,17 @@
 
 """Utility class for managing Plist files."""
 
+import collections
+import copy
 import os
 import plistlib
+import shutil
+import threading
 
 from xctestrunner.shared import ios_errors
 
+_PARSE_CACHE_MAX_ENTRIES = 256
+
 
 class Plist(object):
   """Handles the .plist file operations."""
@@ -48,9 +54,9 @@ class Plist(object):
     Raises:
       ios_errors.PlistError: the field does not exist in the plist dict.
     """
-    with open(self._plist_file_path, 'rb') as plist_file:
-      plist_root_object = plistlib.load(plist_file)
-    return _GetObjectWithField(plist_root_object, field)
+    plist_root_object = _parse_cache.Load(self._plist_file_path)
+    # The cached object is shared, so the caller gets its own copy to modify.
+    return copy.deepcopy(_GetObjectWithField(plist_root_object, field))
 
   def HasPlistField(self, field):
     """Checks whether a specific field is in the .plist file.
@@ -87,31 +93,11 @@ class Plist(object):
       ios_errors.PlistError: the field does not exist in the .plist file's dict.
     """
     if not field:
-      with open(self._plist_file_path, 'wb') as plist_file:
-        plistlib.dump(value, plist_file)
+      _WritePlistFile(self._plist_file_path, value)
       return
-
-    if os.path.exists(self._plist_file_path):
-      with open(self._plist_file_path, 'rb') as plist_file:
-        plist_root_object = plistlib.load(plist_file)
-    else:
-      plist_root_object = {}
-    keys_in_field = field.rsplit(':', 1)
-    if len(keys_in_field) == 1:
-      key = field
-      target_object = plist_root_object
-    else:
-      key = keys_in_field[1]
-      target_object = _GetObjectWithField(plist_root_object, keys_in_field[0])
-    try:
-      target_object[_ParseKey(target_object, key)] = value
-    except ios_errors.PlistError as e:
-      raise e
-    except (KeyError, IndexError):
-      raise ios_errors.PlistError('Failed to set key %s from object %s.'
-                                  % (key, target_object))
-    with open(self._plist_file_path, 'wb') as plist_file:
-      plistlib.dump(plist_root_object, plist_file)
+    document = PlistDocument(self._plist_file_path)
+    document.SetPlistField(field, value)
+    document.Flush()
 
   def DeletePlistField(self, field):
     """Delete field in .plist file.
@@ -126,26 +112,211 @@ class Plist(object):
     Raises:
       ios_errors.PlistError: the field does not exist in the .plist file's dict.
     """
-    with open(self._plist_file_path, 'rb') as plist_file:
-      plist_root_object = plistlib.load(plist_file)
-    keys_in_field = field.rsplit(':', 1)
-    if len(keys_in_field) == 1:
-      key = field
-      target_object = plist_root_object
+    if not os.path.exists(self._plist_file_path):
+      raise ios_errors.PlistError('The plist file %s does not exist.' %
+                                  self._plist_file_path)
+    document = PlistDocument(self._plist_file_path)
+    document.DeletePlistField(field)
+    document.Flush()
+
+
+class PlistDocument(object):
+  """The in-memory document of a .plist file.
+
+  The file is parsed once when the document is created. The Get, Set and
+  Delete operations are applied to the in-memory object and the file is written
+  once by Flush, atomically via a temp file and rename. E.g.,
+
+    with plist_util.PlistDocument(path) as document:
+      document.SetPlistField('Key1', 'value1')
+      document.DeletePlistField('Key2')
+
+  The fields have the same format as the fields of Plist.
+  """
+
+  def __init__(self, plist_file_path):
+    """Initializes the PlistDocument object.
+
+    Args:
+      plist_file_path: string, the path of the .plist file. If the file does not
+        exist, the document starts with an empty dict.
+    """
+    self._plist_file_path = plist_file_path
+    if os.path.exists(plist_file_path):
+      with open(plist_file_path, 'rb') as plist_file:
+        self._plist_root_object = plistlib.load(plist_file)
     else:
-      key = keys_in_field[1]
-      target_object = _GetObjectWithField(plist_root_object, keys_in_field[0])
+      self._plist_root_object = {}
+    self._dirty = False
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exc_type, unused_value, unused_traceback):
+    if exc_type is None:
+      self.Flush()
+
+  @property
+  def dirty(self):
+    """Whether the document has changes which are not written to the file."""
+    return self._dirty
+
+  def GetPlistField(self, field):
+    """Gets a copy of the specific field in the document.
+
+    Raises:
+      ios_errors.PlistError: the field does not exist in the plist dict.
+    """
+    return copy.deepcopy(_GetObjectWithField(self._plist_root_object, field))
 
+  def HasPlistField(self, field):
+    """Checks whether a specific field is in the document."""
+    try:
+      _GetObjectWithField(self._plist_root_object, field)
+    except ios_errors.PlistError:
+      return False
+    return True
+
+  def SetPlistField(self, field, value):
+    """Sets field with provided value in the document.
+
+    Raises:
+      ios_errors.PlistError: the parent of the field does not exist in the
+        document.
+    """
+    if not field:
+      self._plist_root_object = value
+    else:
+      target_object, key = self._GetParentObjectAndKey(field)
+      try:
+        target_object[_ParseKey(target_object, key)] = value
+      except (KeyError, IndexError):
+        raise ios_errors.PlistError('Failed to set key %s from object %s.'
+                                    % (key, target_object))
+    self._dirty = True
+
+  def DeletePlistField(self, field):
+    """Deletes field in the document.
+
+    Raises:
+      ios_errors.PlistError: the field does not exist in the document.
+    """
+    target_object, key = self._GetParentObjectAndKey(field)
     try:
       del target_object[_ParseKey(target_object, key)]
-    except ios_errors.PlistError as e:
-      raise e
     except (KeyError, IndexError):
       raise ios_errors.PlistError('Failed to delete key %s from object %s.'
                                   % (key, target_object))
+    self._dirty = True
+
+  def Flush(self):
+    """Writes the document to the file if it has changes."""
+    if not self._dirty:
+      return
+    _WritePlistFile(self._plist_file_path, self._plist_root_object)
+    self._dirty = False
+
+  def _GetParentObjectAndKey(self, field):
+    """Gets the parent object of the field and the last key of the field."""
+    keys_in_field = field.rsplit(':', 1)
+    if len(keys_in_field) == 1:
+      return self._plist_root_object, field
+    return (_GetObjectWithField(self._plist_root_object, keys_in_field[0]),
+            keys_in_field[1])
+
+
+def _WritePlistFile(plist_file_path, plist_root_object):
+  """Writes the plist file atomically and invalidates its parse cache."""
+  temp_file_path = '%s.%d.tmp' % (plist_file_path, os.getpid())
+  with open(temp_file_path, 'wb') as plist_file:
+    plistlib.dump(plist_root_object, plist_file)
+  if os.path.exists(plist_file_path):
+    shutil.copymode(plist_file_path, temp_file_path)
+  os.replace(temp_file_path, plist_file_path)
+  _parse_cache.Invalidate(plist_file_path)
+
+
+class _PlistParseCache(object):
+  """The cache of parsed plist files validated by the files' stat.
+
+  An entry is reused only when the file's (mtime_ns, size, inode) is unchanged,
+  so a rewritten or replaced file is always parsed again.
+  """
+
+  def __init__(self, max_entries=_PARSE_CACHE_MAX_ENTRIES):
+    self._max_entries = max_entries
+    self._entries = collections.OrderedDict()
+    self._lock = threading.Lock()
+    self.hits = 0
+    self.misses = 0
+
+  def Load(self, plist_file_path):
+    """Gets the parsed root object of the plist file.
+
+    The returned object is shared by all callers and must not be modified.
+
+    Args:
+      plist_file_path: string, the path of the .plist file.
+
+    Returns:
+      the root object of the plist file.
+    """
+    path = os.path.abspath(plist_file_path)
+    stat = os.stat(path)
+    signature = (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+    with self._lock:
+      entry = self._entries.get(path)
+      if entry and entry[0] == signature:
+        self._entries.move_to_end(path)
+        self.hits += 1
+        return entry[1]
+      self.misses += 1
+    with open(path, 'rb') as plist_file:
+      plist_root_object = plistlib.load(plist_file)
+    with self._lock:
+      self._entries[path] = (signature, plist_root_object)
+      self._entries.move_to_end(path)
+      while len(self._entries) > self._max_entries:
+        self._entries.popitem(last=False)
+    return plist_root_object
+
+  def Invalidate(self, plist_file_path):
+    """Drops the cached entry of the plist file."""
+    with self._lock:
+      self._entries.pop(os.path.abspath(plist_file_path), None)
+
+  def GetStats(self):
+    """Gets the counters of the cache."""
+    with self._lock:
+      return {
+          'hits': self.hits,
+          'misses': self.misses,
+          'entries': len(self._entries),
+      }
+
+  def Clear(self):
+    """Drops all entries and resets the counters."""
+    with self._lock:
+      self._entries.clear()
+      self.hits = 0
+      self.misses = 0
+
+
+_parse_cache = _PlistParseCache()
+
+
+def GetParseCacheStats():
+  """Gets the hit and miss counters of the plist parse cache.
+
+  Returns:
+    a dict with keys hits, misses and entries.
+  """
+  return _parse_cache.GetStats()
+
 
-    with open(self._plist_file_path, 'wb') as plist_file:
-      plistlib.dump(plist_root_object, plist_file)
+def ClearParseCache():
+  """Clears the plist parse cache and its counters."""
+  _parse_cache.Clear()
 
 
 def _GetObjectWithField(target_object, field):
@@ -0,0 +1,136 @@
+# Copyright 2017 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""The graph of dependent tasks which runs independent tasks concurrently."""
+
+import collections
+import concurrent.futures
+import logging
+import os
+import time
+
+from xctestrunner.shared import ios_errors
+
+DEFAULT_MAX_WORKERS = min(8, os.cpu_count() or 1)
+
+
+class TaskGraph(object):
+  """The tasks with dependencies run on a thread pool.
+
+  A task starts as soon as all the tasks it depends on are finished. The tasks
+  must be added after their dependencies, so the graph is always acyclic.
+
+  Usage:
+    graph = task_graph.TaskGraph()
+    graph.AddTask('framework', SignFramework)
+    graph.AddTask('app', SignApp, deps=['framework'])
+    graph.Run()
+  """
+
+  def __init__(self):
+    self._tasks = collections.OrderedDict()
+    self._timings = {}
+
+  @property
+  def timings(self):
+    """Gets a dict of task name to the (start, end) time of the finished task."""
+    return dict(self._timings)
+
+  def AddTask(self, name, fn, deps=()):
+    """Adds the task to the graph.
+
+    Args:
+      name: string, the unique name of the task.
+      fn: the callable without arguments to run the task.
+      deps: a list of string, the names of the tasks to finish before this one.
+
+    Returns:
+      string, the name of the task.
+
+    Raises:
+      ios_errors.IllegalArgumentError: when the name is duplicated or the
+        dependency is not added yet.
+    """
+    if name in self._tasks:
+      raise ios_errors.IllegalArgumentError(
+          'The task %s is already in the graph.' % name)
+    for dep in deps:
+      if dep not in self._tasks:
+        raise ios_errors.IllegalArgumentError(
+            'The dependency %s of task %s is not in the graph.' % (dep, name))
+    self._tasks[name] = (fn, frozenset(deps))
+    return name
+
+  def Run(self, max_workers=DEFAULT_MAX_WORKERS):
+    """Runs all the tasks and waits until they are finished.
+
+    If a task fails, no more tasks are started and the running ones are waited.
+
+    Args:
+      max_workers: int, the max number of the tasks running at once.
+
+    Raises:
+      the exception raised by the first failed task.
+    """
+    remaining_deps = {
+        name: set(deps) for name, (_, deps) in self._tasks.items()
+    }
+    running = {}
+    error = None
+    with concurrent.futures.ThreadPoolExecutor(max_workers) as executor:
+      while remaining_deps or running:
+        if error is None:
+          for name in [n for n, deps in remaining_deps.items() if not deps]:
+            del remaining_deps[name]
+            running[executor.submit(self._RunTask, name)] = name
+        elif not running:
+          break
+        done, _ = concurrent.futures.wait(
+            running, return_when=concurrent.futures.FIRST_COMPLETED)
+        for future in done:
+          name = running.pop(future)
+          if future.exception() is not None:
+            if error is None:
+              error = future.exception()
+            continue
+          for deps in remaining_deps.values():
+            deps.discard(name)
+    if error is not None:
+      raise error
+
+  def GetCriticalPath(self):
+    """Gets the chain of the finished tasks which bounded the total time.
+
+    Starting from the task finished last, it walks back through the dependency
+    finished last of each task. Speeding up any other task does not shorten the
+    run.
+
+    Returns:
+      a list of (name, seconds) tuples of the tasks in the running order.
+    """
+    path = []
+    names = [name for name in self._tasks if name in self._timings]
+    while names:
+      name = max(names, key=lambda n: self._timings[n][1])
+      start_time, end_time = self._timings[name]
+      path.append((name, end_time - start_time))
+      names = [dep for dep in self._tasks[name][1] if dep in self._timings]
+    path.reverse()
+    return path
+
+  def _RunTask(self, name):
+    start_time = time.time()
+    self._tasks[name][0]()
+    self._timings[name] = (start_time, time.time())
+    logging.debug('Finished task %s in %.2fs.', name, time.time() - start_time)
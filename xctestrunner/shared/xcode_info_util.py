@@ -12,21 +12,333 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-"""Utility methods for Xcode information."""
+"""Utility methods for Xcode information.
 
+A Toolchain object carries the information of one installed Xcode, so one
+process can run tests with several Xcodes at the same time. The module level
+functions are about the active Xcode, which is selected by the environment
+variable DEVELOPER_DIR or `xcode-select`.
+
+The toolchain facts, e.g. the Xcode version and the SDK paths, are cached on
+disk under the user cache directory. The cache is keyed by the developer
+directory and the modification time of the Info.plist of Xcode.app, so it is
+reused across the runner processes until the Xcode is updated.
+"""
+
+import json
 import os
 import subprocess
+import threading
 
+from xctestrunner.shared import cache_util
 from xctestrunner.shared import ios_constants
 from xctestrunner.shared import version_util
 
+_TOOLCHAIN_INFO_CACHE_NAME = 'toolchain_info'
+_TOOLCHAIN_INFO_FILE_NAME = 'toolchain_info.json'
+_TOOLCHAIN_INFO_LOCK_FILE_NAME = 'toolchain_info.lock'
+_TOOLCHAIN_INFO_MAX_KEYS = 8
+# The symlink which `xcode-select -s` updates.
+_XCODE_SELECT_LINK = '/var/db/xcode_select_link'
+
+
+class Toolchain(object):
+  """The information of an installed Xcode.
+
+  The facts are computed lazily and cached both in memory and on disk.
+  """
+
+  def __init__(self, developer_dir=None):
+    """Initializes the Toolchain object.
+
+    Args:
+      developer_dir: string, the developer directory of the Xcode, e.g.,
+        /Applications/Xcode.app/Contents/Developer. The path of Xcode.app is
+        also accepted. None means the active Xcode, which is resolved every
+        time the in-memory facts are loaded.
+    """
+    if developer_dir:
+      developer_dir = _NormalizeDeveloperDir(developer_dir)
+    self._developer_dir = developer_dir
+    self._lock = threading.Lock()
+    self._key = None
+    self._facts = None
+    # The name of the fact being computed to the event set once it is done.
+    self._pending_facts = {}
+
+  @property
+  def developer_dir(self):
+    """Gets the developer directory of the Xcode."""
+    return self._developer_dir or self.GetXcodeDeveloperPath()
+
+  @property
+  def env(self):
+    """Gets the environment to run the Xcode tools of this toolchain.
+
+    Returns:
+      a dict of the environment variables, or None which means inheriting the
+      environment of the current process.
+    """
+    if not self._developer_dir:
+      return None
+    env = dict(os.environ)
+    env['DEVELOPER_DIR'] = self._developer_dir
+    return env
+
+  def GetXcodeDeveloperPath(self):
+    """Gets the developer path of Xcode command line tools."""
+    if self._developer_dir:
+      return self._developer_dir
+    return self._Get('developer_path',
+                     lambda: self._CheckOutput(('xcode-select', '-p')))
+
+  def GetXcodeVersionNumber(self):
+    """Gets the Xcode version number.
+
+    E.g. if xcode version is 8.2.1, the xcode version number is 821.
+
+    Returns:
+      integer, xcode version number.
+    """
+
+    def _ComputeXcodeVersionNumber():
+      # Example output:
+      # Xcode 8.2.1
+      # Build version 8C1002
+      output = self._CheckOutput(('xcodebuild', '-version'))
+      xcode_version = output.split('\n')[0].split(' ')[1]
+      return version_util.GetVersionNumber(xcode_version)
+
+    return self._Get('xcode_version_number', _ComputeXcodeVersionNumber)
+
+  def GetSwift5FallbackLibsDir(self):
+    """Gets the Swift5 fallback libraries directory."""
+    relative_path = 'Toolchains/XcodeDefault.xctoolchain/usr/lib/swift-5.0'
+    swift_libs_dir = os.path.join(self.GetXcodeDeveloperPath(), relative_path)
+    swift_lib_platform_dir = os.path.join(swift_libs_dir,
+                                          ios_constants.SDK.IPHONESIMULATOR)
+    if os.path.exists(swift_lib_platform_dir):
+      return swift_lib_platform_dir
+    return None
+
+  def GetSdkPlatformPath(self, sdk):
+    """Gets the selected SDK platform path."""
+    return self._Get(
+        'sdk_platform_path:%s' % sdk,
+        lambda: self._CheckOutput(
+            ['xcrun', '--sdk', sdk, '--show-sdk-platform-path']))
+
+  def GetSdkVersion(self, sdk):
+    """Gets the selected SDK version."""
+    return self._Get(
+        'sdk_version:%s' % sdk,
+        lambda: self._CheckOutput(
+            ['xcrun', '--sdk', sdk, '--show-sdk-version']))
+
+  def GetXctestToolPath(self, sdk):
+    """Gets the path of xctest tool under the given SDK platform."""
+    return os.path.join(
+        self.GetSdkPlatformPath(sdk), 'Developer/Library/Xcode/Agents/xctest')
+
+  def GetToolPath(self, tool):
+    """Gets the absolute path of the Xcode tool, e.g., simctl.
+
+    The path is resolved by `xcrun -f` once per toolchain and cached.
+
+    Raises:
+      subprocess.CalledProcessError: when xcrun fails to find the tool.
+    """
+    return self._Get('tool_path:%s' % tool,
+                     lambda: self._CheckOutput(('xcrun', '-f', tool)))
+
+  def ResolveXcrunCommand(self, command):
+    """Replaces `xcrun <tool>` in the command by the absolute tool path.
+
+    Running the tool directly skips the tool lookup of the xcrun shim on every
+    call. The command is returned unchanged if it does not start with
+    `xcrun <tool>` or the tool can not be resolved.
+
+    Args:
+      command: a list of string, the command to run.
+
+    Returns:
+      a list of string, the resolved command.
+    """
+    command = list(command)
+    if len(command) < 2 or command[0] != 'xcrun' or command[1].startswith('-'):
+      return command
+    try:
+      tool_path = self.GetToolPath(command[1])
+    except (OSError, subprocess.CalledProcessError):
+      return command
+    # The cached path may be stale if the Xcode is moved without updating.
+    if not os.path.isfile(tool_path):
+      return command
+    return [tool_path] + command[2:]
+
+  def GetDarwinUserCacheDir(self):
+    """Gets the path of Darwin user cache directory."""
+    return self._Get('darwin_user_cache_dir',
+                     lambda: self._CheckOutput(
+                         ('getconf', 'DARWIN_USER_CACHE_DIR')))
+
+  def GetXcodeEmbeddedAppDeltasDir(self):
+    """Gets the path of Xcode's EmbeddedAppDeltas directory."""
+    return os.path.join(self.GetDarwinUserCacheDir(),
+                        'com.apple.DeveloperTools/All/Xcode/EmbeddedAppDeltas')
 
-_xcode_version_number = None
+  def ClearCache(self):
+    """Drops the in-memory facts. They will be loaded again from disk."""
+    with self._lock:
+      self._key = None
+      self._facts = None
+
+  def _CheckOutput(self, command):
+    """Runs the command of this toolchain and returns the stripped stdout."""
+    return subprocess.check_output(command, env=self.env).decode(
+        'utf-8').strip()
+
+  def _Get(self, name, compute_fn):
+    """Gets the toolchain fact and computes it on cache miss.
+
+    Args:
+      name: string, the name of the fact.
+      compute_fn: callable, it is called without argument to compute the fact.
+        The returned value should be serializable by json.
+
+    Returns:
+      the value of the fact.
+    """
+    while True:
+      with self._lock:
+        if self._facts is None:
+          self._key = _GetToolchainKey(self._developer_dir)
+          # Loads all the facts of the toolchain in one read.
+          self._facts = dict(_ReadToolchainInfoFile().get(self._key, {}))
+        if name in self._facts:
+          return self._facts[name]
+        key = self._key
+        pending = self._pending_facts.get(name)
+        if pending is None:
+          pending = threading.Event()
+          self._pending_facts[name] = pending
+          break
+      # Another thread is computing the fact. Checks again once it is done,
+      # and computes it here if that thread failed.
+      pending.wait()
+    try:
+      value = compute_fn()
+      with self._lock:
+        if self._key == key:
+          self._facts[name] = value
+      _SaveToolchainFact(key, name, value)
+    finally:
+      with self._lock:
+        del self._pending_facts[name]
+      pending.set()
+    return value
+
+
+_toolchains = {}
+_toolchains_lock = threading.Lock()
+
+
+def GetToolchain(developer_dir=None):
+  """Gets the shared Toolchain object of the given developer directory.
+
+  Args:
+    developer_dir: string, the developer directory or the path of Xcode.app.
+      None means the active Xcode.
+
+  Returns:
+    a Toolchain object.
+  """
+  if developer_dir:
+    developer_dir = _NormalizeDeveloperDir(developer_dir)
+  with _toolchains_lock:
+    toolchain = _toolchains.get(developer_dir)
+    if toolchain is None:
+      toolchain = Toolchain(developer_dir)
+      _toolchains[developer_dir] = toolchain
+    return toolchain
+
+
+def ClearToolchainInfoCache():
+  """Drops the in-memory toolchain facts, e.g., after switching Xcode."""
+  with _toolchains_lock:
+    for toolchain in _toolchains.values():
+      toolchain.ClearCache()
+
+
+def _NormalizeDeveloperDir(developer_dir):
+  """Converts the path of Xcode.app to its developer directory."""
+  if developer_dir.endswith('.app'):
+    developer_dir = os.path.join(developer_dir, 'Contents/Developer')
+  return os.path.normpath(developer_dir)
+
+
+def _GetToolchainKey(developer_dir=None):
+  """Gets the cache key of the toolchain without running subprocess.
+
+  Args:
+    developer_dir: string, the normalized developer directory. None means the
+      active one.
+  """
+  if not developer_dir:
+    developer_dir = os.environ.get('DEVELOPER_DIR')
+    if developer_dir:
+      developer_dir = _NormalizeDeveloperDir(developer_dir)
+    elif os.path.exists(_XCODE_SELECT_LINK):
+      developer_dir = os.path.realpath(_XCODE_SELECT_LINK)
+    else:
+      developer_dir = subprocess.check_output(
+          ('xcode-select', '-p')).decode('utf-8').strip()
+  info_plist_path = os.path.join(os.path.dirname(developer_dir), 'Info.plist')
+  try:
+    info_plist_mtime_ns = os.stat(info_plist_path).st_mtime_ns
+  except OSError:
+    info_plist_mtime_ns = 0
+  return '%s|%d' % (developer_dir, info_plist_mtime_ns)
+
+
+def _ReadToolchainInfoFile():
+  """Reads all the cached toolchains from the cache file."""
+  file_path = os.path.join(
+      cache_util.GetCacheDir(_TOOLCHAIN_INFO_CACHE_NAME),
+      _TOOLCHAIN_INFO_FILE_NAME)
+  try:
+    with open(file_path) as cache_file:
+      return json.load(cache_file)
+  except (OSError, ValueError):
+    return {}
+
+
+def _SaveToolchainFact(key, name, value):
+  """Merges the fact of the toolchain into the cache file."""
+  cache_dir = cache_util.GetCacheDir(_TOOLCHAIN_INFO_CACHE_NAME)
+  file_path = os.path.join(cache_dir, _TOOLCHAIN_INFO_FILE_NAME)
+  lock_file_path = os.path.join(cache_dir, _TOOLCHAIN_INFO_LOCK_FILE_NAME)
+  try:
+    with cache_util.FileLock(lock_file_path):
+      toolchains = _ReadToolchainInfoFile()
+      facts = toolchains.pop(key, {})
+      facts[name] = value
+      # Keeps the recently updated toolchains only.
+      toolchains[key] = facts
+      while len(toolchains) > _TOOLCHAIN_INFO_MAX_KEYS:
+        del toolchains[next(iter(toolchains))]
+      temp_file_path = file_path + '.tmp'
+      with open(temp_file_path, 'w') as cache_file:
+        json.dump(toolchains, cache_file, indent=2)
+      os.rename(temp_file_path, file_path)
+  except OSError:
+    # The cache is only an optimization.
+    pass
 
 
 def GetXcodeDeveloperPath():
   """Gets the active developer path of Xcode command line tools."""
-  return subprocess.check_output(('xcode-select', '-p')).decode('utf-8').strip()
+  return GetToolchain().GetXcodeDeveloperPath()
 
 
 def GetXcodeVersionNumber():
@@ -37,19 +349,7 @@ def GetXcodeVersionNumber():
   Returns:
     integer, xcode version number.
   """
-  global _xcode_version_number
-  if _xcode_version_number is not None:
-    return _xcode_version_number
-
-  # Example output:
-  # Xcode 8.2.1
-  # Build version 8C1002
-  output = subprocess.check_output(('xcodebuild', '-version')).decode('utf-8')
-  xcode_version = output.split('\n')[0].split(' ')[1]
-  # Add cache xcode_version_number to avoid calling subprocess multiple times.
-  # It is expected that no one changes xcode during the test runner working.
-  _xcode_version_number = version_util.GetVersionNumber(xcode_version)
-  return _xcode_version_number
+  return GetToolchain().GetXcodeVersionNumber()
 
 
 # Xcode 11+'s Swift dylibs are configured in a way that does not allow them to
@@ -60,41 +360,37 @@ def GetXcodeVersionNumber():
 # See https://github.com/bazelbuild/rules_apple/issues/684 for context.
 def GetSwift5FallbackLibsDir():
   """Gets the Swift5 fallback libraries directory."""
-  relative_path = 'Toolchains/XcodeDefault.xctoolchain/usr/lib/swift-5.0'
-  swift_libs_dir = os.path.join(GetXcodeDeveloperPath(), relative_path)
-  swift_lib_platform_dir = os.path.join(swift_libs_dir,
-                                        ios_constants.SDK.IPHONESIMULATOR)
-  if os.path.exists(swift_lib_platform_dir):
-    return swift_lib_platform_dir
-  return None
+  return GetToolchain().GetSwift5FallbackLibsDir()
 
 
 def GetSdkPlatformPath(sdk):
   """Gets the selected SDK platform path."""
-  return subprocess.check_output(
-      ['xcrun', '--sdk', sdk,
-       '--show-sdk-platform-path']).decode('utf-8').strip()
+  return GetToolchain().GetSdkPlatformPath(sdk)
 
 
 def GetSdkVersion(sdk):
   """Gets the selected SDK version."""
-  return subprocess.check_output(['xcrun', '--sdk', sdk, '--show-sdk-version'
-                                 ]).decode('utf-8').strip()
+  return GetToolchain().GetSdkVersion(sdk)
 
 
 def GetXctestToolPath(sdk):
   """Gets the path of xctest tool under the given SDK platform."""
-  return os.path.join(
-      GetSdkPlatformPath(sdk), 'Developer/Library/Xcode/Agents/xctest')
+  return GetToolchain().GetXctestToolPath(sdk)
+
+
+def ResolveXcrunCommand(command):
+  """Replaces `xcrun <tool>` in the command by the absolute tool path.
+
+  See Toolchain.ResolveXcrunCommand for details.
+  """
+  return GetToolchain().ResolveXcrunCommand(command)
 
 
 def GetDarwinUserCacheDir():
   """Gets the path of Darwin user cache directory."""
-  return subprocess.check_output(
-      ('getconf', 'DARWIN_USER_CACHE_DIR')).decode('utf-8').rstrip()
+  return GetToolchain().GetDarwinUserCacheDir()
 
 
 def GetXcodeEmbeddedAppDeltasDir():
   """Gets the path of Xcode's EmbeddedAppDeltas directory."""
-  return os.path.join(GetDarwinUserCacheDir(),
-                      'com.apple.DeveloperTools/All/Xcode/EmbeddedAppDeltas')
+  return GetToolchain().GetXcodeEmbeddedAppDeltasDir()
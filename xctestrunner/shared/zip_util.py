@@ -0,0 +1,148 @@
+# Copyright 2017 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Utility methods for extracting zip archives, e.g., ipa files.
+
+Unlike zipfile.ZipFile.extractall, which drops the permission bits (see
+https://bugs.python.org/issue15795), the extractor restores the mode bits, the
+symlinks and the modified times from the entries. The files are decompressed
+on a thread pool, which runs in parallel since zlib releases the GIL.
+"""
+
+import concurrent.futures
+import os
+import shutil
+import stat
+import threading
+import time
+import zipfile
+
+from xctestrunner.shared import ios_errors
+
+DEFAULT_MAX_WORKERS = min(8, os.cpu_count() or 1)
+_COPY_BUFFER_SIZE = 1024 * 1024
+
+
+def ExtractZip(zip_file_path, target_dir, member_filter=None,
+               max_workers=DEFAULT_MAX_WORKERS):
+  """Extracts the zip file to the directory.
+
+  Args:
+    zip_file_path: string, the path of the zip file.
+    target_dir: string, the directory to extract the files to.
+    member_filter: the callable which accepts the name of the member, e.g.,
+      Payload/Foo.app/Info.plist, and returns whether to extract it. None means
+      extracting all the members.
+    max_workers: int, the max number of the files decompressed at once.
+
+  Raises:
+    ios_errors.BundleError: when the zip file is invalid or a member is outside
+      the target directory.
+  """
+  try:
+    with zipfile.ZipFile(zip_file_path) as zip_file:
+      infos = [
+          info for info in zip_file.infolist()
+          if member_filter is None or member_filter(info.filename)
+      ]
+  except (OSError, zipfile.BadZipFile) as e:
+    raise ios_errors.BundleError(
+        'Failed to read the zip file %s: %s' % (zip_file_path, e))
+
+  target_dir = os.path.abspath(target_dir)
+  dir_infos = []
+  file_infos = []
+  link_infos = []
+  for info in infos:
+    if info.is_dir():
+      dir_infos.append(info)
+    elif stat.S_ISLNK(_GetMode(info)):
+      link_infos.append(info)
+    else:
+      file_infos.append(info)
+
+  # Creates the directories first, so the files can be written concurrently.
+  dir_paths = {target_dir}
+  for info in infos:
+    path = _GetTargetPath(target_dir, info)
+    dir_paths.add(os.path.dirname(path))
+    if info.is_dir():
+      dir_paths.add(path)
+  for dir_path in sorted(dir_paths):
+    os.makedirs(dir_path, exist_ok=True)
+
+  local = threading.local()
+  opened_zip_files = []
+  opened_zip_files_lock = threading.Lock()
+
+  def _ExtractFile(info):
+    # Each thread reads from its own handle of the zip file.
+    zip_file = getattr(local, 'zip_file', None)
+    if zip_file is None:
+      zip_file = zipfile.ZipFile(zip_file_path)
+      local.zip_file = zip_file
+      with opened_zip_files_lock:
+        opened_zip_files.append(zip_file)
+    path = _GetTargetPath(target_dir, info)
+    if os.path.lexists(path) and not os.path.isdir(path):
+      os.remove(path)
+    with zip_file.open(info) as src, open(path, 'wb') as dst:
+      shutil.copyfileobj(src, dst, _COPY_BUFFER_SIZE)
+    _RestoreAttributes(path, info)
+
+  try:
+    with concurrent.futures.ThreadPoolExecutor(max_workers) as executor:
+      # The largest files go first to balance the workers.
+      list(executor.map(
+          _ExtractFile,
+          sorted(file_infos, key=lambda i: i.file_size, reverse=True)))
+    with zipfile.ZipFile(zip_file_path) as zip_file:
+      for info in link_infos:
+        path = _GetTargetPath(target_dir, info)
+        if os.path.lexists(path):
+          os.remove(path)
+        os.symlink(zip_file.read(info).decode('utf-8'), path)
+  except (zipfile.BadZipFile, zipfile.LargeZipFile) as e:
+    raise ios_errors.BundleError(
+        'Failed to extract the zip file %s: %s' % (zip_file_path, e))
+  finally:
+    for zip_file in opened_zip_files:
+      zip_file.close()
+  # Restores the modes of the directories at last, in case some of them are
+  # not writable.
+  for info in sorted(dir_infos, key=lambda i: i.filename, reverse=True):
+    _RestoreAttributes(_GetTargetPath(target_dir, info), info)
+
+
+def _GetTargetPath(target_dir, info):
+  """Gets the extracted path of the member, which must be in the directory."""
+  path = os.path.normpath(os.path.join(target_dir, info.filename))
+  if path != target_dir and not path.startswith(target_dir + os.sep):
+    raise ios_errors.BundleError(
+        'The zip member %s is outside of the target directory.' % info.filename)
+  return path
+
+
+def _GetMode(info):
+  """Gets the unix mode of the member, or 0 if it is not recorded."""
+  return info.external_attr >> 16
+
+
+def _RestoreAttributes(path, info):
+  """Restores the permission bits and the modified time of the member."""
+  mode = stat.S_IMODE(_GetMode(info))
+  if mode:
+    os.chmod(path, mode)
+  mtime = time.mktime(info.date_time + (0, 0, -1))
+  os.utime(path, (mtime, mtime))
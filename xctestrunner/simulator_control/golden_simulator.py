@@ -0,0 +1,230 @@
+# Copyright 2017 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""The golden simulators which new simulators are cloned from.
+
+The first boot of a new simulator spends most of its time on data migration.
+A golden simulator is created once per (device_type, os_version, Xcode
+version), booted once to finish the first boot setup and shut down. Then the
+new simulators are cloned from it by `simctl clone`, which is much faster than
+`simctl create` plus the first boot.
+
+A golden simulator is rebuilt when the build version of its runtime or the
+Xcode version changes. The clones hold the lock of the golden simulators
+shared, and the builds hold it exclusive, so a golden simulator is never
+deleted while it is being cloned.
+"""
+
+import json
+import logging
+import os
+import subprocess
+import time
+
+from xctestrunner.shared import cache_util
+from xctestrunner.shared import ios_constants
+from xctestrunner.shared import ios_errors
+from xctestrunner.shared import xcode_info_util
+from xctestrunner.simulator_control import simulator_reaper
+from xctestrunner.simulator_control import simulator_util
+
+_GOLDEN_CACHE_NAME = 'golden_simulators'
+_GOLDEN_STATE_FILE_NAME = 'goldens.json'
+_GOLDEN_LOCK_FILE_NAME = 'goldens.lock'
+_GOLDEN_SIMULATOR_NAME_PREFIX = 'Golden'
+_GOLDEN_BOOT_STATUS_TIMEOUT_SEC = 300
+_GOLDEN_CLONE_MAX_ATTEMPTS = 3
+
+
+def CreateNewSimulatorFromGolden(device_type=None, os_version=None,
+                                 name_prefix=None):
+  """Creates a new simulator by cloning the golden simulator.
+
+  The golden simulator is built first if it does not exist or is stale. See
+  simulator_util.CreateNewSimulator for the details of the arguments and the
+  returned value.
+
+  Raises:
+    ios_errors.SimError: when failed to build the golden simulator or to clone
+      it.
+    ios_errors.IllegalArgumentError: when the given argument is invalid.
+  """
+  device_type, os_version = simulator_util.ResolveSimulatorTypeAndOsVersion(
+      device_type, os_version)
+  golden_dir = cache_util.GetCacheDir(_GOLDEN_CACHE_NAME)
+  state_file_path = os.path.join(golden_dir, _GOLDEN_STATE_FILE_NAME)
+  xcode_version = xcode_info_util.GetXcodeVersionNumber()
+  runtime_build_version = _GetRuntimeBuildVersion(device_type, os_version)
+  for _ in range(_GOLDEN_CLONE_MAX_ATTEMPTS):
+    with cache_util.FileLock(
+        os.path.join(golden_dir, _GOLDEN_LOCK_FILE_NAME), shared=True):
+      golden_id = _GetUpToDateGoldenId(
+          _LoadGoldens(state_file_path), device_type, os_version,
+          xcode_version, runtime_build_version)
+      if golden_id:
+        return simulator_util.CreateNewSimulator(
+            device_type=device_type,
+            os_version=os_version,
+            name_prefix=name_prefix,
+            clone_source_id=golden_id)
+    # The golden simulator is missing or stale. Builds it under the exclusive
+    # lock, then clones it under the shared lock again.
+    GetGoldenSimulatorId(device_type, os_version)
+  raise ios_errors.SimError(
+      'The golden simulator of %s %s was rebuilt by others in %d attempts.' %
+      (device_type, os_version, _GOLDEN_CLONE_MAX_ATTEMPTS))
+
+
+def GetGoldenSimulatorId(device_type, os_version):
+  """Gets the id of the golden simulator and builds it if needed.
+
+  The golden simulator may be rebuilt by others once the lock is released. Use
+  CreateNewSimulatorFromGolden to clone it.
+
+  Args:
+    device_type: string, the resolved device type of the simulator.
+    os_version: string, the resolved OS version of the simulator.
+
+  Returns:
+    string, the id of the SHUTDOWN golden simulator.
+
+  Raises:
+    ios_errors.SimError: when failed to build the golden simulator.
+  """
+  golden_dir = cache_util.GetCacheDir(_GOLDEN_CACHE_NAME)
+  state_file_path = os.path.join(golden_dir, _GOLDEN_STATE_FILE_NAME)
+  xcode_version = xcode_info_util.GetXcodeVersionNumber()
+  runtime_build_version = _GetRuntimeBuildVersion(device_type, os_version)
+  key = _GetGoldenKey(device_type, os_version)
+  # Holds the lock while building, so concurrent runners build the golden
+  # simulator only once.
+  with cache_util.FileLock(os.path.join(golden_dir, _GOLDEN_LOCK_FILE_NAME)):
+    goldens = _LoadGoldens(state_file_path)
+    golden_id = _GetUpToDateGoldenId(goldens, device_type, os_version,
+                                     xcode_version, runtime_build_version)
+    if golden_id:
+      return golden_id
+    golden = goldens.get(key)
+    if golden:
+      logging.info('The golden simulator %s of %s is stale. Will rebuild it.',
+                   golden['simulator_id'], key)
+      _DeleteGolden(simulator_util.Simulator(golden['simulator_id']))
+      del goldens[key]
+      _SaveGoldens(state_file_path, goldens)
+
+    golden_id = _BuildGolden(device_type, os_version)
+    goldens[key] = {
+        'simulator_id': golden_id,
+        'xcode_version': xcode_version,
+        'runtime_build_version': runtime_build_version,
+        'created_time': time.time(),
+    }
+    _SaveGoldens(state_file_path, goldens)
+    return golden_id
+
+
+def InvalidateGoldens():
+  """Deletes all golden simulators. They will be rebuilt on demand."""
+  golden_dir = cache_util.GetCacheDir(_GOLDEN_CACHE_NAME)
+  state_file_path = os.path.join(golden_dir, _GOLDEN_STATE_FILE_NAME)
+  with cache_util.FileLock(os.path.join(golden_dir, _GOLDEN_LOCK_FILE_NAME)):
+    for golden in _LoadGoldens(state_file_path).values():
+      _DeleteGolden(simulator_util.Simulator(golden['simulator_id']))
+    _SaveGoldens(state_file_path, {})
+
+
+def _GetUpToDateGoldenId(goldens, device_type, os_version, xcode_version,
+                         runtime_build_version):
+  """Gets the id of the golden simulator if it is up to date, otherwise None.
+
+  The caller should hold the lock.
+  """
+  golden = goldens.get(_GetGoldenKey(device_type, os_version))
+  if (golden and golden['xcode_version'] == xcode_version and
+      golden['runtime_build_version'] == runtime_build_version and
+      simulator_util.Simulator(golden['simulator_id']).GetSimulatorState() ==
+      ios_constants.SimState.SHUTDOWN):
+    return golden['simulator_id']
+  return None
+
+
+def _GetGoldenKey(device_type, os_version):
+  return '%s|%s' % (device_type, os_version)
+
+
+def _BuildGolden(device_type, os_version):
+  """Creates the golden simulator, boots it once and shuts it down."""
+  golden_id, _, _, _ = simulator_util.CreateNewSimulator(
+      device_type=device_type,
+      os_version=os_version,
+      name_prefix=_GOLDEN_SIMULATOR_NAME_PREFIX)
+  simulator_reaper.WriteOwnerMarker(golden_id, persistent=True)
+  golden_obj = simulator_util.Simulator(golden_id)
+  logging.info('Booting golden simulator %s to finish the first boot setup.',
+               golden_id)
+  try:
+    golden_obj.Boot()
+    boot_status = golden_obj.BootStatus()
+    try:
+      boot_status.wait(timeout=_GOLDEN_BOOT_STATUS_TIMEOUT_SEC)
+    except subprocess.TimeoutExpired:
+      boot_status.kill()
+      raise ios_errors.SimError(
+          'The simulator %s could not be booted in %ss.' %
+          (golden_id, _GOLDEN_BOOT_STATUS_TIMEOUT_SEC))
+    golden_obj.Shutdown()
+  except ios_errors.SimError as e:
+    _DeleteGolden(golden_obj)
+    raise ios_errors.SimError('Failed to build golden simulator: %s' % str(e))
+  logging.info('Built golden simulator %s.', golden_id)
+  return golden_id
+
+
+def _GetRuntimeBuildVersion(device_type, os_version):
+  """Gets the build version of the simulator runtime from simctl inventory."""
+  runtime_id = simulator_util.GetRuntimeId(
+      simulator_util.GetOsType(device_type), os_version)
+  for runtime_info in simulator_util.GetSimctlInventory().runtimes:
+    if runtime_info.get('identifier') == runtime_id:
+      return runtime_info.get('buildversion')
+  return None
+
+
+def _DeleteGolden(golden_obj):
+  """Deletes the golden simulator. Errors are only logged."""
+  simulator_id = golden_obj.simulator_id
+  try:
+    golden_obj.Delete(asynchronously=False)
+  except ios_errors.SimError as e:
+    logging.warning('Failed to delete golden simulator %s: %s', simulator_id,
+                    str(e))
+
+
+def _LoadGoldens(state_file_path):
+  """Loads the golden simulator records. The caller should hold the lock."""
+  if not os.path.exists(state_file_path):
+    return {}
+  with open(state_file_path) as state_file:
+    try:
+      return json.load(state_file)
+    except ValueError:
+      return {}
+
+
+def _SaveGoldens(state_file_path, goldens):
+  """Saves the golden simulator records. The caller should hold the lock."""
+  temp_file_path = state_file_path + '.tmp'
+  with open(temp_file_path, 'w') as state_file:
+    json.dump(goldens, state_file, indent=2, sort_keys=True)
+  os.rename(temp_file_path, state_file_path)
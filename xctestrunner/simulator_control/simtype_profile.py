@@ -25,15 +25,18 @@ from xctestrunner.shared import xcode_info_util
 class SimTypeProfile(object):
   """The object for simulator device type's profile."""
 
-  def __init__(self, device_type):
+  def __init__(self, device_type, toolchain=None):
     """Constructor of SimulatorProfile object.
 
     Args:
       device_type: string, device type of the new simulator. The value
           corresponds to the output of `xcrun simctl list devicetypes`.
           E.g., iPhone 6, iPad Air, etc.
+      toolchain: xcode_info_util.Toolchain, the Xcode which provides the
+          simulator profiles. By default, it is the active Xcode.
     """
     self._device_type = device_type
+    self._toolchain = toolchain or xcode_info_util.GetToolchain()
     self._profile_plist_obj = None
     self._min_os_version = None
     self._max_os_version = None
@@ -47,8 +50,8 @@ class SimTypeProfile(object):
       profile.plist.
     """
     if not self._profile_plist_obj:
-      xcode_version = xcode_info_util.GetXcodeVersionNumber()
-      platform_path = xcode_info_util.GetSdkPlatformPath(
+      xcode_version = self._toolchain.GetXcodeVersionNumber()
+      platform_path = self._toolchain.GetSdkPlatformPath(
           ios_constants.SDK.IPHONEOS)
       if xcode_version >= 1630:
         sim_profiles_dir = '/Library/Developer/CoreSimulator/Profiles'
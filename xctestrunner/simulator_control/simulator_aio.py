@@ -0,0 +1,282 @@
+# Copyright 2017 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""The asyncio counterpart of simulator_util.
+
+The coroutines have the same semantics as the blocking methods in
+simulator_util, so many simulators can be created, booted, shut down and
+deleted concurrently from one event loop. E.g.,
+
+  async def _BringUp(count):
+    results = await asyncio.gather(
+        *[simulator_aio.CreateNewSimulator() for _ in range(count)])
+    simulators = [simulator_aio.AsyncSimulator(r[0]) for r in results]
+    await asyncio.gather(*[s.Boot() for s in simulators])
+    return simulators
+"""
+
+import asyncio
+import logging
+import os
+import shutil
+import time
+
+from xctestrunner.shared import ios_constants
+from xctestrunner.shared import ios_errors
+from xctestrunner.shared import xcode_info_util
+from xctestrunner.simulator_control import simulator_reaper
+from xctestrunner.simulator_control import simulator_util
+
+_SIM_CHECK_STATE_MIN_INTERVAL_SEC = 0.02
+_SIM_CHECK_STATE_MAX_INTERVAL_SEC = 0.5
+
+
+class AsyncSimulator(object):
+  """The asyncio wrapper of simulator_util.Simulator."""
+
+  def __init__(self, simulator_id, on_interrupted=None):
+    """Constructor of AsyncSimulator object.
+
+    Args:
+      simulator_id: string, the identity of the simulator.
+      on_interrupted: callable, it is called without argument every time the
+        simctl commands of this simulator see the CoreSimulatorService
+        connection interrupted.
+    """
+    self._simulator = simulator_util.Simulator(simulator_id)
+    self._on_interrupted = on_interrupted
+
+  @property
+  def simulator(self):
+    """Gets the blocking simulator_util.Simulator object."""
+    return self._simulator
+
+  @property
+  def simulator_id(self):
+    return self._simulator.simulator_id
+
+  async def Boot(self):
+    """Boots the simulator and waits until its state becomes BOOTED."""
+    await RunSimctlCommand(['xcrun', 'simctl', 'boot', self.simulator_id],
+                           on_interrupted=self._on_interrupted)
+    await self.WaitUntilStateBooted()
+    logging.info('The simulator %s is booted.', self.simulator_id)
+
+  async def WaitForBootStatus(self, timeout_sec=None):
+    """Waits until the simulator finishes booting all its services.
+
+    Args:
+      timeout_sec: int, the max seconds to wait. None means no limit.
+
+    Returns:
+      True if the simulator finished booting, False if it is timeout.
+    """
+    process = await asyncio.create_subprocess_exec(
+        *xcode_info_util.ResolveXcrunCommand(
+            ['xcrun', 'simctl', 'bootstatus', self.simulator_id, '-b']),
+        stdout=asyncio.subprocess.DEVNULL,
+        stderr=asyncio.subprocess.DEVNULL)
+    try:
+      await asyncio.wait_for(process.wait(), timeout_sec)
+      return True
+    except asyncio.TimeoutError:
+      process.kill()
+      await process.wait()
+      return False
+
+  async def Shutdown(self):
+    """Shuts down the simulator."""
+    if not self._simulator.CheckShutdownNeeded():
+      return
+    try:
+      await RunSimctlCommand(
+          ['xcrun', 'simctl', 'shutdown', self.simulator_id],
+          on_interrupted=self._on_interrupted)
+    except ios_errors.SimError as e:
+      self._simulator.HandleShutdownError(e)
+      return
+    await self.WaitUntilStateShutdown()
+    logging.info('Shut down simulator %s.', self.simulator_id)
+
+  async def Delete(self):
+    """Deletes the simulator and waits until the deletion finishes.
+
+    Raises:
+      ios_errors.SimError: when failed to delete the simulator.
+    """
+    simulator_id = self.simulator_id
+    try:
+      await RunSimctlCommand(['xcrun', 'simctl', 'delete', simulator_id],
+                             on_interrupted=self._on_interrupted)
+      logging.info('Deleted simulator %s.', simulator_id)
+      simulator_reaper.RemoveOwnerMarker(simulator_id)
+    except ios_errors.SimError as e:
+      raise ios_errors.SimError('Failed to delete simulator %s: %s' %
+                                (simulator_id, str(e)))
+    finally:
+      simulator_util.GetSimctlInventory().Invalidate()
+    # The delete command won't delete the simulator log directory.
+    log_root_dir = self._simulator.simulator_log_root_dir
+    if os.path.exists(log_root_dir):
+      await asyncio.get_running_loop().run_in_executor(
+          None, lambda: shutil.rmtree(log_root_dir, ignore_errors=True))
+
+  async def WaitUntilStateBooted(
+      self, timeout_sec=simulator_util.SIMULATOR_BOOTED_TIMEOUT_SEC):
+    """Waits until the simulator state becomes BOOTED.
+
+    Raises:
+      ios_errors.SimError: when it is timeout to wait the simulator state
+          becomes BOOTED.
+    """
+    if not await self._WaitUntilState(ios_constants.SimState.BOOTED,
+                                      timeout_sec):
+      raise ios_errors.SimError('Timeout to wait for simulator booted in %ss.' %
+                                timeout_sec)
+
+  async def WaitUntilStateShutdown(
+      self, timeout_sec=simulator_util.SIMULATOR_SHUTDOWN_TIMEOUT_SEC):
+    """Waits until the simulator state becomes SHUTDOWN.
+
+    Raises:
+      ios_errors.SimError: when it is timeout to wait the simulator state
+          becomes SHUTDOWN.
+    """
+    if not await self._WaitUntilState(ios_constants.SimState.SHUTDOWN,
+                                      timeout_sec):
+      raise ios_errors.SimError(
+          'Timeout to wait for simulator shutdown in %ss.' % timeout_sec)
+
+  async def _WaitUntilState(self, state, timeout_sec):
+    """Polls the simulator state with adaptive backoff.
+
+    Reading the state is only a stat call while device.plist is unchanged, so
+    polling many simulators from one event loop is cheap.
+
+    Returns:
+      True if the simulator reaches the state, False if it is timeout.
+    """
+    deadline = time.time() + timeout_sec
+    interval = _SIM_CHECK_STATE_MIN_INTERVAL_SEC
+    while True:
+      if self._simulator.GetSimulatorState() == state:
+        return True
+      remaining_sec = deadline - time.time()
+      if remaining_sec <= 0:
+        return False
+      await asyncio.sleep(min(interval, remaining_sec))
+      interval = min(interval * 2, _SIM_CHECK_STATE_MAX_INTERVAL_SEC)
+
+
+async def CreateNewSimulator(device_type=None, os_version=None,
+                             name_prefix=None, on_interrupted=None):
+  """Creates a new simulator according to arguments.
+
+  See simulator_util.CreateNewSimulator for the details of the arguments and
+  the default values. See RunSimctlCommand for the argument on_interrupted.
+
+  Returns:
+     a tuple with four items:
+        string, id of the new simulator.
+        string, simulator device type of the new simulator.
+        string, OS version of the new simulator.
+        string, name of the new simulator.
+
+  Raises:
+    ios_errors.SimError: when failed to create new simulator.
+    ios_errors.IllegalArgumentError: when the given argument is invalid.
+  """
+  # Resolving reads the cached simctl inventory. Runs it in the executor since
+  # the first call of the process runs `simctl list`.
+  device_type, os_version = await asyncio.get_running_loop().run_in_executor(
+      None, simulator_util.ResolveSimulatorTypeAndOsVersion, device_type,
+      os_version)
+  os_type = simulator_util.GetOsType(device_type)
+  if not name_prefix:
+    name_prefix = 'New'
+  name = '%s-%s-%s' % (name_prefix, device_type, os_version)
+  runtime_id = simulator_util.GetRuntimeId(os_type, os_version)
+  logging.info('Creating a new simulator:\nName: %s\nOS: %s %s\nType: %s', name,
+               os_type, os_version, device_type)
+  for i in range(0, simulator_util.SIM_OPERATION_MAX_ATTEMPTS):
+    try:
+      new_simulator_id = await RunSimctlCommand(
+          ['xcrun', 'simctl', 'create', name, device_type, runtime_id],
+          on_interrupted=on_interrupted)
+    except ios_errors.SimError as e:
+      raise ios_errors.SimError('Failed to create simulator: %s' % str(e))
+    simulator_util.GetSimctlInventory().Invalidate()
+    simulator_reaper.WriteOwnerMarker(new_simulator_id)
+    new_simulator_obj = AsyncSimulator(new_simulator_id, on_interrupted)
+    # After creating a new simulator, its state is CREATING. When the
+    # simulator's state becomes SHUTDOWN, the simulator is created.
+    try:
+      await new_simulator_obj.WaitUntilStateShutdown(
+          simulator_util.SIMULATOR_CREATING_TO_SHUTDOWN_TIMEOUT_SEC)
+      logging.info('Created new simulator %s.', new_simulator_id)
+      return new_simulator_id, device_type, os_version, name
+    except ios_errors.SimError as error:
+      logging.debug('Failed to create simulator %s: %s.', new_simulator_id,
+                    error)
+      try:
+        await new_simulator_obj.Delete()
+        logging.debug('Deleted half-created simulator %s.', new_simulator_id)
+      except ios_errors.SimError as e:
+        logging.debug('Failed to delete half-created simulator %s: %s',
+                      new_simulator_id, e)
+      if i != simulator_util.SIM_OPERATION_MAX_ATTEMPTS - 1:
+        logging.debug('Will sleep %ss and retry again.',
+                      simulator_util.SIM_ERROR_RETRY_INTERVAL_SEC)
+        await asyncio.sleep(simulator_util.SIM_ERROR_RETRY_INTERVAL_SEC)
+  raise ios_errors.SimError('Failed to create simulator in %d attempts.' %
+                            simulator_util.SIM_OPERATION_MAX_ATTEMPTS)
+
+
+async def RunSimctlCommand(command, on_interrupted=None):
+  """Runs simctl command without blocking the event loop.
+
+  Like simulator_util.RunSimctlCommand, the command is retried when the
+  CoreSimulatorService connection is interrupted.
+
+  Args:
+    command: a list of string, the simctl command.
+    on_interrupted: callable, it is called without argument every time the
+      command sees the CoreSimulatorService connection interrupted, including
+      the retried ones.
+
+  Returns:
+    string, the stripped stdout of the command.
+
+  Raises:
+    ios_errors.SimError: when the command fails.
+  """
+  command = xcode_info_util.ResolveXcrunCommand(command)
+  for i in range(simulator_util.SIMCTL_MAX_ATTEMPTS):
+    process = await asyncio.create_subprocess_exec(
+        *command,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE)
+    stdout, stderr = await process.communicate()
+    stdout = stdout.decode('utf-8')
+    all_output = '\n'.join([stdout, stderr.decode('utf-8')])
+    output = stdout.strip()
+    if process.returncode != 0:
+      interrupted = (
+          ios_constants.CORESIMULATOR_INTERRUPTED_ERROR in all_output)
+      if interrupted and on_interrupted:
+        on_interrupted()
+      if i < (simulator_util.SIMCTL_MAX_ATTEMPTS - 1) and interrupted:
+        continue
+      raise ios_errors.SimError(output or all_output.strip())
+    return output
@@ -0,0 +1,206 @@
+# Copyright 2017 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Creates and boots many simulators in parallel behind an adaptive limiter.
+
+The CoreSimulatorService connection may be interrupted when too many simulators
+are booting at the same time. The limiter follows AIMD (additive increase,
+multiplicative decrease): every successful bring-up grows the number of
+in-flight operations by one and every interruption halves it. So the fan-out
+converges to the max throughput that the host can take.
+"""
+
+import asyncio
+import logging
+
+from xctestrunner.shared import ios_errors
+from xctestrunner.simulator_control import simulator_aio
+
+DEFAULT_INITIAL_CONCURRENCY = 4
+DEFAULT_MAX_CONCURRENCY = 16
+_BRING_UP_MAX_ATTEMPTS = 3
+
+
+class AdaptiveConcurrencyLimiter(object):
+  """The AIMD concurrency limiter for the simulator operations."""
+
+  def __init__(self,
+               initial_limit=DEFAULT_INITIAL_CONCURRENCY,
+               min_limit=1,
+               max_limit=DEFAULT_MAX_CONCURRENCY,
+               increase_step=1,
+               decrease_factor=0.5):
+    """Initializes the AdaptiveConcurrencyLimiter object.
+
+    Args:
+      initial_limit: int, the initial number of in-flight operations.
+      min_limit: int, the lower bound of the limit.
+      max_limit: int, the upper bound of the limit.
+      increase_step: int, the value added to the limit on every success.
+      decrease_factor: float, the factor multiplied to the limit on every
+        interruption.
+    """
+    self._limit = float(initial_limit)
+    self._min_limit = min_limit
+    self._max_limit = max_limit
+    self._increase_step = increase_step
+    self._decrease_factor = decrease_factor
+    self._in_flight = 0
+    self._condition = None
+
+  @property
+  def limit(self):
+    """Gets the current max number of in-flight operations."""
+    return max(self._min_limit, int(self._limit))
+
+  @property
+  def in_flight(self):
+    """Gets the current number of in-flight operations."""
+    return self._in_flight
+
+  async def Acquire(self):
+    """Waits until a new operation is admitted."""
+    async with self._GetCondition():
+      await self._condition.wait_for(lambda: self._in_flight < self.limit)
+      self._in_flight += 1
+
+  async def Release(self):
+    """Releases the slot of a finished operation."""
+    async with self._GetCondition():
+      self._in_flight -= 1
+      self._condition.notify_all()
+
+  async def OnSuccess(self):
+    """Grows the limit additively after a successful operation."""
+    async with self._GetCondition():
+      self._limit = min(self._max_limit, self._limit + self._increase_step)
+      self._condition.notify_all()
+
+  def OnInterrupted(self):
+    """Shrinks the limit multiplicatively after an interruption.
+
+    It is not a coroutine so it can be used as the on_interrupted callback of
+    simulator_aio. The waiters only need to be notified when the limit grows.
+    """
+    new_limit = max(self._min_limit, self._limit * self._decrease_factor)
+    if new_limit < self._limit:
+      logging.info('CoreSimulatorService is interrupted. Reduces simulator '
+                   'operation concurrency from %d to %d.', self.limit,
+                   int(new_limit))
+    self._limit = new_limit
+
+  def _GetCondition(self):
+    """Creates the condition lazily in the running event loop."""
+    if self._condition is None:
+      self._condition = asyncio.Condition()
+    return self._condition
+
+
+async def CreateAndBootSimulatorsAsync(count,
+                                       device_type=None,
+                                       os_version=None,
+                                       name_prefix=None,
+                                       limiter=None):
+  """Creates and boots simulators in parallel.
+
+  See simulator_util.CreateNewSimulator for the details of the arguments
+  device_type, os_version and name_prefix.
+
+  Args:
+    count: int, the number of simulators to bring up.
+    device_type: string, device type of the new simulators.
+    os_version: string, OS version of the new simulators.
+    name_prefix: string, name prefix of the new simulators.
+    limiter: AdaptiveConcurrencyLimiter, the limiter of in-flight operations.
+      By default, a new limiter is used.
+
+  Returns:
+    a list of tuples (simulator id, device type, OS version, name) of the
+    booted simulators. The failed ones are logged and skipped.
+
+  Raises:
+    ios_errors.SimError: when none of the simulators is brought up.
+  """
+  if limiter is None:
+    limiter = AdaptiveConcurrencyLimiter()
+  results = await asyncio.gather(
+      *[_BringUpSimulator(device_type, os_version, name_prefix, limiter)
+        for _ in range(count)],
+      return_exceptions=True)
+  simulators = []
+  errors = []
+  for result in results:
+    if isinstance(result, ios_errors.SimError):
+      errors.append(result)
+    elif isinstance(result, BaseException):
+      raise result
+    else:
+      simulators.append(result)
+  for error in errors:
+    logging.warning('Failed to bring up simulator: %s', error)
+  if count and not simulators:
+    raise ios_errors.SimError('Failed to bring up any of %d simulators: %s' %
+                              (count, errors[0]))
+  return simulators
+
+
+def CreateAndBootSimulators(count,
+                            device_type=None,
+                            os_version=None,
+                            name_prefix=None,
+                            limiter=None):
+  """Blocking wrapper of CreateAndBootSimulatorsAsync."""
+  return asyncio.run(
+      CreateAndBootSimulatorsAsync(count, device_type, os_version, name_prefix,
+                                   limiter))
+
+
+async def _BringUpSimulator(device_type, os_version, name_prefix, limiter):
+  """Creates and boots one simulator within a limiter slot."""
+  last_error = None
+  for _ in range(_BRING_UP_MAX_ATTEMPTS):
+    interrupted = []
+
+    def _OnInterrupted():
+      interrupted.append(True)
+      limiter.OnInterrupted()
+
+    await limiter.Acquire()
+    simulator_obj = None
+    try:
+      simulator_id, created_type, created_version, name = (
+          await simulator_aio.CreateNewSimulator(
+              device_type=device_type,
+              os_version=os_version,
+              name_prefix=name_prefix,
+              on_interrupted=_OnInterrupted))
+      simulator_obj = simulator_aio.AsyncSimulator(simulator_id,
+                                                   _OnInterrupted)
+      await simulator_obj.Boot()
+    except ios_errors.SimError as e:
+      last_error = e
+      if simulator_obj:
+        try:
+          await simulator_obj.Delete()
+        except ios_errors.SimError as delete_error:
+          logging.warning('Failed to delete simulator %s: %s', simulator_id,
+                          delete_error)
+      if not interrupted:
+        raise
+      continue
+    finally:
+      await limiter.Release()
+    await limiter.OnSuccess()
+    return simulator_id, created_type, created_version, name
+  raise last_error
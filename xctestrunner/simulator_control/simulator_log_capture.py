@@ -0,0 +1,209 @@
+# Copyright 2017 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Captures the simulator log during the test by `log stream`.
+
+Unlike Simulator.FetchLogToFile, which runs `log show` after the test, the
+capture streams the log while the test is running and compresses it on the
+fly. The compressed log is split into segments. When the total size of the
+segments exceeds the cap, the oldest segment is dropped, so the capture keeps
+the latest log like a ring buffer.
+"""
+
+import gzip
+import logging
+import os
+import subprocess
+import threading
+
+from xctestrunner.shared import xcode_info_util
+
+try:
+  import zstandard  # pylint: disable=g-import-not-at-top
+except ImportError:
+  zstandard = None
+
+DEFAULT_MAX_SIZE_BYTES = 64 * 1024 * 1024
+DEFAULT_SEGMENT_COUNT = 4
+_LOG_FILE_NAME_PREFIX = 'simulator_log'
+_READ_SIZE = 64 * 1024
+_STOP_TIMEOUT_SEC = 5
+# The fast levels, so compressing keeps up with a chatty simulator. The level
+# of zstd is its default.
+_ZSTD_COMPRESS_LEVEL = 3
+_GZIP_COMPRESS_LEVEL = 1
+
+
+class Compression(object):
+  """The supported compression formats of the captured log."""
+  GZIP = 'gzip'
+  ZSTD = 'zstd'
+
+
+_COMPRESSION_FILE_EXTENSIONS = {
+    Compression.GZIP: 'gz',
+    Compression.ZSTD: 'zst',
+}
+
+
+class SimulatorLogCapture(object):
+  """Streams the simulator log into size-capped compressed segments.
+
+  Usage:
+    with SimulatorLogCapture(simulator_id, output_dir) as capture:
+      RunTest()
+    logging.info('Simulator log: %s', capture.segment_paths)
+  """
+
+  def __init__(self,
+               simulator_id,
+               output_dir,
+               predicate=None,
+               max_size_bytes=DEFAULT_MAX_SIZE_BYTES,
+               segment_count=DEFAULT_SEGMENT_COUNT,
+               compression=Compression.GZIP):
+    """Initializes the SimulatorLogCapture object.
+
+    Args:
+      simulator_id: string, the id of the booted simulator.
+      output_dir: string, the directory to save the compressed log segments.
+      predicate: string, the predicate of `log stream` to filter the log. None
+        means capturing all the log.
+      max_size_bytes: int, the max total size of the compressed segments.
+      segment_count: int, the number of segments kept in the ring buffer.
+      compression: Compression, the compression format. If zstd is requested
+        but the zstandard module is not available, gzip is used.
+    """
+    self._simulator_id = simulator_id
+    self._output_dir = output_dir
+    self._predicate = predicate
+    self._segment_max_size_bytes = max(1, max_size_bytes // segment_count)
+    self._segment_count = segment_count
+    if compression == Compression.ZSTD and zstandard is None:
+      logging.warning('The zstandard module is not available. Will compress '
+                      'the simulator log by gzip.')
+      compression = Compression.GZIP
+    self._compression = compression
+    self._process = None
+    self._thread = None
+    self._segment_paths = []
+    self._segment_index = 0
+    self._raw_file = None
+    self._writer = None
+    self._dropped_segment_count = 0
+
+  def __enter__(self):
+    self.Start()
+    return self
+
+  def __exit__(self, unused_type, unused_value, unused_traceback):
+    self.Stop()
+
+  @property
+  def segment_paths(self):
+    """Gets the paths of the kept segments, from the oldest to the latest."""
+    return list(self._segment_paths)
+
+  @property
+  def dropped_segment_count(self):
+    """Gets the number of the oldest segments dropped for the size cap."""
+    return self._dropped_segment_count
+
+  def Start(self):
+    """Starts streaming the simulator log."""
+    command = [
+        'xcrun', 'simctl', 'spawn', self._simulator_id, 'log', 'stream',
+        '--style', 'syslog'
+    ]
+    if self._predicate:
+      command.extend(('--predicate', self._predicate))
+    if not os.path.exists(self._output_dir):
+      os.makedirs(self._output_dir)
+    self._process = subprocess.Popen(
+        xcode_info_util.ResolveXcrunCommand(command),
+        stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL)
+    self._thread = threading.Thread(target=self._Capture)
+    self._thread.daemon = True
+    self._thread.start()
+    logging.info('Started streaming the log of simulator %s.',
+                 self._simulator_id)
+
+  def Stop(self):
+    """Stops streaming and flushes the compressed log. It is idempotent."""
+    if self._process is None:
+      return
+    if self._process.poll() is None:
+      self._process.terminate()
+      try:
+        self._process.wait(timeout=_STOP_TIMEOUT_SEC)
+      except subprocess.TimeoutExpired:
+        self._process.kill()
+        self._process.wait()
+    self._thread.join()
+    self._process = None
+    self._thread = None
+    logging.info('Stopped streaming the log of simulator %s to %s.',
+                 self._simulator_id, self._output_dir)
+
+  def _Capture(self):
+    """Compresses the stream into the segments until the stream ends."""
+    fd = self._process.stdout.fileno()
+    try:
+      self._OpenNextSegment()
+      while True:
+        data = os.read(fd, _READ_SIZE)
+        if not data:
+          break
+        self._writer.write(data)
+        if self._raw_file.tell() >= self._segment_max_size_bytes:
+          self._CloseSegment()
+          self._OpenNextSegment()
+    except (OSError, ValueError) as e:
+      logging.warning('Failed to capture the log of simulator %s: %s',
+                      self._simulator_id, e)
+    finally:
+      self._CloseSegment()
+      self._process.stdout.close()
+
+  def _OpenNextSegment(self):
+    """Opens a new segment and drops the oldest ones over the cap."""
+    segment_path = os.path.join(
+        self._output_dir, '%s.%03d.log.%s' %
+        (_LOG_FILE_NAME_PREFIX, self._segment_index,
+         _COMPRESSION_FILE_EXTENSIONS[self._compression]))
+    self._segment_index += 1
+    self._raw_file = open(segment_path, 'wb')
+    if self._compression == Compression.ZSTD:
+      self._writer = zstandard.ZstdCompressor(
+          level=_ZSTD_COMPRESS_LEVEL).stream_writer(
+              self._raw_file, closefd=False)
+    else:
+      self._writer = gzip.GzipFile(
+          fileobj=self._raw_file, mode='wb',
+          compresslevel=_GZIP_COMPRESS_LEVEL)
+    self._segment_paths.append(segment_path)
+    while len(self._segment_paths) > self._segment_count:
+      oldest_path = self._segment_paths.pop(0)
+      os.remove(oldest_path)
+      self._dropped_segment_count += 1
+
+  def _CloseSegment(self):
+    """Finishes the compressed stream of the current segment."""
+    if self._writer is not None:
+      self._writer.close()
+      self._writer = None
+    if self._raw_file is not None:
+      self._raw_file.close()
+      self._raw_file = None
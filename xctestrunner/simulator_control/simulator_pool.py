@@ -0,0 +1,396 @@
+# Copyright 2017 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""The pool of warm simulators which are leased to test sessions.
+
+Creating, booting and deleting a simulator per test session costs tens of
+seconds. The pool keeps pre-created and pre-booted simulators per
+(device_type, os_version) and leases them to test sessions. When a lease is
+returned, the simulator is erased and booted again instead of being deleted.
+
+The pool state is stored in a json file under the cache directory and guarded by
+a file lock. So several runner processes on the same host share the same pool.
+"""
+
+import json
+import logging
+import os
+import time
+
+from xctestrunner.shared import cache_util
+from xctestrunner.shared import ios_constants
+from xctestrunner.shared import ios_errors
+from xctestrunner.shared import plist_util
+from xctestrunner.simulator_control import golden_simulator
+from xctestrunner.simulator_control import simulator_fanout
+from xctestrunner.simulator_control import simulator_reaper
+from xctestrunner.simulator_control import simulator_util
+
+DEFAULT_POOL_SIZE = 2
+DEFAULT_IDLE_TIMEOUT_SEC = 60 * 60
+DEFAULT_MAX_AGE_SEC = 24 * 60 * 60
+_POOL_CACHE_NAME = 'simulator_pool'
+_POOL_STATE_FILE_NAME = 'pool.json'
+_POOL_LOCK_FILE_NAME = 'pool.lock'
+_POOL_FILL_LOCK_FILE_NAME = 'fill.lock'
+_POOL_SIMULATOR_NAME_PREFIX = 'Pool'
+
+
+class SimulatorLease(object):
+  """The lease of a simulator from the pool."""
+
+  def __init__(self, simulator_id, device_type, os_version, name):
+    """Constructor of SimulatorLease object.
+
+    Args:
+      simulator_id: string, the id of the leased simulator.
+      device_type: string, the device type of the leased simulator.
+      os_version: string, the OS version of the leased simulator.
+      name: string, the name of the leased simulator.
+    """
+    self.simulator_id = simulator_id
+    self.device_type = device_type
+    self.os_version = os_version
+    self.name = name
+
+
+class SimulatorPool(object):
+  """The pool of warm simulators shared by the runner processes on the host."""
+
+  def __init__(self,
+               pool_size=DEFAULT_POOL_SIZE,
+               idle_timeout_sec=DEFAULT_IDLE_TIMEOUT_SEC,
+               max_age_sec=DEFAULT_MAX_AGE_SEC,
+               pool_dir=None,
+               clone_from_golden=False):
+    """Constructor of SimulatorPool object.
+
+    Args:
+      pool_size: int, the max number of simulators kept per (device_type,
+        os_version).
+      idle_timeout_sec: int, the simulator which is not leased in the given
+        seconds will be deleted.
+      max_age_sec: int, the simulator which was created before the given
+        seconds will be deleted instead of being reset when it is returned.
+      pool_dir: string, the directory to store the pool state. By default, it is
+        under the cache directory of test runner.
+      clone_from_golden: bool, whether the new simulators are cloned from the
+        golden simulator. See golden_simulator for details.
+    """
+    self._pool_size = pool_size
+    self._idle_timeout_sec = idle_timeout_sec
+    self._max_age_sec = max_age_sec
+    self._pool_dir = pool_dir or cache_util.GetCacheDir(_POOL_CACHE_NAME)
+    self._state_file_path = os.path.join(self._pool_dir, _POOL_STATE_FILE_NAME)
+    self._lock_file_path = os.path.join(self._pool_dir, _POOL_LOCK_FILE_NAME)
+    self._fill_lock_file_path = os.path.join(self._pool_dir,
+                                             _POOL_FILL_LOCK_FILE_NAME)
+    self._clone_from_golden = clone_from_golden
+
+  def Lease(self, device_type=None, os_version=None):
+    """Leases a booted simulator from the pool.
+
+    If there is no idle simulator matching the arguments in the pool, a new
+    simulator will be created and booted.
+
+    Args:
+      device_type: string, device type of the simulator. See
+        simulator_util.CreateNewSimulator for details.
+      os_version: string, OS version of the simulator. See
+        simulator_util.CreateNewSimulator for details.
+
+    Returns:
+      a SimulatorLease object.
+
+    Raises:
+      ios_errors.SimError: when failed to create or boot the simulator.
+      ios_errors.IllegalArgumentError: when the given argument is invalid.
+    """
+    device_type, os_version = simulator_util.ResolveSimulatorTypeAndOsVersion(
+        device_type, os_version)
+    self.Evict()
+    with cache_util.FileLock(self._lock_file_path):
+      entries = self._LoadEntries()
+      simulator_id = None
+      for candidate_id, candidate in entries.items():
+        if (candidate['device_type'] == device_type and
+            candidate['os_version'] == os_version and
+            not _IsLeaseAlive(candidate)):
+          simulator_id = candidate_id
+          break
+      if simulator_id:
+        entry = entries[simulator_id]
+        need_reset = entry['leased_by_pid'] is not None
+        entry['leased_by_pid'] = os.getpid()
+        entry['last_used_time'] = time.time()
+        self._SaveEntries(entries)
+
+    if simulator_id:
+      logging.info('Leased simulator %s from the pool.', simulator_id)
+      try:
+        # The previous lease holder exited without returning the simulator.
+        if need_reset:
+          _ResetSimulator(simulator_util.Simulator(simulator_id))
+        else:
+          _EnsureBooted(simulator_util.Simulator(simulator_id))
+      except ios_errors.SimError as e:
+        logging.warning('The pooled simulator %s is broken: %s. Will lease '
+                        'a new one.', simulator_id, str(e))
+        self._Discard(simulator_id)
+        return self.Lease(device_type, os_version)
+      return SimulatorLease(simulator_id, device_type, os_version,
+                            entry['name'])
+
+    simulator_id, name = self._CreatePooledSimulator(device_type, os_version)
+    return SimulatorLease(simulator_id, device_type, os_version, name)
+
+  def Return(self, lease, discard=False):
+    """Returns the leased simulator to the pool.
+
+    The simulator will be erased and booted again, so the next lease gets a
+    clean simulator. If the pool is full, the simulator reaches the max age or
+    discard is True, the simulator will be deleted.
+
+    Args:
+      lease: SimulatorLease, the lease to return.
+      discard: bool, whether the simulator should be deleted instead of being
+        reset, e.g., the simulator is broken in the test session.
+    """
+    with cache_util.FileLock(self._lock_file_path):
+      entries = self._LoadEntries()
+      entry = entries.get(lease.simulator_id)
+      # The simulators being reset by the other returns hold their slots.
+      idle_count = len([
+          e for e in entries.values()
+          if e['device_type'] == lease.device_type and
+          e['os_version'] == lease.os_version and
+          (not _IsLeaseAlive(e) or e.get('resetting'))
+      ])
+      keep = not (
+          discard or entry is None or idle_count >= self._pool_size or
+          time.time() - entry['created_time'] > self._max_age_sec)
+      if keep:
+        # Reserves the slot before releasing the lock, so the concurrent
+        # returns do not overfill the pool.
+        entry['resetting'] = True
+        self._SaveEntries(entries)
+    if not keep:
+      self._Discard(lease.simulator_id)
+      return
+
+    try:
+      _ResetSimulator(simulator_util.Simulator(lease.simulator_id))
+    except ios_errors.SimError as e:
+      logging.warning('Failed to reset simulator %s: %s', lease.simulator_id,
+                      str(e))
+      self._Discard(lease.simulator_id)
+      return
+    with cache_util.FileLock(self._lock_file_path):
+      entries = self._LoadEntries()
+      if lease.simulator_id in entries:
+        entry = entries[lease.simulator_id]
+        entry.pop('resetting', None)
+        entry['leased_by_pid'] = None
+        entry['last_used_time'] = time.time()
+        self._SaveEntries(entries)
+    logging.info('Returned simulator %s to the pool.', lease.simulator_id)
+    logging.debug('The plist parse cache stats: %s',
+                  plist_util.GetParseCacheStats())
+
+  def Fill(self, device_type=None, os_version=None):
+    """Pre-creates and boots simulators until the pool size is reached.
+
+    The leased simulators of the type count toward the pool size, since they
+    are reset and kept when returned. The missing simulators are brought up in
+    parallel.
+
+    Args:
+      device_type: string, device type of the simulator. See
+        simulator_util.CreateNewSimulator for details.
+      os_version: string, OS version of the simulator. See
+        simulator_util.CreateNewSimulator for details.
+    """
+    device_type, os_version = simulator_util.ResolveSimulatorTypeAndOsVersion(
+        device_type, os_version)
+    # Only one process fills the pool at a time. The others wait and then find
+    # the pool filled.
+    with cache_util.FileLock(self._fill_lock_file_path):
+      self._Fill(device_type, os_version)
+
+  def _Fill(self, device_type, os_version):
+    """Fills the pool. The caller should hold the fill lock."""
+    with cache_util.FileLock(self._lock_file_path):
+      existing_count = len([
+          e for e in self._LoadEntries().values()
+          if e['device_type'] == device_type and e['os_version'] == os_version
+      ])
+    missing_count = self._pool_size - existing_count
+    if missing_count <= 0:
+      return
+    if self._clone_from_golden:
+      # Cloning is fast, so the clones are not fanned out.
+      for _ in range(missing_count):
+        simulator_id, _ = self._CreatePooledSimulator(device_type, os_version)
+        with cache_util.FileLock(self._lock_file_path):
+          entries = self._LoadEntries()
+          if simulator_id in entries:
+            entries[simulator_id]['leased_by_pid'] = None
+            self._SaveEntries(entries)
+      return
+    simulators = simulator_fanout.CreateAndBootSimulators(
+        missing_count,
+        device_type=device_type,
+        os_version=os_version,
+        name_prefix=_POOL_SIMULATOR_NAME_PREFIX)
+    now = time.time()
+    with cache_util.FileLock(self._lock_file_path):
+      entries = self._LoadEntries()
+      for simulator_id, _, _, name in simulators:
+        entries[simulator_id] = {
+            'device_type': device_type,
+            'os_version': os_version,
+            'name': name,
+            'created_time': now,
+            'last_used_time': now,
+            'leased_by_pid': None,
+        }
+      self._SaveEntries(entries)
+    for simulator_id, _, _, _ in simulators:
+      simulator_reaper.WriteOwnerMarker(simulator_id, persistent=True)
+
+  def Evict(self):
+    """Deletes the idle simulators which reach the idle timeout or max age."""
+    now = time.time()
+    evicted_ids = []
+    with cache_util.FileLock(self._lock_file_path):
+      entries = self._LoadEntries()
+      for simulator_id, entry in list(entries.items()):
+        if not os.path.exists(
+            simulator_util.Simulator(simulator_id).simulator_root_dir):
+          # The simulator was deleted outside the pool.
+          del entries[simulator_id]
+          continue
+        if _IsLeaseAlive(entry):
+          continue
+        if (now - entry['last_used_time'] > self._idle_timeout_sec or
+            now - entry['created_time'] > self._max_age_sec):
+          del entries[simulator_id]
+          evicted_ids.append(simulator_id)
+      self._SaveEntries(entries)
+    for simulator_id in evicted_ids:
+      logging.info('Evicting simulator %s from the pool.', simulator_id)
+      _DeleteSimulator(simulator_util.Simulator(simulator_id))
+
+  def _CreatePooledSimulator(self, device_type, os_version):
+    """Creates and boots a new simulator which is leased by this process.
+
+    Args:
+      device_type: string, the resolved device type of the simulator.
+      os_version: string, the resolved OS version of the simulator.
+
+    Returns:
+      a tuple with two items:
+        string, id of the new simulator.
+        string, name of the new simulator.
+    """
+    if self._clone_from_golden:
+      create_simulator = golden_simulator.CreateNewSimulatorFromGolden
+    else:
+      create_simulator = simulator_util.CreateNewSimulator
+    simulator_id, _, _, name = create_simulator(
+        device_type=device_type,
+        os_version=os_version,
+        name_prefix=_POOL_SIMULATOR_NAME_PREFIX)
+    now = time.time()
+    with cache_util.FileLock(self._lock_file_path):
+      entries = self._LoadEntries()
+      entries[simulator_id] = {
+          'device_type': device_type,
+          'os_version': os_version,
+          'name': name,
+          'created_time': now,
+          'last_used_time': now,
+          'leased_by_pid': os.getpid(),
+      }
+      self._SaveEntries(entries)
+    simulator_reaper.WriteOwnerMarker(simulator_id, persistent=True)
+    try:
+      simulator_util.Simulator(simulator_id).Boot()
+    except ios_errors.SimError:
+      self._Discard(simulator_id)
+      raise
+    return simulator_id, name
+
+  def _Discard(self, simulator_id):
+    """Removes the simulator from the pool and deletes it."""
+    with cache_util.FileLock(self._lock_file_path):
+      entries = self._LoadEntries()
+      entries.pop(simulator_id, None)
+      self._SaveEntries(entries)
+    _DeleteSimulator(simulator_util.Simulator(simulator_id))
+
+  def _LoadEntries(self):
+    """Loads the pool entries. The caller should hold the pool lock."""
+    if not os.path.exists(self._state_file_path):
+      return {}
+    with open(self._state_file_path) as state_file:
+      try:
+        return json.load(state_file)
+      except ValueError:
+        logging.warning('The simulator pool state file %s is broken. Will '
+                        'reset it.', self._state_file_path)
+        return {}
+
+  def _SaveEntries(self, entries):
+    """Saves the pool entries. The caller should hold the pool lock."""
+    temp_file_path = self._state_file_path + '.tmp'
+    with open(temp_file_path, 'w') as state_file:
+      json.dump(entries, state_file, indent=2, sort_keys=True)
+    os.rename(temp_file_path, self._state_file_path)
+
+
+def _IsLeaseAlive(entry):
+  """Checks if the simulator of the pool entry is leased by a live process."""
+  pid = entry.get('leased_by_pid')
+  if pid is None:
+    return False
+  try:
+    os.kill(pid, 0)
+  except ProcessLookupError:
+    return False
+  except PermissionError:
+    return True
+  return True
+
+
+def _EnsureBooted(simulator_obj):
+  """Boots the simulator if it is not booted."""
+  if simulator_obj.GetSimulatorState() != ios_constants.SimState.BOOTED:
+    simulator_obj.Boot()
+
+
+def _ResetSimulator(simulator_obj):
+  """Erases the simulator and boots it again."""
+  simulator_obj.Shutdown()
+  simulator_obj.Erase()
+  simulator_obj.Boot()
+
+
+def _DeleteSimulator(simulator_obj):
+  """Deletes the simulator. Errors are only logged."""
+  simulator_id = simulator_obj.simulator_id
+  try:
+    simulator_obj.Delete()
+  except ios_errors.SimError as e:
+    logging.warning('Failed to delete simulator %s: %s', simulator_id, str(e))
@@ -0,0 +1,370 @@
+# Copyright 2017 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""The background reaper which deletes simulators and reclaims orphans.
+
+Every simulator created by the test runner gets an owner marker file under the
+cache directory, which records the pid of the owner process. The marker is only
+removed after the simulator is confirmed deleted. So the simulators leaked by a
+crashed runner process, or whose deletion failed, are found by the orphan scan
+of a later runner process and reclaimed together with their log directories.
+
+The simulators owned by the simulator pool or the golden simulators are marked
+persistent and never reclaimed as orphans.
+"""
+
+import json
+import logging
+import os
+import pwd
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+
+from xctestrunner.shared import cache_util
+from xctestrunner.shared import ios_constants
+from xctestrunner.shared import xcode_info_util
+
+DEFAULT_MAX_CONCURRENCY = 4
+DEFAULT_MAX_ATTEMPTS = 3
+DEFAULT_ORPHAN_NAME_PREFIXES = ('New',)
+_OWNER_MARKERS_CACHE_NAME = 'simulator_owners'
+_DELETE_RETRY_INTERVAL_SEC = 2
+# The owner markers of the simulators which are not listed are only dropped
+# when they are older than this, since the marker is written right after the
+# simulator is created and the listing may be taken in between.
+_MARKER_GRACE_PERIOD_SEC = 300
+
+
+class DeletionOutcome(object):
+  """The outcomes of the deletion in the reaper."""
+  PENDING = 'pending'
+  DELETED = 'deleted'
+  FAILED = 'failed'
+
+
+class SimulatorReaper(object):
+  """The bounded-concurrency deletion queue of simulators."""
+
+  def __init__(self,
+               max_concurrency=DEFAULT_MAX_CONCURRENCY,
+               max_attempts=DEFAULT_MAX_ATTEMPTS):
+    """Initializes the SimulatorReaper object.
+
+    Args:
+      max_concurrency: int, the max number of deletions running at once.
+      max_attempts: int, the max attempts to delete one simulator.
+    """
+    self._max_attempts = max_attempts
+    # Held by every running `simctl delete` process, including the retries.
+    self._semaphore = threading.BoundedSemaphore(max_concurrency)
+    self._lock = threading.Lock()
+    self._outcomes = {}
+    self._reclaim_threads = []
+
+  @property
+  def outcomes(self):
+    """Gets a dict of simulator id to its DeletionOutcome."""
+    with self._lock:
+      return dict(self._outcomes)
+
+  def Submit(self, simulator_id):
+    """Starts deleting the simulator in background.
+
+    The `simctl delete` process is started before returning, in its own process
+    group, so it finishes even if the runner process exits right after. It
+    blocks while max_concurrency deletions are running. The retries run in a
+    background thread, which only lives as long as the runner process. The
+    owner marker is kept until the deletion is confirmed, so the simulators
+    failed to delete are reclaimed by a later runner process.
+
+    Args:
+      simulator_id: string, the id of the simulator.
+    """
+    with self._lock:
+      if self._outcomes.get(simulator_id) == DeletionOutcome.PENDING:
+        return
+      self._outcomes[simulator_id] = DeletionOutcome.PENDING
+    self._semaphore.acquire()
+    try:
+      attempt = _DeleteAttempt(simulator_id)
+    except OSError as e:
+      self._semaphore.release()
+      logging.warning('Failed to start deleting simulator %s: %s',
+                      simulator_id, e)
+      attempt = None
+    worker = threading.Thread(
+        target=self._RunWorker, args=(simulator_id, attempt))
+    worker.daemon = True
+    worker.start()
+
+  def Wait(self, timeout_sec=None):
+    """Waits until the orphan scans and all the submitted deletions finish.
+
+    Args:
+      timeout_sec: float, the max seconds to wait. None means no limit.
+
+    Returns:
+      True if all of them finished, False if it is timeout.
+    """
+    deadline = None if timeout_sec is None else time.time() + timeout_sec
+    while True:
+      with self._lock:
+        self._reclaim_threads = [
+            t for t in self._reclaim_threads if t.is_alive()]
+        if (not self._reclaim_threads and
+            DeletionOutcome.PENDING not in self._outcomes.values()):
+          return True
+      if deadline is not None and time.time() >= deadline:
+        return False
+      time.sleep(0.1)
+
+  def ReclaimOrphans(self, name_prefixes=DEFAULT_ORPHAN_NAME_PREFIXES):
+    """Scans the simulators leaked by dead runner processes and deletes them.
+
+    A simulator is an orphan when its name starts with one of the prefixes, it
+    has a non-persistent owner marker and the owner process is dead.
+
+    Args:
+      name_prefixes: a list of string, the name prefixes of the simulators
+        created by the test runner.
+
+    Returns:
+      a list of string, the ids of the orphan simulators queued for deletion.
+    """
+    list_time = time.time()
+    try:
+      output = subprocess.check_output(
+          xcode_info_util.ResolveXcrunCommand(
+              ['xcrun', 'simctl', 'list', 'devices', '-j']),
+          stderr=subprocess.DEVNULL).decode('utf-8')
+      devices_by_runtime = json.loads(output)['devices']
+    except (OSError, subprocess.CalledProcessError, ValueError, KeyError) as e:
+      logging.warning('Failed to list simulators to reclaim orphans: %s', e)
+      return []
+    existing_ids = set()
+    orphan_ids = []
+    for devices in devices_by_runtime.values():
+      for device in devices:
+        simulator_id = device['udid']
+        existing_ids.add(simulator_id)
+        if not any(device['name'].startswith(prefix + '-')
+                   for prefix in name_prefixes):
+          continue
+        marker = _ReadOwnerMarker(simulator_id)
+        if (marker is None or marker.get('persistent') or
+            _IsProcessAlive(marker.get('pid'))):
+          continue
+        orphan_ids.append(simulator_id)
+    # Drops the markers of the simulators which were deleted outside the
+    # reaper, e.g., by the reaper of an exited process. The marker of a
+    # simulator created after the listing is not listed either, so only the
+    # old markers of the dead owners are dropped.
+    markers_dir = cache_util.GetCacheDir(_OWNER_MARKERS_CACHE_NAME)
+    for marker_file_name in os.listdir(markers_dir):
+      simulator_id, ext = os.path.splitext(marker_file_name)
+      if ext != '.json' or simulator_id in existing_ids:
+        continue
+      try:
+        marker_time = os.path.getmtime(
+            os.path.join(markers_dir, marker_file_name))
+      except OSError:
+        continue
+      if marker_time > list_time - _MARKER_GRACE_PERIOD_SEC:
+        continue
+      marker = _ReadOwnerMarker(simulator_id)
+      if marker is None or _IsProcessAlive(marker.get('pid')):
+        continue
+      logging.info('Dropping the owner marker of deleted simulator %s.',
+                   simulator_id)
+      RemoveOwnerMarker(simulator_id)
+      _RemoveSimulatorLogDir(simulator_id)
+    for simulator_id in orphan_ids:
+      logging.info('Reclaiming orphan simulator %s.', simulator_id)
+      self.Submit(simulator_id)
+    return orphan_ids
+
+  def StartReclaimingOrphans(self, name_prefixes=DEFAULT_ORPHAN_NAME_PREFIXES):
+    """Runs ReclaimOrphans in a background thread.
+
+    So the scan does not delay the startup of the test runner. Wait also waits
+    for the scan.
+    """
+    thread = threading.Thread(
+        target=self.ReclaimOrphans, args=(name_prefixes,))
+    thread.daemon = True
+    with self._lock:
+      self._reclaim_threads.append(thread)
+    thread.start()
+
+  def _RunWorker(self, simulator_id, attempt):
+    """Waits for the deletion of the simulator and retries on failure."""
+    try:
+      deleted = self._WaitAndRetry(simulator_id, attempt)
+    except OSError as e:
+      logging.warning('Failed to delete simulator %s: %s', simulator_id, e)
+      deleted = False
+    with self._lock:
+      self._outcomes[simulator_id] = (
+          DeletionOutcome.DELETED if deleted else DeletionOutcome.FAILED)
+
+  def _WaitAndRetry(self, simulator_id, attempt):
+    """Waits for the started deletion and retries it on failure.
+
+    Args:
+      simulator_id: string, the id of the simulator.
+      attempt: _DeleteAttempt, the started deletion which holds the
+        semaphore, or None if it failed to start.
+
+    Returns:
+      True if the simulator is deleted.
+    """
+    for i in range(self._max_attempts):
+      if attempt is None:
+        self._semaphore.acquire()
+        try:
+          attempt = _DeleteAttempt(simulator_id)
+        except OSError:
+          self._semaphore.release()
+          raise
+      try:
+        returncode, output = attempt.Wait()
+      finally:
+        self._semaphore.release()
+        attempt = None
+      if returncode == 0 or 'Invalid device' in output:
+        _RemoveSimulatorLogDir(simulator_id)
+        RemoveOwnerMarker(simulator_id)
+        logging.info('Deleted simulator %s.', simulator_id)
+        return True
+      logging.warning('Failed to delete simulator %s in attempt %d: %s',
+                      simulator_id, i + 1, output)
+      if 'current state: Booted' in output:
+        # The orphan simulators may be left booted by the crashed runner.
+        subprocess.call(xcode_info_util.ResolveXcrunCommand(
+            ['xcrun', 'simctl', 'shutdown', simulator_id]),
+                        stdout=subprocess.DEVNULL,
+                        stderr=subprocess.DEVNULL)
+        continue
+      if (i < self._max_attempts - 1 and
+          ios_constants.CORESIMULATOR_INTERRUPTED_ERROR not in output):
+        time.sleep(_DELETE_RETRY_INTERVAL_SEC)
+    return False
+
+
+class _DeleteAttempt(object):
+  """The detached `simctl delete` process of one attempt."""
+
+  def __init__(self, simulator_id):
+    # The deletion runs in its own process group and writes its output to an
+    # unlinked file instead of a pipe, so it still finishes if the runner
+    # process exits in the middle.
+    self._output_file = tempfile.TemporaryFile(mode='w+')
+    try:
+      self._process = subprocess.Popen(
+          xcode_info_util.ResolveXcrunCommand(
+              ['xcrun', 'simctl', 'delete', simulator_id]),
+          stdout=self._output_file,
+          stderr=subprocess.STDOUT,
+          preexec_fn=os.setpgrp)
+    except OSError:
+      self._output_file.close()
+      raise
+
+  def Wait(self):
+    """Waits for the process. Returns a tuple of returncode and output."""
+    try:
+      returncode = self._process.wait()
+      self._output_file.seek(0)
+      return returncode, self._output_file.read().strip()
+    finally:
+      self._output_file.close()
+
+
+_reaper = None
+_reaper_lock = threading.Lock()
+
+
+def GetReaper():
+  """Gets the process wide SimulatorReaper object."""
+  global _reaper
+  with _reaper_lock:
+    if _reaper is None:
+      _reaper = SimulatorReaper()
+    return _reaper
+
+
+def WriteOwnerMarker(simulator_id, persistent=False):
+  """Marks the simulator as owned by the current process.
+
+  Args:
+    simulator_id: string, the id of the simulator.
+    persistent: bool, whether the simulator outlives the current process, e.g.,
+      the pooled simulators and the golden simulators.
+  """
+  marker_path = _GetOwnerMarkerPath(simulator_id)
+  temp_marker_path = marker_path + '.tmp'
+  with open(temp_marker_path, 'w') as marker_file:
+    json.dump({
+        'pid': os.getpid(),
+        'persistent': persistent,
+        'created_time': time.time(),
+    }, marker_file)
+  os.rename(temp_marker_path, marker_path)
+
+
+def RemoveOwnerMarker(simulator_id):
+  """Removes the owner marker of the simulator."""
+  try:
+    os.remove(_GetOwnerMarkerPath(simulator_id))
+  except OSError:
+    pass
+
+
+def _ReadOwnerMarker(simulator_id):
+  """Reads the owner marker of the simulator or None if it does not exist."""
+  try:
+    with open(_GetOwnerMarkerPath(simulator_id)) as marker_file:
+      return json.load(marker_file)
+  except (OSError, ValueError):
+    return None
+
+
+def _GetOwnerMarkerPath(simulator_id):
+  return os.path.join(
+      cache_util.GetCacheDir(_OWNER_MARKERS_CACHE_NAME),
+      '%s.json' % simulator_id)
+
+
+def _RemoveSimulatorLogDir(simulator_id):
+  """Removes the CoreSimulator log directory of the simulator."""
+  home_dir = pwd.getpwuid(os.geteuid()).pw_dir
+  log_dir = os.path.join(home_dir, 'Library/Logs/CoreSimulator', simulator_id)
+  if os.path.exists(log_dir):
+    shutil.rmtree(log_dir, ignore_errors=True)
+
+
+def _IsProcessAlive(pid):
+  """Checks if the process with the given pid is alive."""
+  if pid is None:
+    return False
+  try:
+    os.kill(pid, 0)
+  except ProcessLookupError:
+    return False
+  except PermissionError:
+    return True
+  return True
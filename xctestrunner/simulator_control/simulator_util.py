@@ -20,13 +20,25 @@ import pwd
 import re
 import shutil
 import subprocess
+import threading
 import time
 
+from xctestrunner.shared import file_watcher
 from xctestrunner.shared import ios_constants
 from xctestrunner.shared import ios_errors
 from xctestrunner.shared import plist_util
 from xctestrunner.shared import xcode_info_util
 from xctestrunner.simulator_control import simtype_profile
+from xctestrunner.simulator_control import simulator_reaper
+
+# The retries and the timeouts of the simulator operations. They are shared
+# with simulator_aio.
+SIM_OPERATION_MAX_ATTEMPTS = 3
+SIMCTL_MAX_ATTEMPTS = 2
+SIMULATOR_CREATING_TO_SHUTDOWN_TIMEOUT_SEC = 10
+SIMULATOR_BOOTED_TIMEOUT_SEC = 10
+SIMULATOR_SHUTDOWN_TIMEOUT_SEC = 30
+SIM_ERROR_RETRY_INTERVAL_SEC = 2
 
 _SIMULATOR_STATES_MAPPING = {
     0: ios_constants.SimState.CREATING,
@@ -34,13 +46,10 @@ _SIMULATOR_STATES_MAPPING = {
     3: ios_constants.SimState.BOOTED
 }
 _PREFIX_RUNTIME_ID = 'com.apple.CoreSimulator.SimRuntime.'
-_SIM_OPERATION_MAX_ATTEMPTS = 3
-_SIMCTL_MAX_ATTEMPTS = 2
-_SIMULATOR_CREATING_TO_SHUTDOWN_TIMEOUT_SEC = 10
-_SIMULATOR_BOOTED_TIMEOUT_SEC = 10
-_SIMULATOR_SHUTDOWN_TIMEOUT_SEC = 30
-_SIM_ERROR_RETRY_INTERVAL_SEC = 2
 _SIM_CHECK_STATE_INTERVAL_SEC = 0.5
+_SIMCTL_INVENTORY_TTL_SEC = 30
+_SYSTEM_LOG_FOLLOW_INTERVAL_SEC = 0.5
+_SYSTEM_LOG_READ_SIZE = 1024 * 1024
 _PATTERN_APP_CRASH_ON_SIM = (
     r'com\.apple\.CoreSimulator\.SimDevice\.[A-Z0-9\-]+(.+) '
     r'\(UIKitApplication:%s(.+)\): Service exited '
@@ -52,6 +61,72 @@ _PATTERN_XCTEST_PROCESS_CRASH_ON_SIM = (
 _PATTERN_CORESIMULATOR_CRASH = (
     r'com\.apple\.CoreSimulator\.SimDevice\.[A-Z0-9\-]+(.+) '
     r'\(com\.apple\.CoreSimulator(.+)\): Service exited due to ')
+# The text all the crash patterns above contain.
+_SERVICE_EXITED_MARKER = b'Service exited'
+
+
+class SimctlInventory(object):
+  """The cached snapshot of `xcrun simctl list -j`.
+
+  All of device types, runtimes, devices and pairs are fetched by a single
+  simctl call and the queries are answered from memory until the snapshot
+  expires or is invalidated.
+  """
+
+  def __init__(self, ttl_sec=_SIMCTL_INVENTORY_TTL_SEC):
+    """Constructor of SimctlInventory object.
+
+    Args:
+      ttl_sec: int, seconds before the snapshot is considered stale.
+    """
+    self._ttl_sec = ttl_sec
+    self._snapshot = None
+    self._fetched_time = None
+    self._lock = threading.Lock()
+
+  @property
+  def devicetypes(self):
+    """Gets the list of device type infos in `simctl list -j`."""
+    return self._GetSnapshot().get('devicetypes', [])
+
+  @property
+  def runtimes(self):
+    """Gets the list of runtime infos in `simctl list -j`."""
+    return self._GetSnapshot().get('runtimes', [])
+
+  @property
+  def devices(self):
+    """Gets the dict of runtime id to device infos in `simctl list -j`."""
+    return self._GetSnapshot().get('devices', {})
+
+  @property
+  def pairs(self):
+    """Gets the dict of pair id to pair infos in `simctl list -j`."""
+    return self._GetSnapshot().get('pairs', {})
+
+  def Invalidate(self):
+    """Drops the snapshot. The next query will run simctl again."""
+    with self._lock:
+      self._snapshot = None
+      self._fetched_time = None
+
+  def _GetSnapshot(self):
+    """Gets the snapshot and refreshes it if it is missing or stale."""
+    with self._lock:
+      if (self._snapshot is None or
+          time.time() - self._fetched_time > self._ttl_sec):
+        self._snapshot = json.loads(
+            RunSimctlCommand(('xcrun', 'simctl', 'list', '-j')))
+        self._fetched_time = time.time()
+      return self._snapshot
+
+
+_simctl_inventory = SimctlInventory()
+
+
+def GetSimctlInventory():
+  """Gets the process wide SimctlInventory object."""
+  return _simctl_inventory
 
 
 class Simulator(object):
@@ -130,31 +205,58 @@ class Simulator(object):
       A subprocess.Popen object of the boot status process.
     """
     return subprocess.Popen(
-        ['xcrun', 'simctl', 'bootstatus', self.simulator_id, '-b'],
+        xcode_info_util.ResolveXcrunCommand(
+            ['xcrun', 'simctl', 'bootstatus', self.simulator_id, '-b']),
         stdout=subprocess.PIPE,
         stderr=subprocess.PIPE,
         encoding='utf-8')
 
   def Shutdown(self):
     """Shuts down the simulator."""
+    if not self.CheckShutdownNeeded():
+      return
+    try:
+      RunSimctlCommand(['xcrun', 'simctl', 'shutdown', self.simulator_id])
+    except ios_errors.SimError as e:
+      self.HandleShutdownError(e)
+      return
+    self.WaitUntilStateShutdown()
+    logging.info('Shut down simulator %s.', self.simulator_id)
+
+  def CheckShutdownNeeded(self):
+    """Checks whether the simulator should be shut down.
+
+    Returns:
+      True if the shutdown command should run, False if the simulator has
+      already shut down.
+
+    Raises:
+      ios_errors.SimError: when the simulator is in state CREATING.
+    """
     sim_state = self.GetSimulatorState()
     if sim_state == ios_constants.SimState.SHUTDOWN:
       logging.info('Simulator %s has already shut down.', self.simulator_id)
-      return
+      return False
     if sim_state == ios_constants.SimState.CREATING:
       raise ios_errors.SimError(
           'Can not shut down the simulator in state CREATING.')
     logging.info('Shutting down simulator %s.', self.simulator_id)
-    try:
-      RunSimctlCommand(['xcrun', 'simctl', 'shutdown', self.simulator_id])
-    except ios_errors.SimError as e:
-      if 'Unable to shutdown device in current state: Shutdown' in str(e):
-        logging.info('Simulator %s has already shut down.', self.simulator_id)
-        return
-      raise ios_errors.SimError('Failed to shutdown simulator %s: %s' %
-                                (self.simulator_id, str(e)))
-    self.WaitUntilStateShutdown()
-    logging.info('Shut down simulator %s.', self.simulator_id)
+    return True
+
+  def HandleShutdownError(self, error):
+    """Handles the failure of the shutdown command.
+
+    Args:
+      error: ios_errors.SimError, the error of the shutdown command.
+
+    Raises:
+      ios_errors.SimError: unless the simulator has already shut down.
+    """
+    if 'Unable to shutdown device in current state: Shutdown' in str(error):
+      logging.info('Simulator %s has already shut down.', self.simulator_id)
+      return
+    raise ios_errors.SimError('Failed to shutdown simulator %s: %s' %
+                              (self.simulator_id, str(error)))
 
   def Delete(self, asynchronously=True):
     """Deletes the simulator.
@@ -163,30 +265,45 @@ class Simulator(object):
     raise exception.
 
     Args:
-      asynchronously: whether deleting the simulator asynchronously.
+      asynchronously: whether deleting the simulator asynchronously. The
+        asynchronous deletion is queued in the simulator reaper, which retries
+        the failures and removes the simulator log directory.
     Raises:
       ios_errors.SimError: The simulator's state is not SHUTDOWN.
     """
-    command = ['xcrun', 'simctl', 'delete', self.simulator_id]
     if asynchronously:
       logging.info('Deleting simulator %s asynchronously.', self.simulator_id)
-      subprocess.Popen(
-          command,
-          stdout=subprocess.PIPE,
-          stderr=subprocess.PIPE,
-          preexec_fn=os.setpgrp)
+      simulator_reaper.GetReaper().Submit(self.simulator_id)
     else:
+      command = ['xcrun', 'simctl', 'delete', self.simulator_id]
       try:
         RunSimctlCommand(command)
         logging.info('Deleted simulator %s.', self.simulator_id)
       except ios_errors.SimError as e:
         raise ios_errors.SimError('Failed to delete simulator %s: %s' %
                                   (self.simulator_id, str(e)))
-    # The delete command won't delete the simulator log directory.
-    if os.path.exists(self.simulator_log_root_dir):
-      shutil.rmtree(self.simulator_log_root_dir, ignore_errors=True)
+      simulator_reaper.RemoveOwnerMarker(self.simulator_id)
+      # The delete command won't delete the simulator log directory.
+      if os.path.exists(self.simulator_log_root_dir):
+        shutil.rmtree(self.simulator_log_root_dir, ignore_errors=True)
+    GetSimctlInventory().Invalidate()
     self._simulator_id = None
 
+  def Erase(self):
+    """Erases the contents and settings of the simulator.
+
+    The simulator state should be SHUTDOWN when erasing it.
+
+    Raises:
+      ios_errors.SimError: when failed to erase the simulator.
+    """
+    try:
+      RunSimctlCommand(['xcrun', 'simctl', 'erase', self.simulator_id])
+      logging.info('Erased simulator %s.', self.simulator_id)
+    except ios_errors.SimError as e:
+      raise ios_errors.SimError('Failed to erase simulator %s: %s' %
+                                (self.simulator_id, str(e)))
+
   def FetchLogToFile(self, output_file_path, start_time=None, end_time=None):
     """Gets simulator log via running `log` tool on simulator.
 
@@ -248,7 +365,7 @@ class Simulator(object):
     except ios_errors.SimError:
       return False
 
-  def WaitUntilStateBooted(self, timeout_sec=_SIMULATOR_BOOTED_TIMEOUT_SEC):
+  def WaitUntilStateBooted(self, timeout_sec=SIMULATOR_BOOTED_TIMEOUT_SEC):
     """Waits until the simulator state becomes BOOTED.
 
     Args:
@@ -259,15 +376,11 @@ class Simulator(object):
       ios_errors.SimError: when it is timeout to wait the simulator state
           becomes BOOTED.
     """
-    start_time = time.time()
-    while start_time + timeout_sec >= time.time():
-      time.sleep(_SIM_CHECK_STATE_INTERVAL_SEC)
-      if self.GetSimulatorState() == ios_constants.SimState.BOOTED:
-        return
-    raise ios_errors.SimError('Timeout to wait for simulator booted in %ss.' %
-                              timeout_sec)
+    if not self._WaitUntilState(ios_constants.SimState.BOOTED, timeout_sec):
+      raise ios_errors.SimError('Timeout to wait for simulator booted in %ss.' %
+                                timeout_sec)
 
-  def WaitUntilStateShutdown(self, timeout_sec=_SIMULATOR_SHUTDOWN_TIMEOUT_SEC):
+  def WaitUntilStateShutdown(self, timeout_sec=SIMULATOR_SHUTDOWN_TIMEOUT_SEC):
     """Waits until the simulator state becomes SHUTDOWN.
 
     Args:
@@ -278,13 +391,39 @@ class Simulator(object):
       ios_errors.SimError: when it is timeout to wait the simulator state
           becomes SHUTDOWN.
     """
-    start_time = time.time()
-    while start_time + timeout_sec >= time.time():
-      time.sleep(_SIM_CHECK_STATE_INTERVAL_SEC)
-      if self.GetSimulatorState() == ios_constants.SimState.SHUTDOWN:
-        return
-    raise ios_errors.SimError('Timeout to wait for simulator shutdown in %ss.' %
-                              timeout_sec)
+    if not self._WaitUntilState(ios_constants.SimState.SHUTDOWN, timeout_sec):
+      raise ios_errors.SimError(
+          'Timeout to wait for simulator shutdown in %ss.' % timeout_sec)
+
+  def _WaitUntilState(self, state, timeout_sec):
+    """Waits until the simulator state becomes the given state.
+
+    The simulator state is stored in device.plist. Instead of polling the file
+    in fixed interval, the waiter is woken up as soon as device.plist is
+    rewritten.
+
+    Args:
+      state: shared.ios_constants.SimState, the expected state.
+      timeout_sec: int, timeout of waiting in seconds.
+
+    Returns:
+      True if the simulator reaches the state, False if it is timeout.
+    """
+    deadline = time.time() + timeout_sec
+    if not os.path.isdir(self.simulator_root_dir):
+      # The simulator directory may not exist right after creating it.
+      while (not os.path.isdir(self.simulator_root_dir) and
+             time.time() < deadline):
+        time.sleep(_SIM_CHECK_STATE_INTERVAL_SEC)
+    device_plist_path = os.path.join(self.simulator_root_dir, 'device.plist')
+    with file_watcher.FileWatcher(device_plist_path) as watcher:
+      while True:
+        if self.GetSimulatorState() == state:
+          return True
+        remaining_sec = deadline - time.time()
+        if remaining_sec <= 0:
+          return False
+        watcher.Wait(remaining_sec)
 
   def GetSimulatorState(self):
     """Gets the state of the simulator in real time.
@@ -305,7 +444,8 @@ class Simulator(object):
     return _SIMULATOR_STATES_MAPPING[state_num]
 
 
-def CreateNewSimulator(device_type=None, os_version=None, name_prefix=None):
+def CreateNewSimulator(device_type=None, os_version=None, name_prefix=None,
+                       clone_source_id=None):
   """Creates a new simulator according to arguments.
 
   If neither device_type nor os_version is given, will use the latest iOS
@@ -327,6 +467,10 @@ def CreateNewSimulator(device_type=None, os_version=None, name_prefix=None):
       {major}.{minor}, such as 9.3, 10.2.
     name_prefix: string, name prefix of the new simulator. By default, it is
       "New".
+    clone_source_id: string, id of a SHUTDOWN simulator with the same device
+      type and OS version. If it is given, the new simulator is cloned from it
+      by `simctl clone` instead of being created from scratch. See
+      golden_simulator for details.
 
   Returns:
      a tuple with four items:
@@ -339,44 +483,37 @@ def CreateNewSimulator(device_type=None, os_version=None, name_prefix=None):
     ios_errors.SimError: when failed to create new simulator.
     ios_errors.IllegalArgumentError: when the given argument is invalid.
   """
-  if not device_type:
-    os_type = ios_constants.OS.IOS
-  else:
-    _ValidateSimulatorType(device_type)
-    os_type = GetOsType(device_type)
-  if not os_version:
-    os_version = GetLastSupportedSimOsVersion(os_type, device_type=device_type)
-  else:
-    supported_sim_os_versions = GetSupportedSimOsVersions(os_type)
-    if os_version not in supported_sim_os_versions:
-      raise ios_errors.IllegalArgumentError(
-          'The simulator os version %s is not supported. Supported simulator '
-          'os versions are %s.' % (os_version, supported_sim_os_versions))
-  if not device_type:
-    device_type = GetLastSupportedIphoneSimType(os_version)
-  else:
-    _ValidateSimulatorTypeWithOsVersion(device_type, os_version)
+  device_type, os_version = ResolveSimulatorTypeAndOsVersion(
+      device_type, os_version)
+  os_type = GetOsType(device_type)
   if not name_prefix:
     name_prefix = 'New'
   name = '%s-%s-%s' % (name_prefix, device_type, os_version)
 
-  # Example
-  # Runtime ID of iOS 10.2: com.apple.CoreSimulator.SimRuntime.iOS-10-2
-  runtime_id = _PREFIX_RUNTIME_ID + os_type + '-' + os_version.replace('.', '-')
+  runtime_id = GetRuntimeId(os_type, os_version)
   logging.info('Creating a new simulator:\nName: %s\nOS: %s %s\nType: %s', name,
                os_type, os_version, device_type)
-  for i in range(0, _SIM_OPERATION_MAX_ATTEMPTS):
+  if clone_source_id:
+    logging.info('Cloning the new simulator from simulator %s.',
+                 clone_source_id)
+    command = ['xcrun', 'simctl', 'clone', clone_source_id, name]
+  else:
+    command = ['xcrun', 'simctl', 'create', name, device_type, runtime_id]
+  for i in range(0, SIM_OPERATION_MAX_ATTEMPTS):
     try:
-      new_simulator_id = RunSimctlCommand(
-          ['xcrun', 'simctl', 'create', name, device_type, runtime_id])
+      new_simulator_id = RunSimctlCommand(command)
     except ios_errors.SimError as e:
       raise ios_errors.SimError('Failed to create simulator: %s' % str(e))
+    GetSimctlInventory().Invalidate()
+    # Marks the simulator before waiting, so it can be reclaimed by a later
+    # runner process if this one crashes.
+    simulator_reaper.WriteOwnerMarker(new_simulator_id)
     new_simulator_obj = Simulator(new_simulator_id)
     # After creating a new simulator, its state is CREATING. When the
     # simulator's state becomes SHUTDOWN, the simulator is created.
     try:
       new_simulator_obj.WaitUntilStateShutdown(
-          _SIMULATOR_CREATING_TO_SHUTDOWN_TIMEOUT_SEC)
+          SIMULATOR_CREATING_TO_SHUTDOWN_TIMEOUT_SEC)
       logging.info('Created new simulator %s.', new_simulator_id)
       return new_simulator_id, device_type, os_version, name
     except ios_errors.SimError as error:
@@ -384,15 +521,73 @@ def CreateNewSimulator(device_type=None, os_version=None, name_prefix=None):
                     error)
       logging.debug('Deleted half-created simulator %s.', new_simulator_id)
       new_simulator_obj.Delete()
-      if i != _SIM_OPERATION_MAX_ATTEMPTS - 1:
+      if i != SIM_OPERATION_MAX_ATTEMPTS - 1:
         logging.debug('Will sleep %ss and retry again.',
-                      _SIM_ERROR_RETRY_INTERVAL_SEC)
+                      SIM_ERROR_RETRY_INTERVAL_SEC)
         # If the simulator's state becomes SHUTDOWN, there may be something
         # wrong in CoreSimulatorService. Sleeps a short interval(2s) can help
         # reduce flakiness.
-        time.sleep(_SIM_ERROR_RETRY_INTERVAL_SEC)
+        time.sleep(SIM_ERROR_RETRY_INTERVAL_SEC)
   raise ios_errors.SimError('Failed to create simulator in %d attempts.' %
-                            _SIM_OPERATION_MAX_ATTEMPTS)
+                            SIM_OPERATION_MAX_ATTEMPTS)
+
+
+def GetRuntimeId(os_type, os_version):
+  """Gets the simctl runtime id of the given OS type and version.
+
+  Args:
+    os_type: shared.ios_constants.OS, OS type of simulator, such as iOS,
+      watchOS, tvOS.
+    os_version: string, OS version of the simulator. The format is
+      {major}.{minor}, such as 9.3, 10.2.
+
+  Returns:
+    string, the runtime id.
+  """
+  # Example
+  # Runtime ID of iOS 10.2: com.apple.CoreSimulator.SimRuntime.iOS-10-2
+  return _PREFIX_RUNTIME_ID + os_type + '-' + os_version.replace('.', '-')
+
+
+def ResolveSimulatorTypeAndOsVersion(device_type=None, os_version=None):
+  """Resolves and validates the device type and OS version of a simulator.
+
+  The missing arguments are filled with the same defaults as
+  CreateNewSimulator uses. See CreateNewSimulator for details.
+
+  Args:
+    device_type: string, device type of the simulator. The value corresponds
+      to the output of `xcrun simctl list devicetypes`. E.g., iPhone 6, iPad
+      Air, etc.
+    os_version: string, OS version of the simulator. The format is
+      {major}.{minor}, such as 9.3, 10.2.
+
+  Returns:
+     a tuple with two items:
+        string, simulator device type.
+        string, OS version of the simulator.
+
+  Raises:
+    ios_errors.IllegalArgumentError: when the given argument is invalid.
+  """
+  if not device_type:
+    os_type = ios_constants.OS.IOS
+  else:
+    _ValidateSimulatorType(device_type)
+    os_type = GetOsType(device_type)
+  if not os_version:
+    os_version = GetLastSupportedSimOsVersion(os_type, device_type=device_type)
+  else:
+    supported_sim_os_versions = GetSupportedSimOsVersions(os_type)
+    if os_version not in supported_sim_os_versions:
+      raise ios_errors.IllegalArgumentError(
+          'The simulator os version %s is not supported. Supported simulator '
+          'os versions are %s.' % (os_version, supported_sim_os_versions))
+  if not device_type:
+    device_type = GetLastSupportedIphoneSimType(os_version)
+  else:
+    _ValidateSimulatorTypeWithOsVersion(device_type, os_version)
+  return device_type, os_version
 
 
 def GetSupportedSimDeviceTypes(os_type=None):
@@ -423,10 +618,8 @@ def GetSupportedSimDeviceTypes(os_type=None):
   # }
   #
   # See more examples in testdata/simctl_list_devicetypes.json
-  sim_types_infos_json = json.loads(
-      RunSimctlCommand(('xcrun', 'simctl', 'list', 'devicetypes', '-j')))
   sim_types = []
-  for sim_types_info in sim_types_infos_json['devicetypes']:
+  for sim_types_info in GetSimctlInventory().devicetypes:
     sim_type = sim_types_info['name']
     if (os_type is None or
         (os_type == ios_constants.OS.IOS and sim_type.startswith('i')) or
@@ -493,10 +686,8 @@ def GetSupportedSimOsVersions(os_type=ios_constants.OS.IOS):
   # }
   # See more examples in testdata/simctl_list_runtimes.json
   xcode_version_num = xcode_info_util.GetXcodeVersionNumber()
-  sim_runtime_infos_json = json.loads(
-      RunSimctlCommand(('xcrun', 'simctl', 'list', 'runtimes', '-j')))
   sim_versions = []
-  for sim_runtime_info in sim_runtime_infos_json['runtimes']:
+  for sim_runtime_info in GetSimctlInventory().runtimes:
     # Normally, the json does not contain unavailable runtimes. To be safe,
     # also checks the 'availability' field.
     if 'availability' in sim_runtime_info and sim_runtime_info[
@@ -656,6 +847,101 @@ def _ValidateSimulatorTypeWithOsVersion(device_type, os_version):
           (device_type, max_os_version, os_version))
 
 
+class SystemLogCrashDetector(threading.Thread):
+  """The thread which follows the simulator's system.log to detect crashes.
+
+  The log is read incrementally from the offset at the time the detector is
+  created, so the whole log of the test session is checked rather than only its
+  tail. All crash patterns are matched in one pass per line. After Stop() is
+  called, the verdicts cover all the log written before that.
+  """
+
+  def __init__(self, system_log_path, app_bundle_id=''):
+    """Initializes the SystemLogCrashDetector object.
+
+    Args:
+      system_log_path: string, the path of the simulator's system.log.
+      app_bundle_id: string, the bundle id of the app. If it is not provided,
+        the crash of any UIKitApplication is detected.
+    """
+    super(SystemLogCrashDetector, self).__init__()
+    self.daemon = True
+    self._system_log_path = system_log_path
+    self._app_crash_pattern = re.compile(
+        _PATTERN_APP_CRASH_ON_SIM % app_bundle_id)
+    self._xctest_crash_pattern = re.compile(
+        _PATTERN_XCTEST_PROCESS_CRASH_ON_SIM)
+    self._coresimulator_crash_pattern = re.compile(
+        _PATTERN_CORESIMULATOR_CRASH)
+    try:
+      self._offset = os.path.getsize(system_log_path)
+    except OSError:
+      self._offset = 0
+    self._partial_line = b''
+    self._read_lock = threading.Lock()
+    self._stop_event = threading.Event()
+    self._stopped = False
+    self.app_crashed = False
+    self.xctest_crashed = False
+    self.coresimulator_crashed = False
+
+  def run(self):
+    with file_watcher.FileWatcher(self._system_log_path) as watcher:
+      while not self._stop_event.is_set():
+        self._ReadNewLines()
+        watcher.Wait(_SYSTEM_LOG_FOLLOW_INTERVAL_SEC)
+
+  def Stop(self):
+    """Stops following and checks the rest of the log."""
+    if self._stopped:
+      return
+    self._stopped = True
+    self._stop_event.set()
+    if self.is_alive():
+      self.join()
+    self._ReadNewLines(flush_partial_line=True)
+
+  def _ReadNewLines(self, flush_partial_line=False):
+    """Reads the log from the saved offset and matches the new lines."""
+    with self._read_lock:
+      try:
+        with open(self._system_log_path, 'rb') as log_file:
+          log_file.seek(0, os.SEEK_END)
+          if log_file.tell() < self._offset:
+            # The log was truncated or rotated.
+            self._offset = 0
+            self._partial_line = b''
+          log_file.seek(self._offset)
+          while True:
+            data = log_file.read(_SYSTEM_LOG_READ_SIZE)
+            if not data:
+              break
+            self._offset += len(data)
+            lines = (self._partial_line + data).split(b'\n')
+            self._partial_line = lines.pop()
+            for line in lines:
+              self._MatchLine(line)
+      except OSError:
+        return
+      if flush_partial_line and self._partial_line:
+        self._MatchLine(self._partial_line)
+        self._partial_line = b''
+
+  def _MatchLine(self, line):
+    """Records the crashes found in the line."""
+    # Most lines match none of the patterns. The marker they all contain
+    # filters them out before decoding and searching.
+    if _SERVICE_EXITED_MARKER not in line:
+      return
+    line = line.decode('utf-8', errors='ignore')
+    if self._app_crash_pattern.search(line):
+      self.app_crashed = True
+    if self._xctest_crash_pattern.search(line):
+      self.xctest_crashed = True
+    if self._coresimulator_crash_pattern.search(line):
+      self.coresimulator_crashed = True
+
+
 def QuitSimulatorApp():
   """Quits the Simulator.app."""
   subprocess.Popen(['killall', 'Simulator'],
@@ -708,7 +994,8 @@ def IsCoreSimulatorCrash(sim_sys_log):
 
 def RunSimctlCommand(command):
   """Runs simctl command."""
-  for i in range(_SIMCTL_MAX_ATTEMPTS):
+  command = xcode_info_util.ResolveXcrunCommand(command)
+  for i in range(SIMCTL_MAX_ATTEMPTS):
     process = subprocess.Popen(
         command,
         stdout=subprocess.PIPE,
@@ -718,7 +1005,7 @@ def RunSimctlCommand(command):
     all_output = '\n'.join([stdout, stderr])
     output = stdout.strip()
     if process.poll() != 0:
-      if (i < (_SIMCTL_MAX_ATTEMPTS - 1) and
+      if (i < (SIMCTL_MAX_ATTEMPTS - 1) and
           ios_constants.CORESIMULATOR_INTERRUPTED_ERROR in all_output):
         continue
       raise ios_errors.SimError(output)
@@ -24,11 +24,20 @@ import json
 import logging
 import subprocess
 import sys
+import threading
 
+from xctestrunner.shared import extraction_cache
 from xctestrunner.shared import ios_constants
 from xctestrunner.shared import ios_errors
+from xctestrunner.shared import task_graph
+from xctestrunner.shared import xcode_info_util
+from xctestrunner.simulator_control import golden_simulator
+from xctestrunner.simulator_control import simulator_pool
+from xctestrunner.simulator_control import simulator_reaper
 from xctestrunner.simulator_control import simulator_util
 from xctestrunner.test_runner import runner_exit_codes
+from xctestrunner.test_runner import signed_framework_cache
+from xctestrunner.test_runner import test_root_cache
 from xctestrunner.test_runner import xctest_session
 
 _XCTESTRUN_HELP = (
@@ -40,6 +49,10 @@ options.
 
 This argument is only supported in Xcode 8+.""")
 
+# The tasks of preparing the simulator test mostly wait for the subprocesses
+# and the disk, so they all run at once regardless of the number of the CPUs.
+_PREPARE_MAX_WORKERS = 4
+
 
 def _AddGeneralArguments(parser):
   """Adds general arguments to the parser."""
@@ -99,6 +112,39 @@ def _AddGeneralArguments(parser):
            '2) the screenshots of every test stages (XCUITest).\n'
            'If directory is specified, the directory will not be deleted after '
            'test ends.')
+  optional_arguments.add_argument(
+      '--cache_test_root',
+      action='store_true',
+      help='Caches the prepared TEST_ROOT keyed by the content of the inputs, '
+           'so a later run with the same inputs skips preparing the bundles.')
+  optional_arguments.add_argument(
+      '--test_root_cache_max_size_mb',
+      type=int,
+      default=test_root_cache.DEFAULT_MAX_SIZE_BYTES // 1024 // 1024,
+      help='The max total size of the cached TEST_ROOTs. The least recently '
+           'used ones are evicted when it is exceeded.')
+  optional_arguments.add_argument(
+      '--cache_extracted_ipa',
+      action='store_true',
+      help='Caches the extracted .ipa/.zip bundles, so the later runs with the '
+           'same archive file on the host skip extracting it.')
+  optional_arguments.add_argument(
+      '--extracted_ipa_cache_max_size_mb',
+      type=int,
+      default=extraction_cache.DEFAULT_MAX_SIZE_BYTES // 1024 // 1024,
+      help='The max total size of the cached extracted archives. The least '
+           'recently used ones are evicted when it is exceeded.')
+  optional_arguments.add_argument(
+      '--cache_signed_frameworks',
+      action='store_true',
+      help='Caches the Xcode frameworks signed for the device tests, keyed by '
+           'the signing certificate, so the later runs skip signing them.')
+  optional_arguments.add_argument(
+      '--signed_frameworks_cache_max_size_mb',
+      type=int,
+      default=signed_framework_cache.DEFAULT_MAX_SIZE_BYTES // 1024 // 1024,
+      help='The max total size of the cached signed frameworks. The least '
+           'recently used ones are evicted when it is exceeded.')
 
 
 def _AddPrepareSubParser(subparsers):
@@ -111,7 +157,10 @@ def _AddPrepareSubParser(subparsers):
         sdk=sdk,
         device_arch=device_arch,
         work_dir=args.work_dir,
-        output_dir=args.output_dir) as session:
+        output_dir=args.output_dir,
+        test_root_cache=_GetTestRootCache(args),
+        extraction_cache=_GetExtractionCache(args),
+        signed_framework_cache=_GetSignedFrameworkCache(args)) as session:
       session.Prepare(
           app_under_test=args.app_under_test_path,
           test_bundle=args.test_bundle_path,
@@ -147,7 +196,10 @@ def _AddTestSubParser(subparsers):
         sdk=sdk,
         device_arch=device_arch,
         work_dir=args.work_dir,
-        output_dir=args.output_dir) as session:
+        output_dir=args.output_dir,
+        test_root_cache=_GetTestRootCache(args),
+        extraction_cache=_GetExtractionCache(args),
+        signed_framework_cache=_GetSignedFrameworkCache(args)) as session:
       session.Prepare(
           app_under_test=args.app_under_test_path,
           test_bundle=args.test_bundle_path,
@@ -182,37 +234,106 @@ def _AddSimulatorTestSubParser(subparsers):
     with xctest_session.XctestSession(
         sdk=ios_constants.SDK.IPHONESIMULATOR,
         device_arch=ios_constants.ARCH.X86_64,
-        work_dir=args.work_dir, output_dir=args.output_dir) as session:
-      simulator_id, _, os_version, _ = simulator_util.CreateNewSimulator(
-          device_type=args.device_type,
-          os_version=args.os_version,
-          name_prefix=args.new_simulator_name_prefix)
-      simulator_obj = simulator_util.Simulator(simulator_id)
+        work_dir=args.work_dir, output_dir=args.output_dir,
+        test_root_cache=_GetTestRootCache(args),
+        extraction_cache=_GetExtractionCache(args)) as session:
+      if args.clone_from_golden:
+        create_simulator = golden_simulator.CreateNewSimulatorFromGolden
+      else:
+        create_simulator = simulator_util.CreateNewSimulator
       hostless = args.app_under_test_path is None
+      simulator = {}
+
+      def _CreateSimulator():
+        simulator['id'], _, simulator['os_version'], _ = create_simulator(
+            device_type=args.device_type,
+            os_version=args.os_version,
+            name_prefix=args.new_simulator_name_prefix)
+
+      # The simulator is created and booted while the session is prepared.
+      graph = task_graph.TaskGraph()
+      graph.AddTask('create_simulator', _CreateSimulator)
+      if not hostless:
+        graph.AddTask(
+            'boot_simulator',
+            lambda: simulator_util.Simulator(simulator['id']).Boot(),
+            deps=['create_simulator'])
+      _AddPrepareSessionTask(graph, session, args)
       try:
-        if not hostless:
-          simulator_obj.Boot()
-        session.Prepare(
-            app_under_test=args.app_under_test_path,
-            test_bundle=args.test_bundle_path,
-            xctestrun_file_path=args.xctestrun,
-            test_type=args.test_type,
-            signing_options=_GetJson(args.signing_options_json_path))
-        session.SetLaunchOptions(_GetJson(args.launch_options_json_path))
+        try:
+          graph.Run(max_workers=_PREPARE_MAX_WORKERS)
+        finally:
+          _LogCriticalPath(graph)
         if not hostless:
           try:
-            simulator_obj.BootStatus().wait(timeout=60)
+            simulator_util.Simulator(simulator['id']).BootStatus().wait(
+                timeout=60)
           except subprocess.TimeoutExpired:
             logging.warning(
                 'The simulator %s could not be booted in 60s. Will try to run '
-                'test directly.', simulator_id)
-        return session.RunTest(simulator_id, os_version=os_version)
+                'test directly.', simulator['id'])
+        return session.RunTest(
+            simulator['id'], os_version=simulator['os_version'])
       finally:
-        simulator_obj.Delete()
+        if 'id' in simulator:
+          simulator_util.Simulator(simulator['id']).Delete()
+
+  def _RunPooledSimulatorTest(args):
+    """The function of running test with simulator leased from the pool."""
+    pool = simulator_pool.SimulatorPool(
+        pool_size=args.pool_size,
+        idle_timeout_sec=args.pool_idle_timeout_sec,
+        max_age_sec=args.pool_max_age_sec,
+        clone_from_golden=args.clone_from_golden)
+    with xctest_session.XctestSession(
+        sdk=ios_constants.SDK.IPHONESIMULATOR,
+        device_arch=ios_constants.ARCH.X86_64,
+        work_dir=args.work_dir, output_dir=args.output_dir,
+        test_root_cache=_GetTestRootCache(args),
+        extraction_cache=_GetExtractionCache(args)) as session:
+      leases = []
+
+      def _Lease():
+        leases.append(pool.Lease(
+            device_type=args.device_type, os_version=args.os_version))
+
+      # The simulator is leased while the session is prepared.
+      graph = task_graph.TaskGraph()
+      graph.AddTask('lease_simulator', _Lease)
+      _AddPrepareSessionTask(graph, session, args)
+      exit_code = None
+      fill_thread = None
+      try:
+        try:
+          graph.Run(max_workers=_PREPARE_MAX_WORKERS)
+        finally:
+          _LogCriticalPath(graph)
+        # Warms up the simulators for the next sessions while testing.
+        fill_thread = threading.Thread(
+            target=_FillPool, args=(pool, leases[0]))
+        fill_thread.start()
+        exit_code = session.RunTest(
+            leases[0].simulator_id, os_version=leases[0].os_version)
+        return exit_code
+      finally:
+        if fill_thread:
+          fill_thread.join()
+        if leases:
+          pool.Return(
+              leases[0],
+              discard=exit_code in (
+                  runner_exit_codes.EXITCODE.NEED_RECREATE_SIM,
+                  runner_exit_codes.EXITCODE.SIM_ERROR))
 
   def _SimulatorTest(args):
     """The function of sub command `simulator_test`."""
+    name_prefixes = set(simulator_reaper.DEFAULT_ORPHAN_NAME_PREFIXES)
+    if args.new_simulator_name_prefix:
+      name_prefixes.add(args.new_simulator_name_prefix)
+    simulator_reaper.GetReaper().StartReclaimingOrphans(sorted(name_prefixes))
     try:
+      if args.use_pool:
+        return _RunPooledSimulatorTest(args)
       return _RunSimulatorTest(args)
     except ios_errors.SimError:
       return runner_exit_codes.EXITCODE.SIM_ERROR
@@ -238,6 +359,42 @@ def _AddSimulatorTestSubParser(subparsers):
            'The new simulator name will be the value of concatenating name '
            'prefix with simulator type and os version. '
            'E.g., New-iPhone 6 Plus-10.2.')
+  test_parser.add_argument(
+      '--clone_from_golden',
+      action='store_true',
+      help='Clone the new simulator from a golden simulator which has finished '
+           'its first boot, instead of creating it from scratch. The golden '
+           'simulator is built on first use per device type, os version and '
+           'Xcode version.')
+  pool_arguments = test_parser.add_argument_group('Simulator pool arguments')
+  pool_arguments.add_argument(
+      '--use_pool',
+      action='store_true',
+      help='Lease a pre-booted simulator from the simulator pool on this host '
+           'instead of creating a new one. The pool is filled up to the pool '
+           'size in background while the test runs. The simulator is reset and '
+           'returned to the pool after test finishes.')
+  pool_arguments.add_argument(
+      '--pool_size',
+      type=int,
+      default=simulator_pool.DEFAULT_POOL_SIZE,
+      help='The number of simulators kept in the pool per device type and os '
+           'version. By default, it is %d.'
+      % simulator_pool.DEFAULT_POOL_SIZE)
+  pool_arguments.add_argument(
+      '--pool_idle_timeout_sec',
+      type=int,
+      default=simulator_pool.DEFAULT_IDLE_TIMEOUT_SEC,
+      help='The pooled simulator which is not leased in the given seconds '
+           'will be deleted. By default, it is %d.'
+      % simulator_pool.DEFAULT_IDLE_TIMEOUT_SEC)
+  pool_arguments.add_argument(
+      '--pool_max_age_sec',
+      type=int,
+      default=simulator_pool.DEFAULT_MAX_AGE_SEC,
+      help='The pooled simulator which was created before the given seconds '
+           'will be deleted instead of being reused. By default, it is %d.'
+      % simulator_pool.DEFAULT_MAX_AGE_SEC)
   test_parser.set_defaults(func=_SimulatorTest)
 
 
@@ -257,6 +414,55 @@ def _BuildParser():
   return parser
 
 
+def _AddPrepareSessionTask(graph, session, args):
+  """Adds the tasks of preparing the session to the graph.
+
+  The facts of the toolchain are queried concurrently with extracting the
+  bundles, which does not need them.
+
+  Args:
+    graph: task_graph.TaskGraph, the graph to add the tasks to.
+    session: xctest_session.XctestSession, the session to prepare.
+    args: the parsed arguments of the sub command.
+  """
+  toolchain = xcode_info_util.GetToolchain()
+
+  def _QueryToolchain():
+    toolchain.GetXcodeVersionNumber()
+    toolchain.GetSdkPlatformPath(ios_constants.SDK.IPHONESIMULATOR)
+
+  def _PrepareSession():
+    session.Prepare(
+        app_under_test=args.app_under_test_path,
+        test_bundle=args.test_bundle_path,
+        xctestrun_file_path=args.xctestrun,
+        test_type=args.test_type,
+        signing_options=_GetJson(args.signing_options_json_path))
+    session.SetLaunchOptions(_GetJson(args.launch_options_json_path))
+
+  graph.AddTask('query_toolchain', _QueryToolchain)
+  graph.AddTask('prepare_session', _PrepareSession)
+
+
+def _FillPool(pool, lease):
+  """Fills the pool with the simulators like the lease. Errors are logged."""
+  try:
+    pool.Fill(device_type=lease.device_type, os_version=lease.os_version)
+  except (ios_errors.SimError, OSError) as e:
+    logging.warning('Failed to fill the simulator pool: %s', e)
+
+
+def _LogCriticalPath(graph):
+  """Logs the chain of the tasks which bounded the time of the graph."""
+  timings = graph.timings
+  if timings:
+    logging.info(
+        'Prepared in %.2fs. Critical path: %s',
+        max(end for _, end in timings.values()) -
+        min(start for start, _ in timings.values()),
+        ' -> '.join('%s (%.2fs)' % task for task in graph.GetCriticalPath()))
+
+
 def _GetJson(json_path):
   """Gets the json dict from the file."""
   if json_path:
@@ -268,6 +474,31 @@ def _GetJson(json_path):
   return None
 
 
+def _GetTestRootCache(args):
+  """Gets the TestRootCache object if it is enabled by the args."""
+  if not args.cache_test_root:
+    return None
+  return test_root_cache.TestRootCache(
+      max_size_bytes=args.test_root_cache_max_size_mb * 1024 * 1024)
+
+
+def _GetExtractionCache(args):
+  """Gets the ExtractionCache object if it is enabled by the args."""
+  if not args.cache_extracted_ipa:
+    return None
+  return extraction_cache.ExtractionCache(
+      max_size_bytes=args.extracted_ipa_cache_max_size_mb * 1024 * 1024)
+
+
+def _GetSignedFrameworkCache(args):
+  """Gets the SignedFrameworkCache object if it is enabled by the args."""
+  if not args.cache_signed_frameworks:
+    return None
+  return signed_framework_cache.SignedFrameworkCache(
+      xcode_info_util.GetToolchain(),
+      max_size_bytes=args.signed_frameworks_cache_max_size_mb * 1024 * 1024)
+
+
 def _PlatformToSdk(platform):
   """Gets the SDK of the given platform."""
   if platform == ios_constants.PLATFORM.IOS_DEVICE:
@@ -310,6 +541,8 @@ def main(argv):
     logging.basicConfig(level=logging.DEBUG, format='%(asctime)s %(message)s')
   else:
     logging.basicConfig(format='%(asctime)s %(message)s')
+  # The simulator reaper is not waited. The started deletions finish in their
+  # own process groups, and the failed ones are reclaimed by a later run.
   exit_code = args.func(args)
   logging.info('Done.')
   return exit_code
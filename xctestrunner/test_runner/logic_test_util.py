@@ -31,7 +31,8 @@ def RunLogicTestOnSim(sim_id,
                       env_vars=None,
                       args=None,
                       tests_to_run=None,
-                      os_version=None):
+                      os_version=None,
+                      toolchain=None):
   """Runs logic tests on the simulator. The output prints on system stdout.
 
   Args:
@@ -43,6 +44,8 @@ def RunLogicTestOnSim(sim_id,
     tests_to_run: array, the format of each item is TestClass[/TestMethod].
         If it is empty, then runs with All methods.
     os_version: string, the OS version of the simulator.
+    toolchain: xcode_info_util.Toolchain, the Xcode to run the test. By default,
+        it is the active Xcode.
 
   Returns:
     exit_code: A value of type runner_exit_codes.EXITCODE.
@@ -50,6 +53,7 @@ def RunLogicTestOnSim(sim_id,
   Raises:
     ios_errors.SimError: The command to launch logic test has error.
   """
+  toolchain = toolchain or xcode_info_util.GetToolchain()
   simctl_env_vars = {}
   if env_vars:
     for key in env_vars:
@@ -58,18 +62,18 @@ def RunLogicTestOnSim(sim_id,
   # When running tests on iOS 12.1 or earlier simulator under Xcode 11 or later,
   # it is required to add swift5 fallback libraries to environment variable.
   # See https://github.com/bazelbuild/rules_apple/issues/684 for context.
-  if (xcode_info_util.GetXcodeVersionNumber() >= 1100 and
+  if (toolchain.GetXcodeVersionNumber() >= 1100 and
       os_version and
       version_util.GetVersionNumber(os_version) < 1220):
     key = _SIMCTL_ENV_VAR_PREFIX + 'DYLD_FALLBACK_LIBRARY_PATH'
-    simctl_env_vars[key] = xcode_info_util.GetSwift5FallbackLibsDir()
+    simctl_env_vars[key] = toolchain.GetSwift5FallbackLibsDir()
   # We need to set the DEVELOPER_DIR to ensure xcrun works correctly
-  developer_dir = os.environ.get('DEVELOPER_DIR')
+  developer_dir = (toolchain.env or os.environ).get('DEVELOPER_DIR')
   if developer_dir:
     simctl_env_vars['DEVELOPER_DIR'] = developer_dir
   command = [
       'xcrun', 'simctl', 'spawn', '-s', sim_id,
-      xcode_info_util.GetXctestToolPath(ios_constants.SDK.IPHONESIMULATOR)]
+      toolchain.GetXctestToolPath(ios_constants.SDK.IPHONESIMULATOR)]
   if args:
     command += args
   if not tests_to_run:
@@ -78,7 +82,8 @@ def RunLogicTestOnSim(sim_id,
     tests_to_run_str = ','.join(tests_to_run)
 
   return_code = subprocess.Popen(
-      command + ['-XCTest', tests_to_run_str, test_bundle_path],
+      toolchain.ResolveXcrunCommand(
+          command + ['-XCTest', tests_to_run_str, test_bundle_path]),
       env=simctl_env_vars, stdout=sys.stdout, stderr=subprocess.STDOUT).wait()
   if return_code != 0:
     return runner_exit_codes.EXITCODE.FAILED
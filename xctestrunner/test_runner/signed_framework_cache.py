@@ -0,0 +1,191 @@
+# Copyright 2017 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""The cache of the Xcode frameworks and libraries signed for device tests.
+
+Every device test session embeds the same frameworks of the Xcode platform
+directory, e.g., XCTest.framework, and signs them with the same identity. The
+cache keeps the signed copies, keyed by the Xcode, the source framework, the
+SHA-1 of the signing certificate and the entitlements, so later sessions only
+materialize them.
+
+The entries of an Xcode are evicted once the version of the Xcode in the same
+developer directory changes. The least recently used entries are evicted when
+the total size exceeds the cap.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import shutil
+
+from xctestrunner.shared import bundle_util
+from xctestrunner.shared import cache_util
+from xctestrunner.shared import materialize_util
+
+DEFAULT_MAX_SIZE_BYTES = 2 * 1024 * 1024 * 1024
+_SIGNED_FRAMEWORK_CACHE_NAME = 'signed_frameworks'
+
+
+class SignedFrameworkCache(object):
+  """The persistent cache of the signed copies of the Xcode frameworks."""
+
+  def __init__(self, toolchain, max_size_bytes=DEFAULT_MAX_SIZE_BYTES,
+               cache_dir=None):
+    """Initializes the SignedFrameworkCache object.
+
+    Args:
+      toolchain: xcode_info_util.Toolchain, the Xcode the frameworks come from.
+      max_size_bytes: int, the max total size of the cached frameworks.
+      cache_dir: string, the directory of the cache. By default, it is under
+        the user cache directory.
+    """
+    self._toolchain = toolchain
+    self._entries = cache_util.EntryCache(
+        cache_dir or cache_util.GetCacheDir(_SIGNED_FRAMEWORK_CACHE_NAME),
+        max_size_bytes)
+
+  def CopyAndSign(self, src_path, target_path, identity,
+                  entitlements_plist_path=None):
+    """Materializes the signed copy of the framework or library.
+
+    On cache miss, the source is copied and signed, then stored in the cache.
+    The cache is bypassed when the identity does not resolve to exactly one
+    certificate.
+
+    Args:
+      src_path: string, the path of the framework or the dylib in Xcode.
+      target_path: string, the path of the signed copy. It should not exist.
+      identity: string, the identity to sign the copy.
+      entitlements_plist_path: string, the path of the entitlements to sign
+        the copy.
+
+    Raises:
+      ios_errors.BundleError: when failed to codesign the copy.
+    """
+    certificate_sha1 = bundle_util.GetSigningCertificateSha1(identity)
+    if certificate_sha1 is None:
+      logging.info('Not caching the signed %s: the identity %s does not match '
+                   'exactly one certificate.', os.path.basename(target_path),
+                   identity)
+      key = None
+    else:
+      key = self._ComputeKey(src_path, certificate_sha1,
+                             entitlements_plist_path)
+      if self._Materialize(key, target_path):
+        return
+    _Materialize(src_path, target_path, symlinks=False)
+    bundle_util.CodesignBundle(
+        target_path,
+        entitlements_plist_path=entitlements_plist_path,
+        identity=identity)
+    if key:
+      self._Store(key, target_path)
+
+  def _ComputeKey(self, src_path, certificate_sha1, entitlements_plist_path):
+    """Computes the cache key of the signed copy."""
+    # The display name of the identity stays the same when the certificate is
+    # renewed, so the key uses the certificate instead.
+    hasher = hashlib.sha256()
+    hasher.update(json.dumps({
+        'xcode_version': self._toolchain.GetXcodeVersionNumber(),
+        'developer_dir': self._toolchain.developer_dir,
+        'src_path': os.path.realpath(src_path),
+        'certificate_sha1': certificate_sha1,
+    }, sort_keys=True).encode('utf-8'))
+    if entitlements_plist_path:
+      with open(entitlements_plist_path, 'rb') as entitlements_file:
+        hasher.update(b'E' + hashlib.sha256(entitlements_file.read()).digest())
+    # The sizes and mtimes of the source files change with any Xcode update,
+    # without hashing the content of the big binaries.
+    for file_path in _ListFiles(src_path):
+      file_stat = os.stat(file_path)
+      hasher.update(b'%s\0%d\0%d\0' % (
+          os.path.relpath(file_path, src_path).encode('utf-8'),
+          file_stat.st_size, file_stat.st_mtime_ns))
+    return hasher.hexdigest()
+
+  def _Materialize(self, key, target_path):
+    """Materializes the cached signed copy. Returns False on cache miss."""
+    record = self._entries.Use(key)
+    if record is None:
+      return False
+    try:
+      _Materialize(
+          os.path.join(self._entries.GetEntryDir(key), record['file_name']),
+          target_path)
+    except OSError as e:
+      # The entry may be evicted by another process during copying.
+      logging.warning('Failed to materialize cached signed %s: %s',
+                      record['file_name'], e)
+      _Remove(target_path)
+      return False
+    logging.info('Materialized signed %s from cache.', record['file_name'])
+    return True
+
+  def _Store(self, key, signed_path):
+    """Stores the signed copy in the cache. Errors are only logged."""
+    file_name = os.path.basename(signed_path)
+    xcode_version = self._toolchain.GetXcodeVersionNumber()
+    developer_dir = self._toolchain.developer_dir
+
+    def _IsStale(record):
+      # The Xcode is updated in place or removed.
+      return ((record['developer_dir'] == developer_dir and
+               record['xcode_version'] != xcode_version) or
+              not os.path.isdir(record['developer_dir']))
+
+    staging_dir = self._entries.GetStagingDir(key)
+    try:
+      os.makedirs(staging_dir)
+      _Materialize(signed_path, os.path.join(staging_dir, file_name))
+      evicted = self._entries.Commit(key, staging_dir, {
+          'file_name': file_name,
+          'xcode_version': xcode_version,
+          'developer_dir': developer_dir,
+      }, is_stale=_IsStale)
+    except OSError as e:
+      logging.warning('Failed to store signed %s in cache: %s', file_name, e)
+      shutil.rmtree(staging_dir, ignore_errors=True)
+      return
+    for _, record in evicted:
+      logging.info('Evicted cached signed %s.', record['file_name'])
+
+
+def _Materialize(src_path, target_path, symlinks=True):
+  """Materializes the framework directory or the library file."""
+  if os.path.isdir(src_path):
+    materialize_util.MaterializeTree(src_path, target_path, symlinks=symlinks)
+  else:
+    materialize_util.MaterializeFile(src_path, target_path)
+
+
+def _Remove(path):
+  if os.path.isdir(path) and not os.path.islink(path):
+    shutil.rmtree(path, ignore_errors=True)
+  elif os.path.lexists(path):
+    os.remove(path)
+
+
+def _ListFiles(path):
+  """Lists the files under the directory in order, or the file itself."""
+  if not os.path.isdir(path):
+    return [path]
+  file_paths = []
+  for dir_path, dir_names, file_names in os.walk(path):
+    dir_names.sort()
+    file_paths.extend(
+        os.path.join(dir_path, file_name) for file_name in sorted(file_names))
+  return file_paths
@@ -0,0 +1,143 @@
+# Copyright 2017 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""The cache of prepared TEST_ROOT directories shared across test sessions.
+
+Generating the TEST_ROOT extracts the bundles, generates the runner app and
+signs the bundles. The generated xctestrun file refers to the TEST_ROOT by
+__TESTROOT__, so the finished TEST_ROOT is relocatable and can be copied into
+the work directory of another session.
+
+The entries are keyed by the content hash of the inputs. When the total size of
+the entries exceeds the cap, the least recently used entries are evicted.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import shutil
+
+from xctestrunner.shared import bundle_util
+from xctestrunner.shared import cache_util
+from xctestrunner.shared import materialize_util
+
+DEFAULT_MAX_SIZE_BYTES = 10 * 1024 * 1024 * 1024
+_TEST_ROOT_CACHE_NAME = 'test_roots'
+
+
+def ComputeKey(app_under_test_path, test_bundle_path, sdk, device_arch,
+               test_type, signing_options, toolchain):
+  """Computes the cache key of the TEST_ROOT generated from the inputs.
+
+  Args:
+    app_under_test_path: string, the path of the original app under test. It
+      can be .ipa or .app. It can be None.
+    test_bundle_path: string, the path of the original test bundle. It can be
+      .ipa, .zip or .xctest.
+    sdk: ios_constants.SDK, the sdk of the target device.
+    device_arch: ios_constants.ARCH, the architecture of the target device.
+    test_type: ios_constants.TestType, the type of the test.
+    signing_options: dict, the signing app options.
+    toolchain: xcode_info_util.Toolchain, the Xcode to generate the TEST_ROOT.
+
+  Returns:
+    string, the hex digest of the key.
+  """
+  hasher = hashlib.sha256()
+  hasher.update(json.dumps({
+      'sdk': sdk,
+      'device_arch': device_arch,
+      'test_type': test_type,
+      'signing_options': signing_options or {},
+      'xcode_version': toolchain.GetXcodeVersionNumber(),
+      'developer_dir': toolchain.developer_dir,
+  }, sort_keys=True).encode('utf-8'))
+  input_paths = [app_under_test_path, test_bundle_path]
+  if signing_options:
+    input_paths.append(
+        signing_options.get('xctrunner_app_provisioning_profile'))
+  for path in input_paths:
+    hasher.update(b'\0')
+    if path:
+      hasher.update(bundle_util.Fingerprint(path).encode('utf-8'))
+  return hasher.hexdigest()
+
+
+class TestRootCache(object):
+  """The content addressed cache of the prepared TEST_ROOT directories."""
+
+  def __init__(self, max_size_bytes=DEFAULT_MAX_SIZE_BYTES, cache_dir=None):
+    """Initializes the TestRootCache object.
+
+    Args:
+      max_size_bytes: int, the max total size of the cached TEST_ROOTs.
+      cache_dir: string, the directory of the cache. By default, it is under
+        the user cache directory.
+    """
+    self._entries = cache_util.EntryCache(
+        cache_dir or cache_util.GetCacheDir(_TEST_ROOT_CACHE_NAME),
+        max_size_bytes)
+
+  def Materialize(self, key, test_root_dir):
+    """Copies the cached TEST_ROOT of the key to the given directory.
+
+    Args:
+      key: string, the cache key from ComputeKey.
+      test_root_dir: string, the path of the TEST_ROOT to create. The existing
+        directory will be replaced.
+
+    Returns:
+      the dict of metadata stored with the entry, or None on cache miss.
+    """
+    record = self._entries.Use(key)
+    if record is None:
+      return None
+    if os.path.exists(test_root_dir):
+      shutil.rmtree(test_root_dir)
+    try:
+      # The TEST_ROOT may be modified in place later, e.g., by xcodebuild or
+      # by resigning, so it never shares the inodes with the entry. The copy
+      # is still cheap where the file system supports clones.
+      materialize_util.MaterializeTree(
+          self._entries.GetEntryDir(key), test_root_dir, symlinks=True)
+    except (OSError, shutil.Error) as e:
+      # The entry may be evicted by another process during copying.
+      logging.warning('Failed to materialize cached TEST_ROOT %s: %s', key, e)
+      shutil.rmtree(test_root_dir, ignore_errors=True)
+      return None
+    logging.info('Materialized TEST_ROOT from cache entry %s.', key)
+    return record['metadata']
+
+  def Store(self, key, test_root_dir, metadata=None):
+    """Stores the finished TEST_ROOT in the cache.
+
+    Args:
+      key: string, the cache key from ComputeKey.
+      test_root_dir: string, the path of the finished TEST_ROOT.
+      metadata: dict, the json serializable data stored with the entry.
+    """
+    staging_dir = self._entries.GetStagingDir(key)
+    try:
+      materialize_util.MaterializeTree(test_root_dir, staging_dir,
+                                       symlinks=True)
+      evicted = self._entries.Commit(
+          key, staging_dir, {'metadata': metadata or {}})
+    except (OSError, shutil.Error) as e:
+      logging.warning('Failed to store TEST_ROOT in cache: %s', e)
+      shutil.rmtree(staging_dir, ignore_errors=True)
+      return
+    for evicted_key, _ in evicted:
+      logging.info('Evicted cached TEST_ROOT %s.', evicted_key)
+    logging.info('Stored TEST_ROOT in cache entry %s.', key)
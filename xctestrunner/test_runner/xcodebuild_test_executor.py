@@ -14,6 +14,7 @@
 
 """Helper class for running test by xcodebuild tool."""
 
+import collections
 import io
 import logging
 import os
@@ -34,17 +35,15 @@ from xctestrunner.test_runner import runner_exit_codes
 _XCODEBUILD_TEST_STARTUP_TIMEOUT_SEC = 150
 _SIM_TEST_MAX_ATTEMPTS = 3
 _DEVICE_TEST_MAX_ATTEMPTS = 2
-_TAIL_SIM_LOG_LINE = 200
 _BACKGROUND_TEST_RUNNER_ERROR = 'Failed to background test runner'
 _PROCESS_EXISTED_OR_CRASHED_ERROR = ('The process did launch, but has since '
                                      'exited or crashed.')
 _REQUEST_DENIED_ERROR = ('The request was denied by service delegate '
                          '(SBMainWorkspace) for reason')
-_APP_UNKNOWN_TO_FRONTEND_PATTERN = re.compile(
+_APP_UNKNOWN_TO_FRONTEND_PATTERN = (
     'Application ".*" is unknown to FrontBoard.')
 _INIT_SIM_SERVICE_ERROR = 'Failed to initiate service connection to simulator'
-_DEVICE_TYPE_WAS_NULL_PATTERN = re.compile(
-    'DTDeviceKit: deviceType from .* was NULL')
+_DEVICE_TYPE_WAS_NULL_PATTERN = 'DTDeviceKit: deviceType from .* was NULL'
 _TOO_MANY_INSTANCES_ALREADY_RUNNING = ('Too many instances of this service are '
                                        'already running.')
 _LOST_CONNECTION_ERROR = 'Lost connection to testmanagerd'
@@ -53,6 +52,72 @@ _DEVICE_NO_LONGER_CONNECTED = 'This device is no longer connected'
 _UNABLE_FIND_DEVICE_IDENTIFIER = 'Unable to find device with identifier'
 _BUNDLE_DAMAGED = 'The bundle is damaged or missing necessary resources.'
 
+# The tags of the xcodebuild output lines.
+_TEST_STARTED = 'test_started'
+_XCTRUNNER_STARTED = 'xctrunner_started'
+_TEST_SUCCEEDED = 'test_succeeded'
+_TEST_FAILED = 'test_failed'
+_NEED_REBOOT_SIM = 'need_reboot_sim'
+_NEED_RECREATE_SIM = 'need_recreate_sim'
+_NEED_RETRY_DEVICE_TESTING = 'need_retry_device_testing'
+_NEED_REBOOT_DEVICE = 'need_reboot_device'
+_PROCESS_CRASHED = 'process_crashed'
+_CORESIMULATOR_INTERRUPTED = 'coresimulator_interrupted'
+_TEST_BUNDLE_DAMAGED = 'bundle_damaged'
+_TEST_CACHE_FILE_DIR = 'test_cache_file_dir'
+
+
+class _OutputClassifier(object):
+  """Classifies the lines of the xcodebuild output as they stream.
+
+  All the patterns are combined into one regex, so most of the lines, which
+  match none of them, are rejected by a single scan. Only the matched lines are
+  checked against each pattern. The tags of all the lines are collected, so the
+  output is never scanned again after the command finishes.
+  """
+
+  def __init__(self, patterns):
+    """Initializes the _OutputClassifier object.
+
+    Args:
+      patterns: a list of (tag, regex) tuples. The literal strings should be
+          escaped by re.escape. If the regex has a group, the first group of
+          each match is collected.
+    """
+    self._patterns = [(tag, re.compile(regex)) for tag, regex in patterns]
+    self._combined_pattern = re.compile(
+        '|'.join('(?:%s)' % regex for _, regex in patterns))
+    self.tags = set()
+    self.groups = collections.defaultdict(list)
+
+  def Reset(self):
+    """Drops the collected tags and groups for a new run of the command."""
+    self.tags = set()
+    self.groups = collections.defaultdict(list)
+
+  def Classify(self, line):
+    """Classifies the line and collects its tags.
+
+    Args:
+      line: string, the line of the output.
+
+    Returns:
+      a frozenset of the tags of the line.
+    """
+    if not self._combined_pattern.search(line):
+      return frozenset()
+    line_tags = set()
+    for tag, pattern in self._patterns:
+      if pattern.groups:
+        for match in pattern.finditer(line):
+          line_tags.add(tag)
+          if match.group(1) not in self.groups[tag]:
+            self.groups[tag].append(match.group(1))
+      elif pattern.search(line):
+        line_tags.add(tag)
+    self.tags.update(line_tags)
+    return frozenset(line_tags)
+
 
 class CheckXcodebuildStuckThread(threading.Thread):
   """The thread class that checking if xcodebuild process stucks.
@@ -106,7 +171,8 @@ class XcodebuildTestExecutor(object):
                succeeded_signal=None,
                failed_signal=None,
                app_bundle_id=None,
-               startup_timeout_sec=None):
+               startup_timeout_sec=None,
+               toolchain=None):
     """Initializes the XcodebuildTestExecutor object.
 
     The optional argument sdk, test_type and device_id can provide more
@@ -121,6 +187,8 @@ class XcodebuildTestExecutor(object):
       failed_signal: string, the signal of command failed.
       app_bundle_id: string, the bundle id of the app under test.
       startup_timeout_sec: int, seconds until the xcodebuild is deemed stuck.
+      toolchain: xcode_info_util.Toolchain, the Xcode to run the command. By
+          default, it is the active Xcode.
     """
     self._command = command
     self._sdk = sdk
@@ -131,6 +199,8 @@ class XcodebuildTestExecutor(object):
     self._app_bundle_id = app_bundle_id
     self._startup_timeout_sec = (
         startup_timeout_sec or _XCODEBUILD_TEST_STARTUP_TIMEOUT_SEC)
+    self._toolchain = toolchain or xcode_info_util.GetToolchain()
+    self._output_classifier = None
 
   def Execute(self, return_output=True, result_bundle_path=None):
     """Executes the xcodebuild test command.
@@ -145,7 +215,7 @@ class XcodebuildTestExecutor(object):
         output: the output of xcodebuild test command or None if return_output
             is False.
     """
-    run_env = dict(os.environ)
+    run_env = dict(self._toolchain.env or os.environ)
     run_env['NSUnbufferedIO'] = 'YES'
     max_attempts = 1
     sim_log_path = None
@@ -160,6 +230,7 @@ class XcodebuildTestExecutor(object):
     test_started = False
     test_succeeded = False
     test_failed = False
+    classifier = self._GetOutputClassifier()
 
     for i in range(max_attempts):
       if result_bundle_path and os.path.exists(result_bundle_path):
@@ -170,13 +241,20 @@ class XcodebuildTestExecutor(object):
       check_xcodebuild_stuck = CheckXcodebuildStuckThread(
           process, self._startup_timeout_sec)
       check_xcodebuild_stuck.start()
+      sim_crash_detector = None
+      if sim_log_path:
+        sim_crash_detector = simulator_util.SystemLogCrashDetector(
+            sim_log_path)
+        sim_crash_detector.start()
       output = io.StringIO()
+      classifier.Reset()
       for stdout_line in process.stdout:
+        line_tags = classifier.Classify(stdout_line)
         if not test_started:
           # Terminates the CheckXcodebuildStuckThread when test has started
           # or XCTRunner.app has started.
           # But XCTRunner.app start does not mean test start.
-          if ios_constants.TEST_STARTED_SIGNAL in stdout_line:
+          if _TEST_STARTED in line_tags:
             test_started = True
             check_xcodebuild_stuck.Terminate()
           # Only terminate the check_xcodebuild_stuck thread when running on
@@ -184,19 +262,17 @@ class XcodebuildTestExecutor(object):
           # XCTRunner.app may not launch the test session sometimes
           # (error rate < 1%).
           if (self._test_type == ios_constants.TestType.XCUITEST and
-              ios_constants.XCTRUNNER_STARTED_SIGNAL in stdout_line and
+              _XCTRUNNER_STARTED in line_tags and
               self._sdk == ios_constants.SDK.IPHONESIMULATOR):
             check_xcodebuild_stuck.Terminate()
         else:
-          if self._succeeded_signal and self._succeeded_signal in stdout_line:
+          if _TEST_SUCCEEDED in line_tags:
             test_succeeded = True
-          if self._failed_signal and self._failed_signal in stdout_line:
+          if _TEST_FAILED in line_tags:
             test_failed = True
 
         print(stdout_line, flush=True, end='')
-        # If return_output is false, the output is only used for checking error
-        # cause and deleting cached files (_DeleteTestCacheFileDirs method).
-        if return_output or not test_started:
+        if return_output:
           output.write(stdout_line)
 
       try:
@@ -215,12 +291,12 @@ class XcodebuildTestExecutor(object):
 
         output_str = output.getvalue()
         # Don't need to retry the case for the damaged test bundle.
-        if _BUNDLE_DAMAGED in output_str:
+        if _TEST_BUNDLE_DAMAGED in classifier.tags:
           return (runner_exit_codes.EXITCODE.TEST_NOT_START,
                   output_str if return_output else None)
 
         if self._sdk == ios_constants.SDK.IPHONEOS:
-          if (self._NeedRetryForDeviceTesting(output_str) and
+          if (_NEED_RETRY_DEVICE_TESTING in classifier.tags and
               i < max_attempts - 1):
             logging.warning(
                 'Failed to launch test on the device. Will relaunch again '
@@ -228,34 +304,31 @@ class XcodebuildTestExecutor(object):
             )
             time.sleep(5)
             continue
-          if _TOO_MANY_INSTANCES_ALREADY_RUNNING in output_str:
+          if _NEED_REBOOT_DEVICE in classifier.tags:
             return (runner_exit_codes.EXITCODE.NEED_REBOOT_DEVICE,
                     output_str if return_output else None)
 
         if self._sdk == ios_constants.SDK.IPHONESIMULATOR:
-          if self._NeedRebootSim(output_str):
+          if _NEED_REBOOT_SIM in classifier.tags:
             return (runner_exit_codes.EXITCODE.NEED_REBOOT_DEVICE,
                     output_str if return_output else None)
-          if self._NeedRecreateSim(output_str):
+          if _NEED_RECREATE_SIM in classifier.tags:
             return (runner_exit_codes.EXITCODE.NEED_RECREATE_SIM,
                     output_str if return_output else None)
 
           # The following error can be fixed by relaunching the test again.
           try:
-            if sim_log_path and os.path.exists(sim_log_path):
-              # Sleeps short time. Then the tail simulator log can get more log.
-              time.sleep(0.5)
-              tail_sim_log = _ReadFileTailInShell(
-                  sim_log_path, _TAIL_SIM_LOG_LINE)
+            if sim_crash_detector:
+              sim_crash_detector.Stop()
               if (self._test_type == ios_constants.TestType.LOGIC_TEST and
-                  simulator_util.IsXctestFailedToLaunchOnSim(tail_sim_log) or
+                  sim_crash_detector.xctest_crashed or
                   self._test_type != ios_constants.TestType.LOGIC_TEST and
-                  simulator_util.IsAppFailedToLaunchOnSim(tail_sim_log) or
-                  simulator_util.IsCoreSimulatorCrash(tail_sim_log)):
+                  sim_crash_detector.app_crashed or
+                  sim_crash_detector.coresimulator_crashed):
                 raise ios_errors.SimError('')
-            if _PROCESS_EXISTED_OR_CRASHED_ERROR in output_str:
+            if _PROCESS_CRASHED in classifier.tags:
               raise ios_errors.SimError('')
-            if ios_constants.CORESIMULATOR_INTERRUPTED_ERROR in output_str:
+            if _CORESIMULATOR_INTERRUPTED in classifier.tags:
               # Sleep random[0,2] seconds to avoid race condition. It is a known
               # issue that CoreSimulatorService connection will be interrupted
               # if two simulators are booting at the same time.
@@ -274,7 +347,53 @@ class XcodebuildTestExecutor(object):
         return (runner_exit_codes.EXITCODE.TEST_NOT_START,
                 output_str if return_output else None)
       finally:
-        _DeleteTestCacheFileDirs(output.getvalue(), self._sdk, self._test_type)
+        if sim_crash_detector:
+          sim_crash_detector.Stop()
+        _DeleteTestCacheFileDirs(classifier.groups[_TEST_CACHE_FILE_DIR],
+                                 self._sdk, self._test_type)
+
+  def _GetOutputClassifier(self):
+    """Gets the classifier of the output of the xcodebuild test command."""
+    if self._output_classifier is not None:
+      return self._output_classifier
+    patterns = [
+        (_TEST_STARTED, re.escape(ios_constants.TEST_STARTED_SIGNAL)),
+        (_XCTRUNNER_STARTED,
+         re.escape(ios_constants.XCTRUNNER_STARTED_SIGNAL)),
+        (_TEST_BUNDLE_DAMAGED, re.escape(_BUNDLE_DAMAGED)),
+    ]
+    if self._succeeded_signal:
+      patterns.append((_TEST_SUCCEEDED, re.escape(self._succeeded_signal)))
+    if self._failed_signal:
+      patterns.append((_TEST_FAILED, re.escape(self._failed_signal)))
+    if self._sdk == ios_constants.SDK.IPHONEOS:
+      patterns.extend([
+          (_NEED_RETRY_DEVICE_TESTING, _DEVICE_TYPE_WAS_NULL_PATTERN),
+          (_NEED_RETRY_DEVICE_TESTING, re.escape(_LOST_CONNECTION_ERROR)),
+          (_NEED_RETRY_DEVICE_TESTING,
+           re.escape(_LOST_CONNECTION_TO_DTSERVICEHUB_ERROR)),
+          (_NEED_RETRY_DEVICE_TESTING, re.escape(_DEVICE_NO_LONGER_CONNECTED)),
+          (_NEED_RETRY_DEVICE_TESTING,
+           re.escape(_UNABLE_FIND_DEVICE_IDENTIFIER)),
+          (_NEED_REBOOT_DEVICE, re.escape(_TOO_MANY_INSTANCES_ALREADY_RUNNING)),
+          # The cache files of the test session, see _DeleteTestCacheFileDirs.
+          (_TEST_CACHE_FILE_DIR, '(%s/[a-z0-9]+)/' % re.escape(
+              self._toolchain.GetXcodeEmbeddedAppDeltasDir())),
+      ])
+    elif self._sdk == ios_constants.SDK.IPHONESIMULATOR:
+      if self._test_type == ios_constants.TestType.XCUITEST:
+        patterns.append(
+            (_NEED_REBOOT_SIM, re.escape(_BACKGROUND_TEST_RUNNER_ERROR)))
+      patterns.extend([
+          (_NEED_RECREATE_SIM, _APP_UNKNOWN_TO_FRONTEND_PATTERN),
+          (_NEED_RECREATE_SIM, re.escape(_REQUEST_DENIED_ERROR)),
+          (_NEED_RECREATE_SIM, re.escape(_INIT_SIM_SERVICE_ERROR)),
+          (_PROCESS_CRASHED, re.escape(_PROCESS_EXISTED_OR_CRASHED_ERROR)),
+          (_CORESIMULATOR_INTERRUPTED,
+           re.escape(ios_constants.CORESIMULATOR_INTERRUPTED_ERROR)),
+      ])
+    self._output_classifier = _OutputClassifier(patterns)
+    return self._output_classifier
 
   def _GetResultForXcodebuildStuck(self, output, return_output):
     """Gets the execution result for the xcodebuild stuck case."""
@@ -289,77 +408,27 @@ class XcodebuildTestExecutor(object):
     return (runner_exit_codes.EXITCODE.TEST_NOT_START,
             output_str if return_output else None)
 
-  def _NeedRebootSim(self, output_str):
-    """Checks if need reboot the simulator."""
-    if (self._test_type == ios_constants.TestType.XCUITEST and
-        _BACKGROUND_TEST_RUNNER_ERROR in output_str):
-      return True
-
-  def _NeedRecreateSim(self, output_str):
-    """Checks if need recreate a new simulator."""
-    if re.search(_APP_UNKNOWN_TO_FRONTEND_PATTERN, output_str):
-      return True
-    if _REQUEST_DENIED_ERROR in output_str:
-      return True
-    if _INIT_SIM_SERVICE_ERROR in output_str:
-      return True
-    return False
-
-  def _NeedRetryForDeviceTesting(self, output_str):
-    """Returns true if the device testing needs retry."""
-    return (re.search(_DEVICE_TYPE_WAS_NULL_PATTERN, output_str) or
-            _LOST_CONNECTION_ERROR in output_str or
-            _LOST_CONNECTION_TO_DTSERVICEHUB_ERROR in output_str or
-            _DEVICE_NO_LONGER_CONNECTED in output_str or
-            _UNABLE_FIND_DEVICE_IDENTIFIER in output_str)
-
-
-def _DeleteTestCacheFileDirs(xcodebuild_test_output, sdk, test_type):
-  """Deletes the cache files of the test session according to arguments."""
+
+def _DeleteTestCacheFileDirs(test_cache_file_dirs, sdk, test_type):
+  """Deletes the cache files of the test session according to arguments.
+
+  When using `xcodebuild` to run test on iOS real device, it will generate some
+  cache files under
+  DARWIN_USER_CACHE_DIR/com.apple.DeveloperTools/All/Xcode/EmbeddedAppDeltas.
+
+  Args:
+    test_cache_file_dirs: a list of the EmbeddedAppDeltas directories in the
+        `xcodebuild test` output of this test session, in order of appearance.
+    sdk: ios_constants.SDK, the sdk of the target device.
+    test_type: ios_constants.TestType, the type of the test.
+  """
   if sdk == ios_constants.SDK.IPHONEOS:
     max_cache_dir_num = 1
     if test_type == ios_constants.TestType.XCUITEST:
       # Because XCUITest will install two apps (app under test and
       # XCTRunner.app) on the device.
       max_cache_dir_num = 2
-    test_cache_file_dirs = _FetchTestCacheFileDirs(xcodebuild_test_output,
-                                                   max_cache_dir_num)
-    for cache_dir in test_cache_file_dirs:
+    for cache_dir in test_cache_file_dirs[:max_cache_dir_num]:
       if os.path.exists(cache_dir):
         logging.info('Removing cache files directory: %s', cache_dir)
         shutil.rmtree(cache_dir)
-
-
-def _FetchTestCacheFileDirs(xcodebuild_test_output, max_dir_num=1):
-  """Fetches the cache file directories of this test session.
-
-  When using `xcodebuild` to run test on iOS real device, it will generate some
-  cache files under
-  DARWIN_USER_CACHE_DIR/com.apple.DeveloperTools/All/Xcode/EmbeddedAppDeltas.
-
-  Args:
-    xcodebuild_test_output: string, the `xcodebuild test` output of this test
-        session.
-    max_dir_num: int, the max number of test cache files potentially.
-
-  Returns:
-    an array of this test's EmbeddedAppDeltas directories.
-  """
-  xcode_cache_dir = xcode_info_util.GetXcodeEmbeddedAppDeltasDir()
-  pattern = re.compile('(%s/[a-z0-9]+)/' % re.escape(xcode_cache_dir))
-  start_pos = 0
-  cache_file_dirs = set()
-  while (start_pos < len(xcodebuild_test_output) and
-         len(cache_file_dirs) < max_dir_num):
-    match = pattern.search(xcodebuild_test_output, start_pos)
-    if not match:
-      break
-    cache_file_dirs.add(match.group(1))
-    start_pos = match.end(1)
-  return cache_file_dirs
-
-
-def _ReadFileTailInShell(file_path, line):
-  """Tails the file in the last several lines."""
-  return subprocess.check_output(['tail', '-%d' % line,
-                                  file_path]).decode('utf-8')
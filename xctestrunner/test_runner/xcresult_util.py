@@ -22,7 +22,7 @@ from xctestrunner.shared import ios_errors
 from xctestrunner.shared import xcode_info_util
 
 
-def ExposeXcresult(xcresult_path, output_path):
+def ExposeXcresult(xcresult_path, output_path, toolchain=None):
   """Exposes the files from xcresult.
 
   The files includes the diagnostics files and attachments files.
@@ -30,8 +30,12 @@ def ExposeXcresult(xcresult_path, output_path):
   Args:
     xcresult_path: string, path of xcresult bundle.
     output_path: string, path of output directory.
+    toolchain: xcode_info_util.Toolchain, the Xcode which generated the
+        xcresult bundle. By default, it is the active Xcode.
   """
-  root_result_bundle = _GetResultBundleObject(xcresult_path, bundle_id=None)
+  toolchain = toolchain or xcode_info_util.GetToolchain()
+  root_result_bundle = _GetResultBundleObject(
+      toolchain, xcresult_path, bundle_id=None)
   actions = root_result_bundle['actions']['_values']
   action_result = None
   for action in actions:
@@ -42,28 +46,28 @@ def ExposeXcresult(xcresult_path, output_path):
     raise ios_errors.XcresultError(
         'Failed to get "ActionResult" from result bundle %s' %
         root_result_bundle)
-  _ExposeDiagnostics(xcresult_path, output_path, action_result)
-  _ExposeAttachments(xcresult_path, output_path, action_result)
+  _ExposeDiagnostics(toolchain, xcresult_path, output_path, action_result)
+  _ExposeAttachments(toolchain, xcresult_path, output_path, action_result)
 
 
-def _ExposeDiagnostics(xcresult_path, output_path, action_result):
+def _ExposeDiagnostics(toolchain, xcresult_path, output_path, action_result):
   """Exposes the diagnostics files from the given xcresult file."""
   if 'diagnosticsRef' not in action_result:
     return
   diagnostics_id = action_result['diagnosticsRef']['id']['_value']
-  export_command = _MakeXcresulttoolCommand([
+  export_command = _MakeXcresulttoolCommand(toolchain, [
     'export', '--path', xcresult_path,
     '--output-path', output_path, '--type', 'directory', '--id',
     diagnostics_id
   ])
-  subprocess.check_call(export_command)
+  subprocess.check_call(export_command, env=toolchain.env)
 
 
-def _ExposeAttachments(xcresult_path, output_path, action_result):
+def _ExposeAttachments(toolchain, xcresult_path, output_path, action_result):
   """Exposes the attachments files from the given xcresult file."""
   testsref_id = action_result['testsRef']['id']['_value']
   test_plan_summaries = _GetResultBundleObject(
-      xcresult_path, bundle_id=testsref_id)
+      toolchain, xcresult_path, bundle_id=testsref_id)
   test_plan_summary = test_plan_summaries['summaries']['_values'][0]
   testable_summary = test_plan_summary['testableSummaries']['_values'][0]
   # If the app under test crashes in unit test (XCTest) before loading the
@@ -73,7 +77,8 @@ def _ExposeAttachments(xcresult_path, output_path, action_result):
   root_tests_summary = testable_summary['tests']['_values'][0]
   failure_test_ref_ids = _GetFailureTestRefs(root_tests_summary)
   for test_ref_id in failure_test_ref_ids:
-    test_summary_result = _GetResultBundleObject(xcresult_path, test_ref_id)
+    test_summary_result = _GetResultBundleObject(
+        toolchain, xcresult_path, test_ref_id)
     # if the test results in an `expectedFailures` entry, there might be an
     # `activitySummaries` field present.
     if 'activitySummaries' not in test_summary_result:
@@ -92,30 +97,32 @@ def _ExposeAttachments(xcresult_path, output_path, action_result):
           target_file_path = os.path.join(target_file_dir, file_name)
 
           payload_ref_id = attachment['payloadRef']['id']['_value']
-          export_command = _MakeXcresulttoolCommand([
+          export_command = _MakeXcresulttoolCommand(toolchain, [
             'export', '--path', xcresult_path,
             '--output-path', target_file_path, '--type', 'file', '--id',
             payload_ref_id
           ])
-          subprocess.check_call(export_command)
+          subprocess.check_call(export_command, env=toolchain.env)
 
 
-def _GetResultBundleObject(xcresult_path, bundle_id=None):
+def _GetResultBundleObject(toolchain, xcresult_path, bundle_id=None):
   """Gets the result bundle object in json format.
 
   Args:
+    toolchain: xcode_info_util.Toolchain, the Xcode to run xcresulttool.
     xcresult_path: string, path of xcresult bundle.
     bundle_id: string, id of the result bundle object. If it is None, it is
         rootID.
   Returns:
     A dict, result bundle object in json format.
   """
-  command = _MakeXcresulttoolCommand([
+  command = _MakeXcresulttoolCommand(toolchain, [
     'get', '--format', 'json', '--path', xcresult_path
   ])
   if bundle_id:
     command.extend(['--id', bundle_id])
-  return json.loads(subprocess.check_output(command).decode('utf-8'))
+  return json.loads(
+      subprocess.check_output(command, env=toolchain.env).decode('utf-8'))
 
 
 def _GetFailureTestRefs(test_summary):
@@ -138,16 +145,17 @@ def _GetFailureTestRefs(test_summary):
       failure_test_refs.append(summary_ref_id)
   return failure_test_refs
 
-def _MakeXcresulttoolCommand(args):
+def _MakeXcresulttoolCommand(toolchain, args):
   """Constructs xcresulttool command for selected Xcode version.
 
   Args:
+    toolchain: xcode_info_util.Toolchain, the Xcode to run xcresulttool.
     args: array, a list of arguments to pass to xcresulttool.
   Returns:
     The xcresulttool command.
   """
-  command = ['xcrun', 'xcresulttool'] + args
-  xcode_version = xcode_info_util.GetXcodeVersionNumber()
+  command = toolchain.ResolveXcrunCommand(['xcrun', 'xcresulttool'] + args)
+  xcode_version = toolchain.GetXcodeVersionNumber()
   if xcode_version >= 1600:
     command.extend(['--legacy'])
   return command
@@ -23,8 +23,13 @@ import tempfile
 from xctestrunner.shared import bundle_util
 from xctestrunner.shared import ios_constants
 from xctestrunner.shared import ios_errors
+from xctestrunner.shared import macho
+from xctestrunner.shared import materialize_util
+from xctestrunner.shared import task_graph
 from xctestrunner.shared import xcode_info_util
+from xctestrunner.simulator_control import simulator_log_capture
 from xctestrunner.test_runner import logic_test_util
+from xctestrunner.test_runner import test_root_cache
 from xctestrunner.test_runner import xcresult_util
 from xctestrunner.test_runner import xctestrun
 
@@ -32,7 +37,9 @@ from xctestrunner.test_runner import xctestrun
 class XctestSession(object):
   """The class that runs XCTEST based tests."""
 
-  def __init__(self, sdk, device_arch, work_dir=None, output_dir=None):
+  def __init__(self, sdk, device_arch, work_dir=None, output_dir=None,
+               toolchain=None, test_root_cache=None, extraction_cache=None,
+               signed_framework_cache=None):
     """Initializes the XctestSession object.
 
     If work_dir is not provdied, will create a temp direcotry to be work_dir and
@@ -48,6 +55,15 @@ class XctestSession(object):
           communication log between host machine and device;
           2) the screenshots of every test stages (XCUITest). If directory is
           specified, the directory will not be deleted after test ends.'
+      toolchain: xcode_info_util.Toolchain, the Xcode to run the test. By
+          default, it is the active Xcode.
+      test_root_cache: test_root_cache.TestRootCache, the cache of the
+          prepared TEST_ROOT directories. None means not using the cache.
+      extraction_cache: extraction_cache.ExtractionCache, the cache of the
+          extracted ipa and zip files. None means not using the cache.
+      signed_framework_cache: signed_framework_cache.SignedFrameworkCache, the
+          cache of the Xcode frameworks signed for device tests. None means not
+          using the cache.
     """
     self._sdk = sdk
     self._device_arch = device_arch
@@ -55,11 +71,16 @@ class XctestSession(object):
     self._delete_work_dir = True
     self._output_dir = output_dir
     self._delete_output_dir = True
+    self._toolchain = toolchain or xcode_info_util.GetToolchain()
+    self._test_root_cache = test_root_cache
+    self._extraction_cache = extraction_cache
+    self._signed_framework_cache = signed_framework_cache
     self._startup_timeout_sec = None
     self._destination_timeout_sec = None
     self._xctestrun_obj = None
     self._prepared = False
     self._keep_xcresult_data = True
+    self._simulator_log_options = None
     # The following fields are only for Logic Test.
     self._logic_test_bundle = None
     self._logic_test_env_vars = None
@@ -127,8 +148,26 @@ class XctestSession(object):
       if not test_bundle:
         raise ios_errors.IllegalArgumentError(
             'Without providing xctestrun file, test bundle is required.')
+      test_root_dir = os.path.join(self._work_dir, 'TEST_ROOT')
+      cache_key = None
+      if self._test_root_cache:
+        cache_key = test_root_cache.ComputeKey(
+            app_under_test, test_bundle, self._sdk, self._device_arch,
+            test_type, signing_options, self._toolchain)
+        metadata = self._test_root_cache.Materialize(cache_key, test_root_dir)
+        if metadata:
+          self._xctestrun_obj = xctestrun.XctestRun(
+              os.path.join(test_root_dir, 'test.xctestrun'),
+              test_type=metadata['test_type'],
+              aut_bundle_id=metadata['aut_bundle_id'])
+          self._prepared = True
+          return
+        # The factory reuses an existing TEST_ROOT of the work directory
+        # regardless of the inputs. It must not be stored under the new key.
+        if os.path.exists(test_root_dir):
+          shutil.rmtree(test_root_dir)
       app_under_test_dir, test_bundle_dir = _PrepareBundles(
-          self._work_dir, app_under_test, test_bundle)
+          self._work_dir, app_under_test, test_bundle, self._extraction_cache)
       test_type = _FinalizeTestType(
           test_bundle_dir, self._sdk, app_under_test_dir=app_under_test_dir,
           original_test_type=test_type)
@@ -141,8 +180,15 @@ class XctestSession(object):
       if test_type != ios_constants.TestType.LOGIC_TEST:
         xctestrun_factory = xctestrun.XctestRunFactory(
             app_under_test_dir, test_bundle_dir, self._sdk, self._device_arch,
-            test_type, signing_options, self._work_dir)
+            test_type, signing_options, self._work_dir,
+            toolchain=self._toolchain,
+            signed_framework_cache=self._signed_framework_cache)
         self._xctestrun_obj = xctestrun_factory.GenerateXctestrun()
+        if cache_key:
+          self._test_root_cache.Store(cache_key, test_root_dir, {
+              'test_type': self._xctestrun_obj.test_type,
+              'aut_bundle_id': self._xctestrun_obj.aut_bundle_id,
+          })
       else:
         self._logic_test_bundle = test_bundle_dir
     self._prepared = True
@@ -164,6 +210,8 @@ class XctestSession(object):
     self._startup_timeout_sec = launch_options.get('startup_timeout_sec')
     self._destination_timeout_sec = launch_options.get(
         'destination_timeout_sec')
+    if launch_options.get('stream_simulator_log'):
+      self._simulator_log_options = launch_options
     if self._xctestrun_obj:
       self._xctestrun_obj.SetTestEnvVars(launch_options.get('env_vars'))
       self._xctestrun_obj.SetTestArgs(launch_options.get('args'))
@@ -182,6 +230,8 @@ class XctestSession(object):
           self._xctestrun_obj.DeleteXctestrunField('SystemAttachmentLifetime')
         except ios_errors.PlistError:
           pass
+      # Writes all the launch options to the xctestrun file at once.
+      self._xctestrun_obj.Flush()
     elif self._logic_test_bundle:
       self._logic_test_env_vars = launch_options.get('env_vars')
       self._logic_test_args = launch_options.get('args')
@@ -205,6 +255,24 @@ class XctestSession(object):
           'The session has not been prepared. Please call '
           'XctestSession.Prepare first.')
 
+    if (self._simulator_log_options and
+        self._sdk == ios_constants.SDK.IPHONESIMULATOR):
+      options = self._simulator_log_options
+      with simulator_log_capture.SimulatorLogCapture(
+          device_id,
+          os.path.join(self._output_dir, 'SimulatorLog'),
+          predicate=options.get('simulator_log_predicate'),
+          max_size_bytes=options.get(
+              'simulator_log_max_size_mb',
+              simulator_log_capture.DEFAULT_MAX_SIZE_BYTES // 1024 // 1024) *
+          1024 * 1024,
+          compression=options.get('simulator_log_compression',
+                                  simulator_log_capture.Compression.GZIP)):
+        return self._RunTest(device_id, os_version)
+    return self._RunTest(device_id, os_version)
+
+  def _RunTest(self, device_id, os_version):
+    """Runs test on the target device. See RunTest for details."""
     if self._xctestrun_obj:
       result_bundle_path = os.path.join(self._output_dir, 'test.xcresult')
       exit_code = self._xctestrun_obj.Run(device_id, self._sdk,
@@ -212,12 +280,14 @@ class XctestSession(object):
                                           self._startup_timeout_sec,
                                           self._destination_timeout_sec,
                                           os_version=os_version,
-                                          result_bundle_path=result_bundle_path)
+                                          result_bundle_path=result_bundle_path,
+                                          toolchain=self._toolchain)
       # The xcresult only contains raw data in Xcode 11 or later.
-      if xcode_info_util.GetXcodeVersionNumber() >= 1100:
+      if self._toolchain.GetXcodeVersionNumber() >= 1100:
         expose_xcresult = os.path.join(self._output_dir, 'ExposeXcresult')
         try:
-          xcresult_util.ExposeXcresult(result_bundle_path, expose_xcresult)
+          xcresult_util.ExposeXcresult(result_bundle_path, expose_xcresult,
+                                       toolchain=self._toolchain)
           if not self._keep_xcresult_data:
             shutil.rmtree(result_bundle_path)
         except subprocess.CalledProcessError as e:
@@ -230,7 +300,8 @@ class XctestSession(object):
           self._logic_test_env_vars,
           self._logic_test_args,
           self._logic_tests_to_run,
-          os_version=os_version)
+          os_version=os_version,
+          toolchain=self._toolchain)
     else:
       raise ios_errors.XcodebuildTestError('Unexpected runtime error.')
 
@@ -244,7 +315,8 @@ class XctestSession(object):
       shutil.rmtree(self._output_dir)
 
 
-def _PrepareBundles(working_dir, app_under_test_path, test_bundle_path):
+def _PrepareBundles(working_dir, app_under_test_path, test_bundle_path,
+                    extraction_cache=None):
   """Prepares the bundles in work directory.
 
   If the original bundle is .ipa, the .ipa file will be unzipped under
@@ -257,6 +329,8 @@ def _PrepareBundles(working_dir, app_under_test_path, test_bundle_path):
         It can be .ipa or .app. It can be None.
     test_bundle_path: string, the path of the test bundle to be tested. It can
         be .ipa or .xctest.
+    extraction_cache: extraction_cache.ExtractionCache, the cache of the
+        extracted ipa and zip files. None means not using the cache.
 
   Returns:
     a tuple with two items:
@@ -268,7 +342,6 @@ def _PrepareBundles(working_dir, app_under_test_path, test_bundle_path):
       exist or its extension is invaild.
   """
   working_dir = os.path.abspath(working_dir)
-  app_under_test_dir = None
   if app_under_test_path:
     if not os.path.exists(app_under_test_path):
       raise ios_errors.IllegalArgumentError(
@@ -278,21 +351,6 @@ def _PrepareBundles(working_dir, app_under_test_path, test_bundle_path):
       raise ios_errors.IllegalArgumentError(
           'The app under test %s should be with .app or .ipa extension.'
           % app_under_test_path)
-
-    app_under_test_dir = os.path.join(
-        working_dir,
-        os.path.splitext(os.path.basename(app_under_test_path))[0] + '.app')
-    if not os.path.exists(app_under_test_dir):
-      if app_under_test_path.endswith('.ipa'):
-        extract_app_under_test_dir = bundle_util.ExtractApp(
-            app_under_test_path, working_dir)
-        shutil.move(extract_app_under_test_dir, app_under_test_dir)
-      elif not os.path.abspath(app_under_test_path).startswith(working_dir):
-        # Only copies the app under test if it is not in working directory.
-        shutil.copytree(app_under_test_path, app_under_test_dir)
-      else:
-        app_under_test_dir = app_under_test_path
-
   if not os.path.exists(test_bundle_path):
     raise ios_errors.IllegalArgumentError(
         'The test bundle does not exists: %s' % test_bundle_path)
@@ -303,21 +361,57 @@ def _PrepareBundles(working_dir, app_under_test_path, test_bundle_path):
         'The test bundle %s should be with .xctest, .ipa or .zip extension.'
         % test_bundle_path)
 
-  test_bundle_dir = os.path.join(
-      working_dir,
-      os.path.splitext(os.path.basename(test_bundle_path))[0] + '.xctest')
-  if not os.path.exists(test_bundle_dir):
-    if test_bundle_path.endswith('.ipa') or test_bundle_path.endswith('.zip'):
-      extract_test_bundle_dir = bundle_util.ExtractTestBundle(
-          test_bundle_path, working_dir)
-      shutil.move(extract_test_bundle_dir, test_bundle_dir)
-    elif not os.path.abspath(test_bundle_path).startswith(working_dir):
-      # Only copies the test bundle if it is not in working directory.
-      shutil.copytree(test_bundle_path, test_bundle_dir)
-    else:
-      test_bundle_dir = test_bundle_path
+  # The app under test and the test bundle are extracted concurrently.
+  bundle_dirs = {'app_under_test': None}
+  graph = task_graph.TaskGraph()
+  if app_under_test_path:
+    def _PrepareAppUnderTest():
+      bundle_dirs['app_under_test'] = _PrepareBundle(
+          working_dir, app_under_test_path, '.app', bundle_util.ExtractApp,
+          extraction_cache)
+    graph.AddTask('app_under_test', _PrepareAppUnderTest)
+
+  def _PrepareTestBundle():
+    bundle_dirs['test_bundle'] = _PrepareBundle(
+        working_dir, test_bundle_path, '.xctest', bundle_util.ExtractTestBundle,
+        extraction_cache)
+  graph.AddTask('test_bundle', _PrepareTestBundle)
+  graph.Run(max_workers=2)
+  return bundle_dirs['app_under_test'], bundle_dirs['test_bundle']
 
-  return app_under_test_dir, test_bundle_dir
+
+def _PrepareBundle(working_dir, bundle_path, bundle_extension, extract_fn,
+                   extraction_cache):
+  """Prepares the bundle in work directory.
+
+  Args:
+    working_dir: string, the absolute path of the working directory.
+    bundle_path: string, the path of the bundle or the archive of the bundle.
+    bundle_extension: string, the extension of the bundle, .app or .xctest.
+    extract_fn: the function to extract the bundle from the archive, e.g.,
+        bundle_util.ExtractApp.
+    extraction_cache: extraction_cache.ExtractionCache, the cache of the
+        extracted ipa and zip files. None means not using the cache.
+
+  Returns:
+    the path of the bundle directory under work directory.
+  """
+  bundle_dir = os.path.join(
+      working_dir,
+      os.path.splitext(os.path.basename(bundle_path))[0] + bundle_extension)
+  if os.path.exists(bundle_dir):
+    return bundle_dir
+  if not bundle_path.endswith(bundle_extension):
+    # Each archive is extracted in its own temporary directory, so the bundles
+    # extracted concurrently do not collide in working_dir.
+    shutil.move(extract_fn(bundle_path, working_dir, extraction_cache),
+                bundle_dir)
+  elif not os.path.abspath(bundle_path).startswith(working_dir):
+    # Only copies the bundle if it is not in working directory.
+    materialize_util.MaterializeTree(bundle_path, bundle_dir)
+  else:
+    bundle_dir = bundle_path
+  return bundle_dir
 
 
 def _FinalizeTestType(
@@ -377,9 +471,7 @@ def _DetectTestType(test_bundle_dir):
   test_bundle_exec_path = os.path.join(
       test_bundle_dir,
       os.path.splitext(os.path.basename(test_bundle_dir))[0])
-  output = subprocess.check_output(['nm',
-                                    test_bundle_exec_path]).decode('utf-8')
-  if 'XCUIApplication' in output:
+  if macho.HasSymbolContaining(test_bundle_exec_path, 'XCUIApplication'):
     return ios_constants.TestType.XCUITEST
   else:
     return ios_constants.TestType.XCTEST
@@ -14,6 +14,7 @@
 
 """Helper class for xctestrun file generated by prebuilt bundles."""
 
+import functools
 import logging
 import os
 import shutil
@@ -22,7 +23,9 @@ import tempfile
 from xctestrunner.shared import bundle_util
 from xctestrunner.shared import ios_constants
 from xctestrunner.shared import ios_errors
+from xctestrunner.shared import materialize_util
 from xctestrunner.shared import plist_util
+from xctestrunner.shared import task_graph
 from xctestrunner.shared import version_util
 from xctestrunner.shared import xcode_info_util
 from xctestrunner.test_runner import xcodebuild_test_executor
@@ -35,7 +38,12 @@ _LIB_XCTEST_SWIFT_RELATIVE_PATH = 'Developer/usr/lib/libXCTestSwiftSupport.dylib
 
 
 class XctestRun(object):
-  """Handles running test by xctestrun."""
+  """Handles running test by xctestrun.
+
+  The xctestrun file is parsed once. The changes of the fields are kept in
+  memory and written to the file once by Flush, which is also called before
+  running the test.
+  """
 
   def __init__(self, xctestrun_file_path, test_type=None, aut_bundle_id=None):
     """Initializes the XctestRun object.
@@ -53,10 +61,10 @@ class XctestRun(object):
       IllegalArgumentError: when the sdk or test type is not supported.
     """
     self._xctestrun_file_path = xctestrun_file_path
-    self._xctestrun_file_plist_obj = plist_util.Plist(xctestrun_file_path)
+    self._xctestrun_document = plist_util.PlistDocument(xctestrun_file_path)
     # xctestrun file always has only key at root dict.
     self._root_key = list(
-        self._xctestrun_file_plist_obj.GetPlistField(None).keys())[0]
+        self._xctestrun_document.GetPlistField(None).keys())[0]
     self._test_type = test_type
     self._aut_bundle_id = aut_bundle_id
 
@@ -143,7 +151,7 @@ class XctestRun(object):
 
   def Run(self, device_id, sdk, derived_data_dir, startup_timeout_sec,
           destination_timeout_sec=None, os_version=None,
-          result_bundle_path=None):
+          result_bundle_path=None, toolchain=None):
     """Runs the test with generated xctestrun file in the specific device.
 
     Args:
@@ -155,6 +163,8 @@ class XctestRun(object):
           the destination device.
       os_version: os version of the device.
       result_bundle_path: path to output a xcresult bundle to
+      toolchain: xcode_info_util.Toolchain, the Xcode to run the test. By
+          default, it is the active Xcode.
 
     Returns:
       A value of type runner_exit_codes.EXITCODE.
@@ -163,15 +173,17 @@ class XctestRun(object):
     # later, it is required to add swift5 fallback libraries to environment
     # variable.
     # See https://github.com/bazelbuild/rules_apple/issues/684 for context.
-    xcode_version = xcode_info_util.GetXcodeVersionNumber()
+    toolchain = toolchain or xcode_info_util.GetToolchain()
+    xcode_version = toolchain.GetXcodeVersionNumber()
     if (xcode_version >= 1100 and
         sdk == ios_constants.SDK.IPHONESIMULATOR and os_version and
         version_util.GetVersionNumber(os_version) < 1220):
       new_env_var = {
           'DYLD_FALLBACK_LIBRARY_PATH':
-              xcode_info_util.GetSwift5FallbackLibsDir()
+              toolchain.GetSwift5FallbackLibsDir()
       }
       self.SetTestEnvVars(new_env_var)
+    self.Flush()
     logging.info('Running test-without-building with device %s', device_id)
     command = ['xcodebuild', 'test-without-building',
                '-xctestrun', self._xctestrun_file_path,
@@ -195,10 +207,15 @@ class XctestRun(object):
         test_type=self.test_type,
         device_id=device_id,
         app_bundle_id=self._aut_bundle_id,
-        startup_timeout_sec=startup_timeout_sec).Execute(
+        startup_timeout_sec=startup_timeout_sec,
+        toolchain=toolchain).Execute(
             return_output=False, result_bundle_path=result_bundle_path)
     return exit_code
 
+  @property
+  def aut_bundle_id(self):
+    return self._aut_bundle_id
+
   @property
   def test_type(self):
     if not self._test_type:
@@ -220,7 +237,7 @@ class XctestRun(object):
       exist in the plist dict.
     """
     try:
-      return self._xctestrun_file_plist_obj.GetPlistField(
+      return self._xctestrun_document.GetPlistField(
           '%s:%s' % (self._root_key, field))
     except ios_errors.PlistError:
       return None
@@ -235,12 +252,8 @@ class XctestRun(object):
     Returns:
       boolean, if the specific field is in the xctestrun file.
     """
-    try:
-      self._xctestrun_file_plist_obj.GetPlistField(
-          '%s:%s' % (self._root_key, field))
-      return True
-    except ios_errors.PlistError:
-      return False
+    return self._xctestrun_document.HasPlistField(
+        '%s:%s' % (self._root_key, field))
 
   def SetXctestrunField(self, field, value):
     """Sets the field with provided value in xctestrun file.
@@ -254,7 +267,7 @@ class XctestRun(object):
     Raises:
       ios_errors.PlistError: the field does not exist in the .plist file's dict.
     """
-    self._xctestrun_file_plist_obj.SetPlistField(
+    self._xctestrun_document.SetPlistField(
         '%s:%s' % (self._root_key, field), value)
 
   def DeleteXctestrunField(self, field):
@@ -267,9 +280,13 @@ class XctestRun(object):
     Raises:
       PlistError: the field does not exist in the .plist file's dict.
     """
-    self._xctestrun_file_plist_obj.DeletePlistField(
+    self._xctestrun_document.DeletePlistField(
         '%s:%s' % (self._root_key, field))
 
+  def Flush(self):
+    """Writes the changed fields to the xctestrun file."""
+    self._xctestrun_document.Flush()
+
 
 class XctestRunFactory(object):
   """The class to generate xctestrunfile by building dummy project."""
@@ -278,7 +295,8 @@ class XctestRunFactory(object):
                sdk=ios_constants.SDK.IPHONESIMULATOR,
                device_arch=ios_constants.ARCH.X86_64,
                test_type=ios_constants.TestType.XCUITEST,
-               signing_options=None, work_dir=None):
+               signing_options=None, work_dir=None, toolchain=None,
+               signed_framework_cache=None):
     """Initializes the XctestRun object.
 
     If arg work_dir is provided, the original app under test file and test
@@ -295,6 +313,11 @@ class XctestRunFactory(object):
       signing_options: dict, the signing app options. See
           ios_constants.SIGNING_OPTIONS_JSON_HELP for details.
       work_dir: string, work directory which contains run files.
+      toolchain: xcode_info_util.Toolchain, the Xcode to generate the test
+          root. By default, it is the active Xcode.
+      signed_framework_cache: signed_framework_cache.SignedFrameworkCache, the
+          cache of the Xcode frameworks signed for device tests. None means not
+          using the cache.
 
     Raises:
       IllegalArgumentError: when the sdk or test type is not supported.
@@ -320,6 +343,8 @@ class XctestRunFactory(object):
     self._xctestrun_obj = None
     self._xctestrun_dict = None
     self._delete_work_dir = False
+    self._toolchain = toolchain or xcode_info_util.GetToolchain()
+    self._signed_framework_cache = signed_framework_cache
     self._ValidateArguments()
 
   def __enter__(self):
@@ -422,7 +447,7 @@ class XctestRunFactory(object):
     Then copies app under test, test bundle, test.xctestrun and uitest
     runner app to test root directory.
     """
-    platform_path = xcode_info_util.GetSdkPlatformPath(self._sdk)
+    platform_path = self._toolchain.GetSdkPlatformPath(self._sdk)
     platform_library_path = os.path.join(platform_path, 'Developer/Library')
     uitest_runner_app = self._GetUitestRunnerAppFromXcode(platform_library_path)
     self._PrepareUitestInRunerApp(uitest_runner_app)
@@ -474,41 +499,50 @@ class XctestRunFactory(object):
 
       runner_app_frameworks_dir = os.path.join(uitest_runner_app, 'Frameworks')
       os.mkdir(runner_app_frameworks_dir)
-      _CopyAndSignFramework(
+      framework_paths = [
           os.path.join(platform_library_path, 'Frameworks/XCTest.framework'),
-          runner_app_frameworks_dir, test_bundle_signing_identity)
-      _CopyAndSignFramework(
           os.path.join(platform_library_path,
                        'PrivateFrameworks/XCTAutomationSupport.framework'),
-          runner_app_frameworks_dir, test_bundle_signing_identity)
-      if xcode_info_util.GetXcodeVersionNumber() >= 1100:
-        _CopyAndSignLibFile(
-            os.path.join(platform_path, _LIB_XCTEST_SWIFT_RELATIVE_PATH),
-            runner_app_frameworks_dir, test_bundle_signing_identity)
-      bundle_util.CodesignBundle(
-          uitest_runner_app,
-          entitlements_plist_path=entitlements_plist_path,
-          identity=test_bundle_signing_identity)
-      if xcode_info_util.GetXcodeVersionNumber() >= 1300:
-        _CopyAndSignFramework(
-          os.path.join(platform_library_path,
-                       'PrivateFrameworks/XCUIAutomation.framework'),
-          runner_app_frameworks_dir, test_bundle_signing_identity)
-        _CopyAndSignFramework(
-          os.path.join(platform_library_path,
-                       'PrivateFrameworks/XCTestCore.framework'),
-          runner_app_frameworks_dir, test_bundle_signing_identity)
-        _CopyAndSignFramework(
-          os.path.join(platform_library_path,
-                       'PrivateFrameworks/XCUnit.framework'),
-          runner_app_frameworks_dir, test_bundle_signing_identity)
-      if xcode_info_util.GetXcodeVersionNumber() >= 1430:
-         _CopyAndSignFramework(
-           os.path.join(platform_library_path,
-                    'PrivateFrameworks/XCTestSupport.framework'),
-           runner_app_frameworks_dir, test_bundle_signing_identity)
-      bundle_util.CodesignBundle(self._test_bundle_dir)
-      bundle_util.CodesignBundle(self._app_under_test_dir)
+      ]
+      if self._toolchain.GetXcodeVersionNumber() >= 1100:
+        framework_paths.append(
+            os.path.join(platform_path, _LIB_XCTEST_SWIFT_RELATIVE_PATH))
+      if self._toolchain.GetXcodeVersionNumber() >= 1300:
+        framework_paths.extend([
+            os.path.join(platform_library_path,
+                         'PrivateFrameworks/XCUIAutomation.framework'),
+            os.path.join(platform_library_path,
+                         'PrivateFrameworks/XCTestCore.framework'),
+            os.path.join(platform_library_path,
+                         'PrivateFrameworks/XCUnit.framework'),
+        ])
+      if self._toolchain.GetXcodeVersionNumber() >= 1430:
+        framework_paths.append(
+            os.path.join(platform_library_path,
+                         'PrivateFrameworks/XCTestSupport.framework'))
+      # The frameworks and the test bundle are signed concurrently. The runner
+      # app is signed after them, since its signature seals its contents.
+      signing_graph = task_graph.TaskGraph()
+      runner_app_content_tasks = _AddCopyAndSignTasks(
+          signing_graph, framework_paths, runner_app_frameworks_dir,
+          test_bundle_signing_identity, self._signed_framework_cache)
+      runner_app_content_tasks.append(signing_graph.AddTask(
+          'test_bundle',
+          functools.partial(bundle_util.CodesignBundle,
+                            self._test_bundle_dir)))
+      signing_graph.AddTask(
+          'uitest_runner_app',
+          functools.partial(
+              bundle_util.CodesignBundle,
+              uitest_runner_app,
+              entitlements_plist_path=entitlements_plist_path,
+              identity=test_bundle_signing_identity),
+          deps=runner_app_content_tasks)
+      signing_graph.AddTask(
+          'app_under_test',
+          functools.partial(bundle_util.CodesignBundle,
+                            self._app_under_test_dir))
+      signing_graph.Run()
 
     platform_name = 'iPhoneOS' if self._on_device else 'iPhoneSimulator'
     developer_path = '__PLATFORMS__/%s.platform/Developer' % platform_name
@@ -552,7 +586,7 @@ class XctestRunFactory(object):
                                      uitest_runner_app_name + '.app')
     if os.path.exists(uitest_runner_app):
       shutil.rmtree(uitest_runner_app)
-    shutil.copytree(xctrunner_app, uitest_runner_app)
+    materialize_util.MaterializeTree(xctrunner_app, uitest_runner_app)
     uitest_runner_exec = os.path.join(uitest_runner_app, uitest_runner_app_name)
     shutil.move(
         os.path.join(uitest_runner_app, 'XCTRunner'), uitest_runner_exec)
@@ -596,7 +630,8 @@ class XctestRunFactory(object):
       # app installation error.
       new_test_bundle_path = os.path.join(
           runner_app_plugins_dir, os.path.basename(self._test_bundle_dir))
-      shutil.copytree(self._test_bundle_dir, new_test_bundle_path)
+      materialize_util.MaterializeTree(self._test_bundle_dir,
+                                       new_test_bundle_path)
       self._test_bundle_dir = new_test_bundle_path
     else:
       self._test_bundle_dir = _MoveAndReplaceFile(self._test_bundle_dir,
@@ -617,71 +652,75 @@ class XctestRunFactory(object):
     # The test bundle under PlugIns can not be symlink since it will cause
     # app installation error.
     if os.path.islink(self._test_bundle_dir):
-      shutil.copytree(self._test_bundle_dir, new_test_bundle_path)
+      materialize_util.MaterializeTree(self._test_bundle_dir,
+                                       new_test_bundle_path)
       self._test_bundle_dir = new_test_bundle_path
     elif new_test_bundle_path != self._test_bundle_dir:
       self._test_bundle_dir = _MoveAndReplaceFile(
           self._test_bundle_dir, app_under_test_plugins_dir)
 
     if self._on_device:
-      platform_path = xcode_info_util.GetSdkPlatformPath(self._sdk)
+      platform_path = self._toolchain.GetSdkPlatformPath(self._sdk)
       app_under_test_frameworks_dir = os.path.join(self._app_under_test_dir,
                                                    'Frameworks')
       if not os.path.exists(app_under_test_frameworks_dir):
         os.mkdir(app_under_test_frameworks_dir)
       app_under_test_signing_identity = bundle_util.GetCodesignIdentity(
           self._app_under_test_dir)
-      _CopyAndSignFramework(
+      framework_paths = [
           os.path.join(platform_path,
                        'Developer/Library/Frameworks/XCTest.framework'),
-          app_under_test_frameworks_dir, app_under_test_signing_identity)
-      bundle_injection_lib = os.path.join(
-          platform_path, 'Developer/usr/lib/libXCTestBundleInject.dylib')
-      _CopyAndSignLibFile(bundle_injection_lib, app_under_test_frameworks_dir,
-                          app_under_test_signing_identity)
-      if xcode_info_util.GetXcodeVersionNumber() >= 1100:
-        _CopyAndSignFramework(
+          os.path.join(platform_path,
+                       'Developer/usr/lib/libXCTestBundleInject.dylib'),
+      ]
+      if self._toolchain.GetXcodeVersionNumber() >= 1100:
+        framework_paths.extend([
             os.path.join(
                 platform_path, 'Developer/Library/PrivateFrameworks/'
                 'XCTAutomationSupport.framework'),
-            app_under_test_frameworks_dir, app_under_test_signing_identity)
-        _CopyAndSignLibFile(
             os.path.join(platform_path, _LIB_XCTEST_SWIFT_RELATIVE_PATH),
-            app_under_test_frameworks_dir, app_under_test_signing_identity)
-      if xcode_info_util.GetXcodeVersionNumber() >= 1300:
-        if xcode_info_util.GetXcodeVersionNumber() >= 1640:
-          _CopyAndSignFramework(
+        ])
+      if self._toolchain.GetXcodeVersionNumber() >= 1300:
+        if self._toolchain.GetXcodeVersionNumber() >= 1640:
+          framework_paths.append(
               os.path.join(
                   platform_path, 'Developer/Library/Frameworks/'
-                  'XCUIAutomation.framework'),
-              app_under_test_frameworks_dir, app_under_test_signing_identity)
+                  'XCUIAutomation.framework'))
         else:
-          _CopyAndSignFramework(
+          framework_paths.append(
               os.path.join(
                   platform_path, 'Developer/Library/PrivateFrameworks/'
-                  'XCUIAutomation.framework'),
-              app_under_test_frameworks_dir, app_under_test_signing_identity)
-        _CopyAndSignFramework(
+                  'XCUIAutomation.framework'))
+        framework_paths.extend([
             os.path.join(
                 platform_path, 'Developer/Library/PrivateFrameworks/'
                 'XCTestCore.framework'),
-            app_under_test_frameworks_dir, app_under_test_signing_identity)
-        _CopyAndSignFramework(
             os.path.join(
                 platform_path, 'Developer/Library/PrivateFrameworks/'
                 'XCUnit.framework'),
-            app_under_test_frameworks_dir, app_under_test_signing_identity)
-      if xcode_info_util.GetXcodeVersionNumber() >= 1430:
-        _CopyAndSignFramework(
+        ])
+      if self._toolchain.GetXcodeVersionNumber() >= 1430:
+        framework_paths.append(
             os.path.join(
                 platform_path,
-                'Developer/Library/PrivateFrameworks/XCTestSupport.framework',
-            ),
-            app_under_test_frameworks_dir,
-            app_under_test_signing_identity,
-        )
-      bundle_util.CodesignBundle(self._test_bundle_dir)
-      bundle_util.CodesignBundle(self._app_under_test_dir)
+                'Developer/Library/PrivateFrameworks/XCTestSupport.framework'))
+      # The frameworks and the test bundle are signed concurrently. The app
+      # under test is signed after them, since its signature seals its
+      # contents.
+      signing_graph = task_graph.TaskGraph()
+      app_under_test_content_tasks = _AddCopyAndSignTasks(
+          signing_graph, framework_paths, app_under_test_frameworks_dir,
+          app_under_test_signing_identity, self._signed_framework_cache)
+      app_under_test_content_tasks.append(signing_graph.AddTask(
+          'test_bundle',
+          functools.partial(bundle_util.CodesignBundle,
+                            self._test_bundle_dir)))
+      signing_graph.AddTask(
+          'app_under_test',
+          functools.partial(bundle_util.CodesignBundle,
+                            self._app_under_test_dir),
+          deps=app_under_test_content_tasks)
+      signing_graph.Run()
 
     app_under_test_name = os.path.splitext(
         os.path.basename(self._app_under_test_dir))[0]
@@ -716,7 +755,7 @@ class XctestRunFactory(object):
     and test.xctestrun to test root directory.
     """
     dyld_framework_path = os.path.join(
-        xcode_info_util.GetSdkPlatformPath(self._sdk),
+        self._toolchain.GetSdkPlatformPath(self._sdk),
         'Developer/Library/Frameworks')
     test_envs = {
         'DYLD_FRAMEWORK_PATH': dyld_framework_path,
@@ -725,7 +764,7 @@ class XctestRunFactory(object):
     self._xctestrun_dict = {
         'ProductModuleName': self._test_name.replace("-", "_"),
         'TestBundlePath': self._test_bundle_dir,
-        'TestHostPath': xcode_info_util.GetXctestToolPath(self._sdk),
+        'TestHostPath': self._toolchain.GetXctestToolPath(self._sdk),
         'TestingEnvironmentVariables': test_envs,
     }
 
@@ -740,21 +779,57 @@ def _MoveAndReplaceFile(src_file, target_parent_dir):
   return new_file_path
 
 
-def _CopyAndSignFramework(src_framework, target_parent_dir, signing_identity):
+def _AddCopyAndSignTasks(signing_graph, src_paths, target_parent_dir,
+                         signing_identity, framework_cache=None):
+  """Adds the tasks to copy and sign the frameworks and libraries to the graph.
+
+  Args:
+    signing_graph: task_graph.TaskGraph, the graph to add the tasks to.
+    src_paths: a list of string, the paths of the frameworks and the dylibs.
+    target_parent_dir: string, the directory to copy the files to.
+    signing_identity: string, the identity to sign the files.
+    framework_cache: signed_framework_cache.SignedFrameworkCache, the cache of
+      the signed copies. None means always signing the copies.
+
+  Returns:
+    a list of string, the names of the added tasks.
+  """
+  task_names = []
+  for src_path in src_paths:
+    if src_path.endswith('.dylib'):
+      copy_and_sign_fn = _CopyAndSignLibFile
+    else:
+      copy_and_sign_fn = _CopyAndSignFramework
+    task_names.append(signing_graph.AddTask(
+        os.path.basename(src_path),
+        functools.partial(copy_and_sign_fn, src_path, target_parent_dir,
+                          signing_identity, framework_cache)))
+  return task_names
+
+
+def _CopyAndSignFramework(src_framework, target_parent_dir, signing_identity,
+                          framework_cache=None):
   """Copies the framework to the directory and signs the file with identity."""
   file_name = os.path.basename(src_framework)
   target_path = os.path.join(target_parent_dir, file_name)
   if os.path.exists(target_path):
     shutil.rmtree(target_path)
-  shutil.copytree(src_framework, target_path)
+  if framework_cache:
+    framework_cache.CopyAndSign(src_framework, target_path, signing_identity)
+    return
+  materialize_util.MaterializeTree(src_framework, target_path)
   bundle_util.CodesignBundle(target_path, identity=signing_identity)
 
 
-def _CopyAndSignLibFile(src_lib, target_parent_dir, signing_identity):
+def _CopyAndSignLibFile(src_lib, target_parent_dir, signing_identity,
+                        framework_cache=None):
   """Copies the library to the directory and signs the file with identity."""
   file_name = os.path.basename(src_lib)
   target_path = os.path.join(target_parent_dir, file_name)
   if os.path.exists(target_path):
     os.remove(target_path)
-  shutil.copy(src_lib, target_path)
+  if framework_cache:
+    framework_cache.CopyAndSign(src_lib, target_path, signing_identity)
+    return
+  materialize_util.MaterializeFile(src_lib, target_path)
   bundle_util.CodesignBundle(target_path, identity=signing_identity)